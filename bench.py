@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#==============================================================================#
+#   Micro-benchmarks for the i3ircterm hot paths
+#==============================================================================#
+#
+#   Usage: python bench.py [name ...]
+#
+#   Runs every benchmark when no names are given. None of these need the
+#   printer or the VFD attached.
+
+import sys
+import timeit
+
+import raster
+import cp437
+import glyphs
+import gpiomem
+import noritake
+from lrucache import LRUCache
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(name, seconds, n, unit):
+    print '%-32s %10.3f ms  %12.1f %s/s' % (name, seconds * 1000, n / seconds, unit)
+
+
+def best_of(func, repeat=3, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+#----------------------------------------------------------------------#
+#   Bitmap rasterizer
+#----------------------------------------------------------------------#
+
+def legacy_pack(pixels, w, h, black_threshold=48, alpha_threshold=127):
+    """ The per-pixel conversion and packing that print_bitmap used to do,
+        kept here as the baseline to compare raster.pack_rows against. """
+    black_and_white_pixels = [1] * 384 * h
+    for i, p in enumerate(pixels):
+        if sum(p[0:3]) / 3.0 < black_threshold and p[3] > alpha_threshold:
+            black_and_white_pixels[i % w + i / w * 384] = 0
+        else:
+            black_and_white_pixels[i % w + i / w * 384] = 1
+    print_bytes = []
+    counter = 0
+    for rowStart in xrange(0, h, 255):
+        chunkHeight = 255 if (h - rowStart) > 255 else h - rowStart
+        print_bytes += (18, 42, chunkHeight, 48)
+        for i in xrange(0, 48 * chunkHeight, 1):
+            byt = 0
+            for xx in xrange(8):
+                if black_and_white_pixels[counter] == 0:
+                    byt += 1 << (7 - xx)
+                counter += 1
+            print_bytes.append(byt)
+    return ''.join(map(chr, print_bytes))
+
+
+def test_image(w, h):
+    """ An RGBA test pattern with diagonal stripes and a transparent border. """
+    pixels = []
+    for y in xrange(h):
+        for x in xrange(w):
+            v = 0 if (x + y) % 16 < 8 else 255
+            a = 0 if x < 4 or y < 4 else 255
+            pixels.append((v, (v + x) % 256, (v + y) % 256, a))
+    return pixels
+
+
+@benchmark
+def bitmap(w=384, h=800):
+    pixels = test_image(w, h)
+
+    def new():
+        return ''.join(raster.chunks(raster.pack_rows(pixels, w, h)))
+
+    if new() != legacy_pack(pixels, w, h):
+        print 'bitmap: raster output differs from the legacy conversion!'
+    engine = 'numpy' if raster.numpy is not None else 'python'
+    report('bitmap legacy %dx%d' % (w, h), best_of(lambda: legacy_pack(pixels, w, h), 1), h, 'rows')
+    report('bitmap raster/%s %dx%d' % (engine, w, h), best_of(new), h, 'rows')
+    if raster.numpy is not None:
+        numpy, raster.numpy = raster.numpy, None
+        try:
+            report('bitmap raster/python %dx%d' % (w, h), best_of(new), h, 'rows')
+        finally:
+            raster.numpy = numpy
+
+
+#----------------------------------------------------------------------#
+#   VFD bus
+#----------------------------------------------------------------------#
+
+class MockGPIO(object):
+    """ Stands in for Adafruit_BBIO.GPIO and counts output() calls. """
+    OUT = 'out'
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.calls = 0
+
+    def setup(self, pin, mode):
+        pass
+
+    def output(self, pin, level):
+        self.calls += 1
+
+
+def legacy_send(gpio, code):
+    """ What Screen.sendCommand + transfer used to do for one character. """
+    command = bin(int(code, 16))[2:].zfill(8)
+    gpio.output(noritake.PINS['RS'], 0)
+    for i in xrange(8):
+        gpio.output(noritake.PINS['DB%d' % (7 - i)], int(command[i]))
+    gpio.output(noritake.PINS['E'], 1)
+    for pin in noritake.PINS.itervalues():
+        gpio.output(pin, 0)
+
+
+@benchmark
+def vfd(n=noritake.ROWS * noritake.COLS * 50):
+    text = ('<agmlego> Hello i3ircterm, the VFD says hi! ' * (n / 40 + 1))[:n]
+    chars = cp437.transpose()
+    codes = [chars[c] for c in text]
+    data = bytearray(cp437.encode(text))
+
+    gpio = MockGPIO()
+    report('vfd legacy sendCommand', best_of(lambda: [legacy_send(gpio, c) for c in codes]), n, 'chars')
+    print '%-32s %10.1f gpio calls/char' % ('', gpio.calls / 3.0 / n)
+
+    gpio = MockGPIO()
+    backend = noritake.GPIOBackend(gpio=gpio)
+    gpio.calls = 0
+    report('vfd GPIOBackend.write', best_of(lambda: [backend.write(b) for b in data]), n, 'chars')
+    report('vfd GPIOBackend.write_bytes', best_of(lambda: backend.write_bytes(data)), n, 'chars')
+    print '%-32s %10.1f gpio calls/char' % ('', gpio.calls / 6.0 / n)
+
+    regs = gpiomem.FakeRegisters()
+    backend = noritake.MmapBackend(regs=regs)
+    backend.write_bytes(data[:256])
+    del regs.writes[:]
+    report('vfd MmapBackend (fake regs)', best_of(lambda: backend.write_bytes(data)), n, 'chars')
+    print '%-32s %10.1f register writes/char' % ('', len(regs.writes) / 3.0 / n)
+
+
+def legacy_print_line(screen, line, y):
+    """ What Screen.printLine used to do: a sendCommand per command byte
+        from a hex string, then a printChar per character, each encoded,
+        written and counted on its own. """
+    for command in ('0x1F', '0x24', '0x%02x' % 0, '0x%02x' % y):
+        screen.sendCommand(command)
+    screen.updatePos(x=0, y=y, abs=True)
+    for char in line[:noritake.COLS]:
+        screen.backend.write_bytes(cp437.encode(char))
+        screen.updatePos(x=1)
+
+
+@benchmark
+def screen(frames=200):
+    lines = [(u'<agmlego> Hello i3ircterm, row %d says hi! ' % y)[:noritake.COLS]
+             for y in xrange(noritake.ROWS)]
+    n = frames * noritake.ROWS * noritake.COLS
+    for name, backend in (('GPIOBackend', lambda: noritake.GPIOBackend(gpio=MockGPIO())),
+                          ('MmapBackend', lambda: noritake.MmapBackend(regs=gpiomem.FakeRegisters()))):
+        display = noritake.Screen(backend=backend())
+
+        def old():
+            for i in xrange(frames):
+                for y, line in enumerate(lines):
+                    legacy_print_line(display, line, y)
+
+        def new():
+            for i in xrange(frames):
+                for y, line in enumerate(lines):
+                    display.write(line, 0, y)
+
+        report('screen legacy printLine/%s' % name, best_of(old), n, 'chars')
+        report('screen Screen.write/%s' % name, best_of(new), n, 'chars')
+        if isinstance(display.backend, noritake.MmapBackend):
+            del display.backend.regs.writes[:]
+
+
+@benchmark
+def vfdtiming(frames=40):
+    """ Characters per second the display takes without losing any, on a
+        virtualvfd.VirtualVFD checking every strobe. Fails when EXEC_TIMES
+        undershoots the VirtualVFD's own model of the display. """
+    import virtualvfd
+    short = virtualvfd.undershoot(noritake.EXEC_TIMES)
+    if short:
+        sys.exit('EXEC_TIMES is short of what the display needs for: %s' % ', '.join(
+            '%s %s (%.0f us < %.0f us)' % (name, ' '.join('%02X' % b for b in data),
+                                          waits * 1e6, needs * 1e6)
+            for name, data, waits, needs in short))
+    lines = [(u'<agmlego> row %d, the VFD keeps up ' % y)[:noritake.COLS]
+             for y in xrange(noritake.ROWS)]
+    n = frames * (noritake.ROWS * noritake.COLS + 1)
+    busy_pins = dict(noritake.PINS, BUSY='P9_25')
+    for name, pins, timing in (('untimed', noritake.PINS, None),
+                               ('EXEC_TIMES', noritake.PINS, 'auto'),
+                               ('BUSY', busy_pins, 'auto')):
+        regs = virtualvfd.VirtualVFD(pins)
+        display = noritake.Screen(backend=noritake.MmapBackend(pins, regs=regs, timing=timing))
+
+        def run():
+            for i in xrange(frames):
+                for y, line in enumerate(lines):
+                    display.write(line, 0, y)
+                # and a scroll
+                display.write(u'\n', 0, noritake.ROWS - 1)
+            del regs.writes[:]
+
+        report('vfdtiming %s' % name, best_of(run), n, 'chars')
+        early = [v for v in regs.violations if v[1] == 'early']
+        print '%-32s %10d bytes too early, %d hold violations' % (
+            '', len(early), len(regs.violations) - len(early))
+
+
+#----------------------------------------------------------------------#
+#   CP437 codec
+#----------------------------------------------------------------------#
+
+IRC_LINES = [
+    u'<agmlego> anyone know where the 3/8" drill bits went?',
+    u'<nate> they’re in the drawer under the “lathe stuff” sign — top left',
+    u'<kirk> café run in 10, who wants what ☕',
+    u'<bot> [github] i3detroit/i3ircterm: 3 new commits pushed to master https://github.com/i3detroit/i3ircterm/compare/abc123...def456',
+    u'<someone> ╭━━━━━━╮ box ╰━━━━━━╯ and ünïcödé',
+]
+
+
+@benchmark
+def codec(n=2000):
+    lines = IRC_LINES * (n / len(IRC_LINES))
+    cp437.encode(u''.join(lines))   # warm the fallback cache
+    report('codec python cp437 replace', best_of(lambda: [l.encode('cp437', 'replace') for l in lines]), n, 'lines')
+    report('codec cp437.encode', best_of(lambda: [cp437.encode(l) for l in lines]), n, 'lines')
+
+
+#----------------------------------------------------------------------#
+#   Raster glyphs
+#----------------------------------------------------------------------#
+
+MIXED_LINES = [
+    u'<agmlego> laser cutter is free again 🎉🎉',
+    u'<nate> 今日は on the CNC, back at 8',
+    u'<kirk> ok 👍',
+    u'<someone> anyone know where the 3/8" drill bits went?',
+    u'<bot> 새 커밋 3개 pushed to master ✨',
+]
+
+
+def fake_rasterize(char, width):
+    """ A checkerboard stand-in for the PIL rasterizer. """
+    cp = glyphs.codepoint(char)
+    return [''.join(['1' if (x + y + cp) % 3 == 0 else '0' for x in xrange(width)])
+            for y in xrange(glyphs.HEIGHT)]
+
+
+# fonts to rasterize with, the one ircterm uses when it is there
+GLYPH_FONTS = [glyphs.FONT, '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf']
+
+
+@benchmark
+def glyph(n=500):
+    """ Lines with glyphs rendered with every lookup missing the cache
+        (LRUCache(0)) against a cache warmed up by a first pass. Uses PIL
+        and the first of GLYPH_FONTS there is, a fake rasterizer without;
+        the fake is several times cheaper than PIL, so only the PIL numbers
+        say what the cache saves. """
+    lines = MIXED_LINES * (n / len(MIXED_LINES))
+    renderer = None
+    for font in GLYPH_FONTS:
+        try:
+            renderer = glyphs.GlyphRenderer(font)
+            engine = 'pil %s' % font.rsplit('/', 1)[-1]
+            break
+        except (ImportError, IOError):
+            pass
+    if renderer is None:
+        renderer = glyphs.GlyphRenderer(rasterize=fake_rasterize)
+        engine = 'fake'
+
+    def render():
+        for line in lines:
+            if glyphs.needs_glyphs(line):
+                renderer.render(line)
+            else:
+                cp437.encode(line)
+
+    renderer.cache = LRUCache(0)
+    report('glyph %s uncached' % engine, best_of(render), n, 'lines')
+    renderer.cache = LRUCache()
+    render()
+    renderer.cache.hits = renderer.cache.misses = 0
+    report('glyph %s warm cache' % engine, best_of(render), n, 'lines')
+    print '%-32s %10d hits %d misses' % ('', renderer.cache.hits, renderer.cache.misses)
+
+
+#----------------------------------------------------------------------#
+#   End to end through the virtual printer
+#----------------------------------------------------------------------#
+
+@benchmark
+def printer(n=200):
+    from printer import ThermalPrinter
+    from virtualprinter import VirtualPrinter
+    lines = [cp437.encode(l) + '\n' for l in IRC_LINES * (n / len(IRC_LINES))]
+
+    def run():
+        # everything is handed over at once, so print_time is the printer's own
+        vp = VirtualPrinter(clock=lambda: 0.0)
+        p = ThermalPrinter(serialport=vp, pacing=False)
+        p.font_b_on()
+        for line in lines:
+            p.print_text(line)
+        p.flush()
+        return vp
+
+    report('printer host side', best_of(run), n, 'lines')
+    vp = run()
+    report('printer paper (modelled)', vp.print_time, len(vp.lines), 'lines')
+    print '%-32s %10d dot rows %d bytes' % ('', len(vp.paper), vp.bytes)
+
+
+#----------------------------------------------------------------------#
+#   Line layout
+#----------------------------------------------------------------------#
+
+@benchmark
+def wrap(n=5000):
+    from textwrap import TextWrapper
+    import layout
+    lines = ['12:34:56 ' + cp437.encode(l) for l in IRC_LINES * (n / len(IRC_LINES))]
+    wrapper = TextWrapper(initial_indent='', subsequent_indent=' ' * 9, width=42, drop_whitespace=True)
+    fast = layout.Layout(42, 9)
+    differ = sum(1 for l in lines[:len(IRC_LINES)] if wrapper.wrap(l) != fast.wrap(l))
+    report('wrap TextWrapper.fill', best_of(lambda: [wrapper.fill(l) for l in lines]), n, 'lines')
+    report('wrap Layout.fill', best_of(lambda: [fast.fill(l) for l in lines]), n, 'lines')
+    print '%-32s %10d of %d lines laid out differently' % ('', differ, len(IRC_LINES))
+
+
+#----------------------------------------------------------------------#
+#   Logging on the message path
+#----------------------------------------------------------------------#
+
+@benchmark
+def logs(n=20000):
+    import logging
+    import os
+    import Queue
+    import logsetup
+    devnull = open(os.devnull, 'w')
+    args = ('nate!~nate@example.net', '#i3detroit', IRC_LINES[1].encode('utf-8'))
+
+    # what every IRCHandler callback used to do: look the logger up, format
+    # eagerly and write to the console and irc.log right away
+    legacy = logging.getLogger('bench.legacy')
+    legacy.propagate = False
+    for i in xrange(2):
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter(logsetup.FORMAT))
+        legacy.addHandler(handler)
+    legacy.setLevel(logging.DEBUG)
+
+    def old():
+        for i in xrange(n):
+            logger = logging.getLogger('bench.legacy.privmsg')
+            logger.debug('PRIVMSG from %s in %s: %s' % args)
+
+    queue = Queue.Queue()
+    queued = logging.getLogger('bench.queued')
+    queued.propagate = False
+    queued.addHandler(logsetup.QueueHandler(queue))
+    log = logsetup.Loggers('bench.queued')
+
+    def new():
+        for i in xrange(n):
+            log.privmsg.debug('PRIVMSG from %s in %s: %s', *args)
+
+    report('logs legacy DEBUG', best_of(old), n, 'messages')
+    queued.setLevel(logging.DEBUG)
+    report('logs queued DEBUG', best_of(new), n, 'messages')
+    queued.setLevel(logging.INFO)
+    report('logs cached INFO', best_of(new), n, 'messages')
+    devnull.close()
+
+
+@benchmark
+def store(n=20000):
+    import os
+    import tempfile
+    import scrollstore
+    path = os.path.join(tempfile.mkdtemp(), 'scrollback.dat')
+    nicks = [u'nate', u'alice', u'bob', u'carol', u'dave']
+    lines = IRC_LINES * (n / len(IRC_LINES) + 1)
+    writer = scrollstore.ScrollStore(path)
+
+    def append():
+        for i in xrange(n):
+            writer.append(u'#i3detroit', nicks[i % 5], lines[i],
+                          scrollstore.HIGHLIGHT if i % 50 == 0 else 0, 1e9 + i)
+
+    report('store append', best_of(append, repeat=1), n, 'records')
+    report('store open', best_of(lambda: scrollstore.ScrollStore(path, writable=False)),
+           len(writer), 'records')
+    report('store open to append', best_of(lambda: scrollstore.ScrollStore(path).close()),
+           len(writer), 'records')
+    reader = scrollstore.ScrollStore(path, writable=False)
+    report('store last 50 from nick', best_of(lambda: reader.query(u'Alice', last=50), number=100),
+           50, 'records')
+    report('store mentions since', best_of(lambda: reader.query(highlight=True, since=1e9 + len(reader) - 5000),
+                                           number=100), 100, 'records')
+    reader.close()
+    writer.close()
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+
+@benchmark
+def rules(n=2000):
+    import random
+    import re
+    from rules import Rules
+    rand = random.Random(42)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    lines = IRC_LINES * (n / len(IRC_LINES))
+    for count in (100, 300, 1000):
+        words = [''.join(rand.choice(letters) for i in xrange(rand.randint(4, 9)))
+                 for j in xrange(count)]
+        regexes = [r'\bticket #%d\b' % i for i in xrange(count / 10)]
+        nicks = ['bot%d' % i for i in xrange(count / 10)]
+        compiled = Rules([(word, 'highlight') for word in words], [(r, 'vfd') for r in regexes],
+                         [(nick, 'suppress') for nick in nicks], ['vfd'])
+
+        # a regular expression per rule, tried one after the other
+        each = [re.compile(r'(?<!\w)%s(?!\w)' % word, re.I | re.U) for word in words]
+        each += [re.compile(r, re.I | re.U) for r in regexes]
+        ignored = set(nicks)
+
+        def old():
+            for line in lines:
+                if 'nate' not in ignored:
+                    for regex in each:
+                        if regex.search(line):
+                            break
+
+        def new():
+            for line in lines:
+                compiled.classify(line, 'nate', 'i3ircterm')
+
+        report('rules %d one by one' % count, best_of(old), n, 'messages')
+        report('rules %d compiled' % count, best_of(new), n, 'messages')
+
+
+@benchmark
+def replay():
+    import replay
+    for name in sorted(replay.PROFILES):
+        run = replay.Replay(replay.PROFILES[name](), vfd=False, digest=False).run()
+        report('replay %s' % name, run.wall, len(run.events), 'messages')
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit('Unknown benchmark %s, choose from: %s' % (name, ' '.join(sorted(BENCHMARKS))))
+        BENCHMARKS[name]()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import time
+
+#==============================================================================#
+#   Monotonic clock
+#==============================================================================#
+#
+#   The BeagleBone has no RTC, so NTP steps the wall clock at boot and
+#   whenever it has drifted. Anything measuring intervals or waiting until
+#   a deadline (the VFD bus timing, the printer pacing, the loop's timers)
+#   reads monotonic() instead of time.time(); time.time() is for the times
+#   that get printed or stored. Python 2 has no time.monotonic(), this gets
+#   clock_gettime(CLOCK_MONOTONIC) from librt with ctypes.
+
+def _monotonic_clock():
+    try:
+        import ctypes
+        import ctypes.util
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        gettime = librt.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    byref = ctypes.byref
+
+    def monotonic():
+        t = timespec()
+        gettime(CLOCK_MONOTONIC, byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds from clock_gettime(CLOCK_MONOTONIC), or time.time() where there is
+# no librt to get it from
+monotonic = _monotonic_clock()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import codecs
+import unicodedata
+
 CHARS = {
      #  0    1    2    3    4    5    6    7     8    9    A    B    C    D    E    F
 0x20:[u' ',u'!',u'"',u'#',u'$',u'%',u'&',u'\'',u'(',u')',u'*',u'+',u',',u'-',u'.',u'/'],
@@ -16,7 +19,7 @@ CHARS = {
 0xC0:[u'└',u'┴',u'┬',u'├',u'─',u'┼',u'╞',u'╟',u'╚',u'╔',u'╩',u'╦',u'╠',u'═',u'╬',u'╧'],
 0xD0:[u'╨',u'╤',u'╥',u'╙',u'╘',u'╒',u'╓',u'╫',u'╪',u'┘',u'┌',u'█',u'▄',u'▌',u'▐',u'▀'],
 0xE0:[u'α',u'ß',u'Γ',u'π',u'Σ',u'σ',u'µ',u'τ',u'Φ',u'Θ',u'Ω',u'δ',u'∞',u'φ',u'ε',u'∩'],
-0xF0:[u'≡',u'±',u'≥',u'≤',u'⌠',u'⌡',u'÷',u'≈',u'°',u'∙',u'·',u'√',u'ⁿ',u'²',u'■',u' ']}
+0xF0:[u'≡',u'±',u'≥',u'≤',u'⌠',u'⌡',u'÷',u'≈',u'°',u'∙',u'·',u'√',u'ⁿ',u'²',u'■',u'\xa0']}
 
 def transpose():
     chars = {}
@@ -25,6 +28,101 @@ def transpose():
             chars[CHARS[msb][lsb]] = hex(msb+lsb)
     return chars
 
+#----------------------------------------------------------------------#
+#   Codec
+#----------------------------------------------------------------------#
+#
+#   CODES maps each character in CHARS to its byte, and ENCODING_MAP is the
+#   same table keyed by code point, plus the newline, for
+#   codecs.charmap_encode(). It is built from CODES and not from DECODING,
+#   whose placeholder for the unused control bytes would otherwise encode
+#   to one of them: IRC text must never reach the VFD as a command byte.
+#
+#   Characters that are not in CP437 go to the 'cp437-translit' error handler
+#   the first time they show up and are added to ENCODING_MAP (and TRANSLIT)
+#   with what they turn into, so the next time they are a lookup: smart quotes,
+#   dashes and the like go through FALLBACK, box drawing characters go to the
+#   nearest CP437 ones, accented letters lose their accents through NFKD, and
+#   whatever is left becomes '?'. Control characters other than a newline
+#   are dropped.
+
+CODES = dict((CHARS[msb][lsb], msb + lsb)
+             for msb in xrange(0x20,0x100,0x10) for lsb in xrange(0x00,0x10))
+
+# byte -> character, u'\ufffe' marks bytes that are never produced
+DECODING = u''.join([u'\n' if b == 0x0A else u'\ufffe' for b in xrange(0x20)] +
+                    [CHARS[msb][lsb] for msb in xrange(0x20,0x100,0x10) for lsb in xrange(0x00,0x10)])
+ENCODING_MAP = dict((ord(c), b) for c, b in CODES.iteritems())
+ENCODING_MAP[ord(u'\n')] = 0x0A
+
+UNKNOWN = u'?'
+
+FALLBACK = {
+    u'‘':u"'", u'’':u"'", u'‚':u"'", u'‛':u"'", u'′':u"'",
+    u'“':u'"', u'”':u'"', u'„':u'"', u'‟':u'"', u'″':u'"',
+    u'‐':u'-', u'‑':u'-', u'‒':u'-', u'–':u'-', u'—':u'-', u'―':u'-', u'−':u'-',
+    u'…':u'...', u'•':u'∙', u'‣':u'>', u'‹':u'<', u'›':u'>',
+    u'←':u'<-', u'→':u'->', u'↑':u'^', u'↓':u'v', u'⇒':u'=>', u'⇐':u'<=', u'↔':u'<->',
+    u'×':u'x', u'≠':u'!=', u'©':u'(c)', u'®':u'(R)', u'™':u'TM', u'€':u'EUR',
+    u'\t':u' ', u'\u200b':u'', u'\ufeff':u'',
+    # heavy, rounded and dashed box drawing to the light CP437 set
+    u'━':u'─', u'┃':u'│', u'┄':u'─', u'┅':u'─', u'┆':u'│', u'┇':u'│',
+    u'┈':u'─', u'┉':u'─', u'┊':u'│', u'┋':u'│', u'╌':u'─', u'╍':u'─',
+    u'╎':u'│', u'╏':u'│', u'╭':u'┌', u'╮':u'┐', u'╯':u'┘', u'╰':u'└',
+    u'┏':u'┌', u'┓':u'┐', u'┗':u'└', u'┛':u'┘', u'┣':u'├', u'┫':u'┤',
+    u'┳':u'┬', u'┻':u'┴', u'╋':u'┼', u'╱':u'/', u'╲':u'\\', u'╳':u'X',
+}
+
+TRANSLIT = {}
+
+def transliterate(char):
+    '''CP437 stand-in for a character CP437 doesn't have, '' to drop it.'''
+    try:
+        return TRANSLIT[char]
+    except KeyError:
+        pass
+    cp = ord(char)
+    if char in FALLBACK:
+        value = FALLBACK[char]
+    elif cp < 0x20 or 0x7F <= cp < 0xA0:
+        value = u''
+    elif 0xDC00 <= cp < 0xE000:
+        # second half of a surrogate pair on narrow builds, the first half
+        # already turned into a '?'
+        value = u''
+    else:
+        value = UNKNOWN
+        base = [c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c)]
+        if base and base != [char] and all(c in CODES or c in FALLBACK for c in base):
+            value = u''.join([FALLBACK.get(c, c) for c in base])
+    TRANSLIT[char] = value
+    if len(char) == 1:
+        ENCODING_MAP[cp] = codecs.charmap_encode(value, 'strict', ENCODING_MAP)[0]
+    return value
+
+def printable(char):
+    '''True if char can be printed as CP437 text, directly or transliterated.
+    A surrogate pair (a character outside the BMP on narrow builds) can't.'''
+    if len(char) != 1:
+        return False
+    return char in CODES or transliterate(char) != UNKNOWN
+
+def _translit_errors(error):
+    return u''.join([transliterate(c) for c in error.object[error.start:error.end]]), error.end
+
+codecs.register_error('cp437-translit', _translit_errors)
+
+def encode(text):
+    '''Encode text for the printer or the VFD, transliterating what CP437
+    lacks. Returns a str of bytes.'''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return codecs.charmap_encode(text, 'cp437-translit', ENCODING_MAP)[0]
+
+def decode(data):
+    '''Turn printer/VFD bytes back into text.'''
+    return codecs.charmap_decode(data, 'replace', DECODING)[0]
+
 if __name__ == '__main__':
     asciiheader = '   | ' + ' '.join([hex(i)[2] + 'h' for i in xrange(0x20,0x80,0x10)])
     extheader = ' |  ' + ' '.join([hex(i)[2] + 'h' for i in xrange(0x80,0x100,0x10)])
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import math
+import re
+import time
+from datetime import datetime
+
+#==============================================================================#
+#   Coalescing and digest stage in front of the printer
+#==============================================================================#
+#
+#   Digest sits between IRCHandler and the printer (or its PrintQueue) and
+#   has the same print_line(). It does two things to save paper and head
+#   time when the channel gets busy:
+#
+#   - join/part/quit/mode events go through membership() and are collected
+#     over a sliding window. A lone event is printed as usual, a burst turns
+#     into one summary like "-!- 14 joins, 9 quits (netsplit)".
+#
+#   - the rate of printed lines is tracked, and while it is above what the
+#     printer can sustain only highlighted lines get through. Once the rate
+#     drops again a single line says how many were skipped.
+#
+#   Timers run on the IRC loop, so everything here happens on one thread.
+
+KINDS = ('join', 'part', 'quit', 'mode')
+
+# a quit message of two server names is what a netsplit looks like
+NETSPLIT = re.compile(r'^[\w-]+(\.[\w-]+)+ [\w-]+(\.[\w-]+)+$')
+
+
+class Digest(object):
+
+    # flush a burst after WINDOW quiet seconds, or MAX_WINDOW after it started
+    WINDOW = 5.0
+    MAX_WINDOW = 30.0
+    # time constant of the line rate estimate, in seconds
+    RATE_TAU = 10.0
+    # leave digest mode once the rate drops below this share of the capacity
+    RESUME = 0.8
+    # printer columns, to estimate how many printed lines a message takes
+    WIDTH = 42
+    INDENT = 9
+
+    def __init__(self, output, loop, capacity=None, window=WINDOW, max_window=MAX_WINDOW):
+        '''output has a print_line(), loop is an ircclient.Loop and capacity
+        the sustainable printer rate in lines per second (None for no limit).'''
+        self.output = output
+        self.loop = loop
+        self.capacity = capacity
+        self.window = window
+        self.max_window = max_window
+
+        self.rate = 0.0
+        self.digest_mode = False
+        self.skipped = 0
+        self._rate_at = time.time()
+
+        self._events = []
+        self._first = None
+        self._timer = None
+
+    #   rate tracking and digest mode
+
+    def _lines(self, text):
+        return 1 + max(0, len(text) - self.INDENT) // (self.WIDTH - self.INDENT)
+
+    def _update_rate(self, lines):
+        now = time.time()
+        self.rate *= math.exp(-(now - self._rate_at) / self.RATE_TAU)
+        self.rate += lines / self.RATE_TAU
+        self._rate_at = now
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        if timestamp is True:
+            timestamp = datetime.now()
+        self._update_rate(self._lines(text))
+        if self.capacity is not None:
+            if not self.digest_mode and self.rate > self.capacity:
+                logger = logging.getLogger('IRCTerm.Digest.print_line')
+                logger.info('%.1f lines/s is more than the printer can take, '
+                            'only printing highlights', self.rate)
+                self.digest_mode = True
+                self.output.print_line('-!- Busy, only printing highlights', timestamp)
+            elif self.digest_mode and self.rate < self.RESUME * self.capacity:
+                logger = logging.getLogger('IRCTerm.Digest.print_line')
+                logger.info('Back to printing everything, skipped %d lines', self.skipped)
+                self.digest_mode = False
+                self.output.print_line('-!- Skipped %d lines' % self.skipped, timestamp)
+                self.skipped = 0
+        if self.digest_mode and not highlight:
+            self.skipped += 1
+            return
+        self.output.print_line(text, timestamp, highlight, event)
+
+    #   join/part/quit/mode aggregation
+
+    def membership(self, kind, event, chan, text, reason=None):
+        '''Queue a join/part/quit/mode event (an events.Join etc.), text is
+        the line to print if it turns out to be the only one in its window.
+        It is printed with the time the event was received.'''
+        now = time.time()
+        if not self._events:
+            self._first = now
+        self._events.append((kind, event.nick, chan, text, reason, event.timestamp()))
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = min(self.window, self._first + self.max_window - now)
+        self._timer = self.loop.call_later(max(0.0, delay), self.flush)
+
+    def flush(self):
+        '''Print whatever membership events are pending.'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        events, self._events = self._events, []
+        if not events:
+            return
+        if len(events) == 1:
+            kind, nick, chan, text, reason, timestamp = events[0]
+            self.print_line(text, timestamp)
+            return
+        self.print_line(summarize(events), events[0][5])
+
+
+def summarize(events):
+    '''One line summary of a burst of (kind, nick, chan, ...) events.'''
+    counts = dict((kind, 0) for kind in KINDS)
+    netsplit = 0
+    chans = set()
+    for kind, nick, chan, text, reason, timestamp in events:
+        counts[kind] += 1
+        if kind == 'quit' and reason and NETSPLIT.match(reason):
+            netsplit += 1
+        elif chan:
+            chans.add(chan)
+    parts = []
+    for kind in KINDS:
+        if counts[kind]:
+            part = '%d %s%s' % (counts[kind], kind, 's' if counts[kind] > 1 else '')
+            if kind == 'quit' and netsplit:
+                part += ' (netsplit)'
+            parts.append(part)
+    line = '-!- ' + ', '.join(parts)
+    if len(chans) == 1:
+        line += ' in %s' % chans.pop()
+    return line
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from lrucache import LRUCache
+
+#==============================================================================#
+#   IRC events
+#==============================================================================#
+#
+#   IRCHandler turns what ircclient hands it, (prefix, *args), into one of
+#   these first thing, and the rules, the routes, the store and the outputs
+#   all work from that. They are namedtuples, no __dict__ and nothing to
+#   change on the way.
+#
+#   - the prefix is parsed once by prefix() into a Prefix, and the Prefix
+#     is kept for the next line from the same sender (in an LRUCache of
+#     the PREFIXES most recently seen), so its nick, user and host strings
+#     are shared rather than split out of the prefix again for every
+#     message. A prefix without '!' is a server or a bare nick: its nick
+#     is the whole thing and user and host are empty.
+#   - time is when the line came off the socket (received()), not when it
+#     gets printed, so a line that waited behind the printer still has the
+#     time it was said, and time.time() - event.time is how long everything
+#     after the socket took.
+#   - line() is the text the outputs print. The event goes along with it,
+#     through the routes and queues to every sink (see sinks.py), and
+#     fields() is what the JSON log makes of it.
+
+PREFIXES = 1024
+
+_prefixes = LRUCache(PREFIXES)
+
+
+class Prefix(namedtuple('Prefix', 'nick user host')):
+    __slots__ = ()
+
+    @property
+    def mask(self):
+        '''user@host, or whatever of it there is.'''
+        if self.user and self.host:
+            return u'%s@%s' % (self.user, self.host)
+        return self.user or self.host
+
+    @property
+    def full(self):
+        return u'%s!%s' % (self.nick, self.mask) if self.mask else self.nick
+
+    @property
+    def who(self):
+        ''''nick <user@host>' as the events print it.'''
+        return u'%s <%s>' % (self.nick, self.mask) if self.mask else self.nick
+
+
+def prefix(text):
+    '''The Prefix for 'nick!user@host', 'nick@host', 'nick' or a server.'''
+    p = _prefixes.get(text)
+    if p is None:
+        nick, bang, mask = text.partition('!')
+        if not bang:
+            nick, at, mask = text.partition('@')
+            p = Prefix(nick, u'', mask)
+        else:
+            user, at, host = mask.partition('@')
+            p = Prefix(nick, user, host) if at else Prefix(nick, mask, u'')
+        _prefixes.put(text, p)
+    return p
+
+
+def received(client):
+    '''When the line being handled was read, now for clients that don't
+    say (ircclient.IRCConnection does).'''
+    return getattr(client, 'received', None) or time.time()
+
+
+class _Event(object):
+    __slots__ = ()
+
+    @property
+    def nick(self):
+        return self.source.nick
+
+    def timestamp(self):
+        return datetime.fromtimestamp(self.time)
+
+    def fields(self):
+        '''The event as a dict for JSON, its type and fields with the source
+        as 'nick!user@host'.'''
+        fields = dict(zip(self._fields, self))
+        fields['type'] = type(self).__name__.lower()
+        fields['source'] = self.source.full
+        return fields
+
+
+class Privmsg(_Event, namedtuple('Privmsg', 'time source target text')):
+    __slots__ = ()
+
+    def line(self, private=False):
+        return u'%s<%s> %s' % (u'P' if private else u'', self.source.nick, self.text)
+
+
+class Notice(_Event, namedtuple('Notice', 'time source target text')):
+    __slots__ = ()
+
+    def line(self):
+        return u'%s: %s' % (self.source.full, self.text)
+
+
+class Join(_Event, namedtuple('Join', 'time source channel')):
+    __slots__ = ()
+
+    def line(self):
+        return u'-!- %s has joined %s' % (self.source.who, self.channel)
+
+
+class Part(_Event, namedtuple('Part', 'time source channel text')):
+    __slots__ = ()
+
+    def line(self):
+        if self.text:
+            return u'-!- %s has left %s: %s' % (self.source.who, self.channel, self.text)
+        return u'-!- %s has left %s' % (self.source.who, self.channel)
+
+
+class Quit(_Event, namedtuple('Quit', 'time source text')):
+    __slots__ = ()
+
+    def line(self):
+        if self.text:
+            return u'-!- %s has quit: %s' % (self.source.who, self.text)
+        return u'-!- %s has quit' % self.source.who
+
+
+class Mode(_Event, namedtuple('Mode', 'time source channel mode target')):
+    '''channel is None for user modes.'''
+    __slots__ = ()
+
+    def line(self):
+        return u'-!- mode/%s (%s %s) by %s' % (self.channel or u'none', self.mode,
+                                               self.target, self.source.nick)
+
+
+class Topic(_Event, namedtuple('Topic', 'time source channel text')):
+    '''The topic of a channel, as the server tells it on joining.'''
+    __slots__ = ()
+
+    def line(self):
+        return u'-!- Topic for %s: %s' % (self.channel, self.text)
+
+
+class Names(_Event, namedtuple('Names', 'time source channel names')):
+    '''names is a sorted tuple, with the @ and + of ops and voices.'''
+    __slots__ = ()
+
+    def line(self):
+        return u'-!- %d users in %s' % (len(self.names), self.channel)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import binascii
+import os
+import unicodedata
+
+import cp437
+import raster
+from lrucache import LRUCache
+
+try:
+    import Image, ImageDraw, ImageFont
+except ImportError:
+    try:
+        from PIL import Image, ImageDraw, ImageFont
+    except ImportError:
+        Image = ImageDraw = ImageFont = None
+
+#==============================================================================#
+#   Raster glyphs for text the printer's own font can't show
+#==============================================================================#
+#
+#   The printer only knows CP437. Lines holding characters that cp437 can't
+#   even transliterate (emoji, CJK, ...) are drawn with a local bitmap font
+#   instead and printed as a 384 dot wide raster strip, the same DC2 *
+#   protocol print_bitmap uses. Everything else keeps printing as text.
+#
+#   Glyphs are laid out on the same grid as the printer's font B: 9 dot wide
+#   cells, wide characters (east asian width W/F) taking two, 17 dot rows
+#   followed by the usual line spacing. Rendered glyphs are kept in an LRU
+#   cache keyed by (code point, font size), so a repeated emoji is only
+#   rasterized once.
+
+FONT = '/usr/share/fonts/truetype/unifont/unifont.ttf'
+FONT_SIZE = 16
+
+CELL_WIDTH = 9          # dots per character cell, as font B
+HEIGHT = 17             # dot rows per glyph, as font B
+LINE_SPACING = 6        # blank dot rows between lines
+COLUMNS = raster.DOTS // CELL_WIDTH
+
+
+def characters(text):
+    '''Iterate over the characters of text, keeping surrogate pairs of narrow
+    Python builds together.'''
+    i = 0
+    n = len(text)
+    while i < n:
+        if u'\ud800' <= text[i] < u'\udc00' and i + 1 < n:
+            yield text[i:i + 2]
+            i += 2
+        else:
+            yield text[i]
+            i += 1
+
+
+def codepoint(char):
+    if len(char) == 2:
+        return 0x10000 + (ord(char[0]) - 0xD800 << 10) + ord(char[1]) - 0xDC00
+    return ord(char)
+
+
+def cells(char):
+    try:
+        wide = unicodedata.east_asian_width(char) in ('W', 'F')
+    except TypeError:
+        # surrogate pair, everything outside the BMP that we care about
+        # (emoji, CJK extensions) is wide
+        wide = True
+    return 2 if wide else 1
+
+
+def needs_glyphs(text):
+    '''True if some character in text can't be printed as CP437 text.'''
+    return any(not cp437.printable(char) for char in text)
+
+
+class GlyphRenderer(object):
+    '''Turns lines of text into packed raster rows. rasterize(char, width)
+    returns HEIGHT strings of '0'/'1' of the given width; by default it draws
+    with PIL and the TrueType font at font_path.'''
+
+    def __init__(self, font_path=FONT, size=FONT_SIZE, rasterize=None, cache_size=1024):
+        self.size = size
+        self.cache = LRUCache(cache_size)
+        if rasterize is None:
+            if ImageFont is None:
+                raise ImportError('GlyphRenderer needs PIL')
+            if not os.path.exists(font_path):
+                raise IOError('Font not found at %s' % font_path)
+            self.font = ImageFont.truetype(font_path, size)
+            rasterize = self._rasterize
+        self.rasterize = rasterize
+
+    def _rasterize(self, char, width):
+        w, h = self.font.getsize(char)
+        img = Image.new('1', (width, HEIGHT), 0)
+        ImageDraw.Draw(img).text((max(0, (width - w) // 2), 0), char, font=self.font, fill=1)
+        pixels = ''.join(['1' if p else '0' for p in img.getdata()])
+        return [pixels[y * width:(y + 1) * width] for y in xrange(HEIGHT)]
+
+    def glyph(self, char):
+        '''(cells, rows) for a character, from the cache when possible.'''
+        key = (codepoint(char), self.size)
+        glyph = self.cache.get(key)
+        if glyph is None:
+            n = cells(char)
+            glyph = (n, self.rasterize(char, n * CELL_WIDTH))
+            self.cache.put(key, glyph)
+        return glyph
+
+    def _pack(self, rows, inverse):
+        fmt = '%%0%dx' % (raster.ROW_BYTES * 2)
+        pad = raster.DOTS - len(rows[0])
+        mask = (1 << raster.DOTS) - 1 if inverse else 0
+        return ''.join([binascii.unhexlify(fmt % (int(row + '0' * pad, 2) ^ mask)) for row in rows])
+
+    def render(self, line, indent=9, inverse=False):
+        '''Packed rows (raster.ROW_BYTES each) for a line of text, wrapping
+        onto more lines with an indent of that many cells if it is wider than
+        the paper. inverse prints white on black like a highlighted line.'''
+        out = []
+        rows = [''] * HEIGHT
+        x = 0
+        for char in characters(line):
+            n, glyph = self.glyph(char)
+            if x + n > COLUMNS:
+                out.append(self._pack(rows, inverse))
+                rows = ['0' * indent * CELL_WIDTH] * HEIGHT
+                x = indent
+            rows = [row + g for row, g in zip(rows, glyph)]
+            x += n
+        if x or not out:
+            out.append(self._pack(rows, inverse))
+        spacing = '\0' * raster.ROW_BYTES * LINE_SPACING
+        return spacing.join(out) + spacing
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import mmap
+import os
+import struct
+
+#==============================================================================#
+#   Memory-mapped GPIO registers of the AM335x (BeagleBone Black)
+#==============================================================================#
+#
+#   Writing SETDATAOUT/CLEARDATAOUT directly through /dev/mem changes any
+#   number of pins of a bank in one store, instead of one sysfs write per pin.
+#   The pins still have to be muxed as GPIOs (mode 7) by the device tree, and
+#   this needs root.
+#
+#   FakeRegisters has the same interface and emulates the set/clear semantics
+#   so the VFD code can be exercised off the board.
+
+BANKS = (0x44E07000, 0x4804C000, 0x481AC000, 0x481AE000)
+BANK_SIZE = 0x1000
+
+OE = 0x134              # output enable, 0 = output
+DATAIN = 0x138
+DATAOUT = 0x13C
+CLEARDATAOUT = 0x190
+SETDATAOUT = 0x194
+
+# header pin -> (bank, bit)
+HEADER = {'P9_11': (0, 30), 'P9_12': (1, 28), 'P9_13': (0, 31), 'P9_14': (1, 18),
+          'P9_15': (1, 16), 'P9_16': (1, 19), 'P9_17': (0, 5),  'P9_18': (0, 4),
+          'P9_19': (0, 13), 'P9_20': (0, 12), 'P9_21': (0, 3),  'P9_22': (0, 2),
+          'P9_23': (1, 17), 'P9_24': (0, 15), 'P9_25': (3, 21), 'P9_26': (0, 14),
+          'P9_27': (3, 19), 'P9_30': (3, 16), 'P9_41': (0, 20), 'P9_42': (0, 7)}
+
+_word = struct.Struct('<I')
+
+
+class MemRegisters(object):
+    '''GPIO banks mapped from /dev/mem.'''
+
+    def __init__(self, banks=(0, 1, 2, 3), path='/dev/mem'):
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self._maps = dict((bank, mmap.mmap(fd, BANK_SIZE, offset=BANKS[bank]))
+                              for bank in banks)
+        finally:
+            os.close(fd)
+
+    def read32(self, bank, offset):
+        return _word.unpack_from(self._maps[bank], offset)[0]
+
+    def write32(self, bank, offset, value):
+        _word.pack_into(self._maps[bank], offset, value)
+
+    def close(self):
+        for m in self._maps.itervalues():
+            m.close()
+
+
+class FakeRegisters(object):
+    '''In-memory register file for testing. Every write is recorded in
+    writes as (bank, offset, value).'''
+
+    def __init__(self):
+        self.regs = dict((bank, {OE: 0xFFFFFFFF, DATAOUT: 0}) for bank in xrange(len(BANKS)))
+        self.writes = []
+
+    def read32(self, bank, offset):
+        if offset == DATAIN:
+            offset = DATAOUT
+        return self.regs[bank].get(offset, 0)
+
+    def write32(self, bank, offset, value):
+        self.writes.append((bank, offset, value))
+        regs = self.regs[bank]
+        if offset == SETDATAOUT:
+            regs[DATAOUT] |= value
+        elif offset == CLEARDATAOUT:
+            regs[DATAOUT] &= ~value & 0xFFFFFFFF
+        else:
+            regs[offset] = value
+
+    def level(self, pin):
+        bank, bit = HEADER[pin]
+        return self.regs[bank][DATAOUT] >> bit & 1
+
+    def close(self):
+        pass
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import errno
+import heapq
+import itertools
+import logging
+import os
+import random
+import select
+import socket
+import time
+
+from oyoyo.ircevents import all_events, numeric_events
+
+from clock import monotonic
+
+#==============================================================================#
+#   Event driven IRC connection
+#==============================================================================#
+#
+#   Replaces the oyoyo IRCClient generator pump with a select() based loop:
+#   the socket is non-blocking, lines are parsed as they stream in, PINGs are
+#   answered right away, a quiet server gets pinged and a dead connection is
+#   re-established with exponential backoff.
+#
+#   Handlers are the same oyoyo style command handlers IRCTerm already uses:
+#   every message ends up in handler.<command>(prefix, *args), with numerics
+#   translated to their oyoyo names (001 -> welcome, 353 -> namreply, ...),
+#   and anything without a method goes to handler.__unhandled__. Only the
+#   names in EVENTS are looked up, so a server can't call the handler's
+#   other methods by sending a line named after them.
+#
+#   The Loop also runs timers and extra file descriptors, so other outputs
+#   (the VFD refresh, the serial keyboard) can share the same thread, and
+#   call_soon_threadsafe() lets worker threads hand results back to it.
+#   Timers and the keepalive run on clock.monotonic, so NTP stepping the
+#   wall clock neither stalls them nor sets them all off at once.
+
+
+class _Timer(object):
+    __slots__ = ('when', 'seq', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, seq, callback, args):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Loop(object):
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._seq = itertools.count()
+        self._pending = []
+        self._running = False
+
+        # self-pipe so other threads can wake up select()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self.add_reader(self._wakeup_r, self._drain_wakeup)
+
+    @staticmethod
+    def _fd(fileobj):
+        return fileobj if isinstance(fileobj, int) else fileobj.fileno()
+
+    def add_reader(self, fileobj, callback, *args):
+        self._readers[self._fd(fileobj)] = (callback, args)
+
+    def remove_reader(self, fileobj):
+        self._readers.pop(self._fd(fileobj), None)
+
+    def add_writer(self, fileobj, callback, *args):
+        self._writers[self._fd(fileobj)] = (callback, args)
+
+    def remove_writer(self, fileobj):
+        self._writers.pop(self._fd(fileobj), None)
+
+    def call_later(self, delay, callback, *args):
+        '''Run callback(*args) after delay seconds, returns a cancellable timer.'''
+        timer = _Timer(monotonic() + delay, next(self._seq), callback, args)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        '''Run callback(*args) in the loop thread, callable from any thread.'''
+        self._pending.append((callback, args))
+        os.write(self._wakeup_w, 'x')
+
+    def _drain_wakeup(self):
+        os.read(self._wakeup_r, 4096)
+        while self._pending:
+            callback, args = self._pending.pop(0)
+            self._run(callback, args)
+
+    def _run(self, callback, args):
+        logger = logging.getLogger('IRCTerm.Loop')
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('Error in %r', callback)
+
+    def stop(self):
+        self._running = False
+
+    def run_once(self, timeout=None):
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            delay = max(0.0, self._timers[0].when - monotonic())
+            timeout = delay if timeout is None else min(timeout, delay)
+        try:
+            readable, writable, _ = select.select(self._readers.keys(),
+                                                  self._writers.keys(), [], timeout)
+        except (select.error, IOError, OSError), e:
+            # interrupted by a signal, e.g. the day-change alarm
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            if fd in self._readers:
+                self._run(*self._readers[fd])
+        for fd in writable:
+            if fd in self._writers:
+                self._run(*self._writers[fd])
+        now = monotonic()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._run(timer.callback, timer.args)
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+#----------------------------------------------------------------------#
+#   Line parsing
+#----------------------------------------------------------------------#
+
+class LineBuffer(object):
+    '''Collects socket data and hands back complete, decoded lines.'''
+
+    # longest line kept before it is thrown away, RFC 1459 allows 512
+    MAX_LINE = 8192
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        if len(self._buffer) > self.MAX_LINE:
+            self._buffer = ''
+        return [decode(line.rstrip('\r')) for line in lines if line.strip()]
+
+
+def decode(line):
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        return line.decode('latin-1')
+
+
+def parse_line(line):
+    '''Split a raw IRC line into (prefix, command, args).'''
+    prefix = ''
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+    line, sep, trailing = line.partition(' :')
+    args = line.split()
+    if sep:
+        args.append(trailing)
+    command = args.pop(0).upper() if args else ''
+    return prefix, command, args
+
+
+# the handler methods commands can reach: oyoyo's event table, and the
+# commands it leaves out
+EVENTS = frozenset(all_events) | frozenset(['notice', 'nick', 'topic', 'kill', 'wallops'])
+
+
+def event_name(command):
+    '''The oyoyo handler name for a command, e.g. 001 -> welcome.'''
+    return numeric_events.get(command, command).lower()
+
+#----------------------------------------------------------------------#
+#   Connection
+#----------------------------------------------------------------------#
+
+class IRCConnection(object):
+
+    CONNECT_TIMEOUT = 30
+    # send a PING after this many quiet seconds, reconnect if the server
+    # stays quiet for PING_TIMEOUT more
+    PING_INTERVAL = 120
+    PING_TIMEOUT = 60
+    # reconnect delays double from RECONNECT_MIN up to RECONNECT_MAX
+    RECONNECT_MIN = 1
+    RECONNECT_MAX = 300
+
+    def __init__(self, loop, handler_class, host, port=6667, nick='i3ircterm',
+                 connect_cb=None):
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.nick = nick
+        self.connect_cb = connect_cb
+        self.command_handler = handler_class(self)
+
+        self.socket = None
+        self.connected = False
+        self._lines = None
+        self._outbuf = ''
+        self._attempts = 0
+        self._last_rx = 0.0
+        self.received = None
+        self._pinged = False
+        self._timer = None
+        self._closing = False
+
+    #   connection lifecycle
+
+    def connect(self):
+        logger = logging.getLogger('IRCTerm.IRCConnection.connect')
+        logger.info('Connecting to %s:%s', self.host, self.port)
+        self._closing = False
+        self._lines = LineBuffer()
+        self._outbuf = ''
+        try:
+            # name lookup still blocks, everything after it does not
+            family, socktype, proto, _, address = socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_STREAM)[0]
+            self.socket = socket.socket(family, socktype, proto)
+            self.socket.setblocking(0)
+            err = self.socket.connect_ex(address)
+        except (socket.error, IOError), e:
+            logger.warn('Connection to %s failed: %s', self.host, e)
+            self._reconnect()
+            return
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            logger.warn('Connection to %s failed: %s', self.host, os.strerror(err))
+            self._reconnect()
+            return
+        self.loop.add_writer(self.socket, self._on_connect)
+        self._schedule(self.CONNECT_TIMEOUT, self._connect_timeout)
+
+    def _connect_timeout(self):
+        logger = logging.getLogger('IRCTerm.IRCConnection.connect')
+        logger.warn('Timed out connecting to %s', self.host)
+        self._reconnect()
+
+    def _on_connect(self):
+        logger = logging.getLogger('IRCTerm.IRCConnection.connect')
+        self.loop.remove_writer(self.socket)
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logger.warn('Connection to %s failed: %s', self.host, os.strerror(err))
+            self._reconnect()
+            return
+        logger.info('Connected to %s:%s', self.host, self.port)
+        self.connected = True
+        self._last_rx = monotonic()
+        self._pinged = False
+        self.loop.add_reader(self.socket, self._on_readable)
+        self._schedule(self.PING_INTERVAL, self._keepalive)
+        self.send('NICK', self.nick)
+        if self.connect_cb is not None:
+            self.connect_cb(self)
+
+    def _teardown(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.socket is not None:
+            self.loop.remove_reader(self.socket)
+            self.loop.remove_writer(self.socket)
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+        self.connected = False
+
+    def _reconnect(self):
+        logger = logging.getLogger('IRCTerm.IRCConnection.reconnect')
+        self._teardown()
+        if self._closing:
+            return
+        delay = min(self.RECONNECT_MAX, self.RECONNECT_MIN * 2 ** self._attempts)
+        delay *= random.uniform(0.5, 1.0)
+        self._attempts += 1
+        logger.info('Reconnecting to %s in %.1fs', self.host, delay)
+        self._timer = self.loop.call_later(delay, self.connect)
+
+    def _schedule(self, delay, callback):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(delay, callback)
+
+    def _keepalive(self):
+        logger = logging.getLogger('IRCTerm.IRCConnection.keepalive')
+        quiet = monotonic() - self._last_rx
+        if quiet >= self.PING_INTERVAL + self.PING_TIMEOUT:
+            logger.warn('No reply from %s for %ds, reconnecting', self.host, quiet)
+            self._reconnect()
+            return
+        if quiet >= self.PING_INTERVAL and not self._pinged:
+            self.send('PING', self.host)
+            self._pinged = True
+        self._schedule(min(self.PING_INTERVAL, self.PING_TIMEOUT) / 4.0, self._keepalive)
+
+    def close(self, msg=None):
+        '''Quit and stay disconnected.'''
+        if self.connected:
+            if msg:
+                self.send('QUIT', ':%s' % msg)
+            else:
+                self.send('QUIT')
+            self._flush()
+        self._closing = True
+        self._teardown()
+
+    #   socket I/O
+
+    def send(self, *args):
+        '''Queue a command, same arguments as oyoyo's IRCClient.send.'''
+        logger = logging.getLogger('IRCTerm.IRCConnection.send')
+        line = u' '.join([a if isinstance(a, unicode) else a.decode('utf-8')
+                          for a in args])
+        logger.debug('>> %s', line)
+        self._outbuf += line.encode('utf-8') + '\r\n'
+        if self.connected:
+            self.loop.add_writer(self.socket, self._flush)
+
+    def _flush(self):
+        try:
+            sent = self.socket.send(self._outbuf)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._lost(e)
+            return
+        self._outbuf = self._outbuf[sent:]
+        if not self._outbuf:
+            self.loop.remove_writer(self.socket)
+
+    def _lost(self, reason):
+        logger = logging.getLogger('IRCTerm.IRCConnection')
+        logger.warn('Lost connection to %s: %s', self.host, reason)
+        self._reconnect()
+
+    def _on_readable(self):
+        try:
+            data = self.socket.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._lost(e)
+            return
+        if not data:
+            self._lost('connection closed')
+            return
+        # the events of these lines get this as their time
+        self.received = time.time()
+        self._last_rx = monotonic()
+        self._pinged = False
+        for line in self._lines.feed(data):
+            self._dispatch(line)
+            if self.socket is None:
+                return
+
+    #   event dispatch
+
+    def _dispatch(self, line):
+        prefix, command, args = parse_line(line)
+        if command == 'PING':
+            self.send('PONG', *[':' + a for a in args[-1:]])
+            return
+        if command == 'PONG':
+            return
+        name = event_name(command)
+        if name == 'welcome':
+            self._attempts = 0
+        elif name == 'nicknameinuse':
+            self.nick += '_'
+            self.send('NICK', self.nick)
+        elif name == 'nick' and prefix.split('!')[0] == self.nick and args:
+            self.nick = args[0]
+        handler = None
+        if name in EVENTS:
+            handler = getattr(self.command_handler, name, None)
+        try:
+            if callable(handler):
+                handler(prefix, *args)
+            else:
+                self.command_handler.__unhandled__(name, prefix, *args)
+        except Exception:
+            logger = logging.getLogger('IRCTerm.IRCConnection.dispatch')
+            logger.exception('Handler for %s failed: %r', name, line)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import re
+
+#==============================================================================#
+#   IRC text formatting as style runs
+#==============================================================================#
+#
+#   parse() turns a message with mIRC control codes (^B bold, ^_ underline,
+#   ^V reverse, ^O reset, ^C colours) and *bold* / _underline_ markup into a
+#   list of (style, text) runs, neighbouring runs of the same style merged.
+#   Styles are a bitmask of BOLD, UNDERLINE and INVERSE, what the thermal
+#   printer can do; colours, italics and the rest are dropped. Everything is
+#   found in a single pass of one regular expression over the message.
+#
+#   Markup only counts around whole words: the opening * or _ after a space
+#   (or at the start) followed by a non-space, the closing one after a
+#   non-space and before a space, punctuation or the end. So file_name_here
+#   and 2*3*4 stay as they are.
+#
+#   wrap() lays runs out into lines with a layout.Layout, so a style carries
+#   on over line breaks, and transitions() gives the minimal style changes
+#   to get from one run to the next.
+
+BOLD = 1
+UNDERLINE = 2
+INVERSE = 4
+
+# mIRC toggles, ^O resets everything
+TOGGLES = {u'\x02': BOLD, u'\x1f': UNDERLINE, u'\x16': INVERSE,
+           u'\x1d': 0, u'\x11': 0, u'\x1e': 0}
+RESET = u'\x0f'
+
+MARKUP = {u'*': BOLD, u'_': UNDERLINE}
+
+TOKENS = re.compile(
+    u'(\x03(?:\\d{1,2}(?:,\\d{1,2})?)?)'                     # colour, dropped
+    u'|([\x02\x0f\x11\x16\x1d\x1e\x1f])'                     # toggles
+    u'|(?<![^\\s(\\[])([*_])(?=[^\\s*_])'                    # markup around
+    u'((?:(?!\\3).)*?[^\\s*_])\\3(?![^\\s.,!?;:)\\]\'"])',   # words
+    re.UNICODE)
+
+
+def _add(runs, style, text):
+    if text:
+        if runs and runs[-1][0] == style:
+            runs[-1] = (style, runs[-1][1] + text)
+        else:
+            runs.append((style, text))
+
+
+def parse(text, style=0):
+    '''[(style, text), ...] for a message with formatting codes and markup.'''
+    runs = []
+    pos = 0
+    for m in TOKENS.finditer(text):
+        _add(runs, style, text[pos:m.start()])
+        pos = m.end()
+        code = m.group(2)
+        if code is not None:
+            if code == RESET:
+                style = 0
+            else:
+                style ^= TOGGLES[code]
+        elif m.group(3) is not None:
+            for inner in parse(m.group(4), style | MARKUP[m.group(3)]):
+                _add(runs, *inner)
+    _add(runs, style, text[pos:])
+    return runs
+
+
+def plain(runs):
+    return runs[0][1][:0].join([text for style, text in runs]) if runs else u''
+
+
+def strip(text):
+    '''text without any formatting.'''
+    return plain(parse(text))
+
+
+def wrap(runs, layout):
+    '''Lines of runs for the runs laid out by layout (a layout.Layout), the
+    hanging indent as an unstyled run.'''
+    text = plain(runs)
+    lines = []
+    i = 0
+    offset = 0              # where runs[i] starts in text
+    for start, end in layout.spans(text):
+        line = []
+        if lines:
+            line.append((0, text[:0] + ' ' * layout.indent))
+        while i < len(runs) and offset + len(runs[i][1]) <= start:
+            offset += len(runs[i][1])
+            i += 1
+        j, at = i, offset
+        while j < len(runs) and at < end:
+            style, chunk = runs[j]
+            piece = chunk[max(0, start - at):end - at]
+            if piece:
+                _add(line, style, piece)
+            at += len(chunk)
+            j += 1
+        lines.append(line)
+    return lines
+
+
+def transitions(old, new):
+    '''[(style bit, on), ...] to go from style old to new.'''
+    return [(bit, bool(new & bit)) for bit in (BOLD, UNDERLINE, INVERSE) if (old ^ new) & bit]
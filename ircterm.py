@@ -3,38 +3,49 @@
 
 # printer imports
 from printer import ThermalPrinter as tp
+import cp437
 from datetime import datetime,timedelta,time
 import logging
-from logging import StreamHandler
-from logging.handlers import TimedRotatingFileHandler
-from textwrap import TextWrapper
+from logsetup import Loggers
+import logsetup
+from layout import Layout
+import ircformat
 import signal
+import threading
 
 # irc imports
-from oyoyo.client import IRCClient
-import oyoyo.parse
+from ircclient import IRCConnection, Loop
 from oyoyo import helpers
 from oyoyo.cmdhandler import DefaultCommandHandler
-from termcolor import colored,cprint
 
+# output imports
+from printqueue import COALESCE
+from digest import Digest
+import noritake
+from vfdtail import VFDTail
+import sinks
+import glyphs
+import scrollstore
+import router
+import events
+from rules import Rules,NORMAL,HIGHLIGHT,SUPPRESS
 
-# setting up logging
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-fileHandler = TimedRotatingFileHandler('irc.log',when='midnight',backupCount=7)
-fileHandler.setLevel(logging.INFO)
-fileHandler.setFormatter(formatter)
-consoleHandler = StreamHandler()
-consoleHandler.setLevel(logging.DEBUG)
-consoleHandler.setFormatter(formatter)
+# input imports
+import serial
+import keyboard
+
+
+# logging is set up by logsetup.setup() in __main__, levels come from
+# IRCTERM_LOG, e.g. 'INFO,IRCTerm.IRCHandler=DEBUG', and IRCTERM_LOG_FORMAT=json
+# writes irc.log as JSON lines
 logger = logging.getLogger('IRCTerm')
-logger.addHandler(fileHandler)
-logger.addHandler(consoleHandler)
-logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.NullHandler())
 
 class IRCMain(object):
     def __init__(self,server='irc.freenode.net',port=6667,channel='#i3detroit',
                  nick='i3ircterm',realname='IRC Terminal at i3Detroit',
-                 user='i3ircterm',password=None,printer=None):
+                 user='i3ircterm',password=None,printer=None,loop=None,store=None,
+                 routes=None):
         logger = logging.getLogger('IRCTerm.IRCMain')
         # setting up connection parameters
         self.server = server
@@ -45,23 +56,32 @@ class IRCMain(object):
         self.user = user
         self.password = password
         self.printer = printer
+        # a scrollstore.ScrollStore keeping what is printed
+        self.store = store
+        # lowercased channel -> router.Route, the rest goes to printer
+        self.routes = routes or {}
         self.cli = None
+        # the printer, VFD and keyboard can run in the same loop
+        self.loop = loop if loop is not None else Loop()
         
         if self.printer is None:
             logger.warn('No printer in use, using console instead')
+            self.printer = sinks.Dispatcher({'console':sinks.ConsoleSink()}).outputs['console']
         
     def connect(self):
         logger = logging.getLogger('IRCTerm.IRCMain.connect')
         if self.cli is None:
             logger.debug('Connecting to %s:%s as %s'%\
                          (self.server,self.port,self.nick))
-            self.cli = IRCClient(IRCHandler, host=self.server, port=self.port,
-                                   nick=self.nick, connect_cb=self.connect_callback)
+            self.cli = IRCConnection(self.loop, IRCHandler, host=self.server, port=self.port,
+                                     nick=self.nick, connect_cb=self.connect_callback)
             self.cli.command_handler.printer = self.printer
-            self.conn = self.cli.connect()
+            self.cli.command_handler.store = self.store
+            self.cli.command_handler.routes = self.routes
+            self.cli.connect()
         else:
             logger.warn('Already connected...')
-        return self.conn
+        return self.cli
 
     def connect_callback(self,cli):
         logger = logging.getLogger('IRCTerm.IRCMain.connect_callback')
@@ -74,187 +94,252 @@ class IRCMain(object):
             helpers.identify(self.cli,self.password)
         else:
             logger.debug('No identify required')
-        logger.info('Joining %s'%self.channel)
-        helpers.join(self.cli,self.channel)
+        # a list of channels is joined at once, JOIN takes them comma separated
+        channel = self.channel
+        if not isinstance(channel,basestring):
+            channel = ','.join(channel)
+        logger.info('Joining %s'%channel)
+        helpers.join(self.cli,channel)
 
 class IRCHandler(DefaultCommandHandler):
-    def print_line(self,text,timestamp=True,highlight=False):
-        if self.printer is None:
-            if timestamp:
-                if highlight:
-                    cprint('%s %s'%(datetime.now(),text),'red')
-                else:
-                    cprint('%s %s'%(datetime.now(),text),'green')
-            else:
-                if highlight:
-                    cprint(text,'red')
-                else:
-                    cprint(text,'green')
+    # these run for every message, keep the loggers around
+    log = Loggers('IRCTerm.IRCHandler')
+    store = None
+    routes = {}
+    # for printers without a router.Route, just our nick as a whole word
+    rules = Rules()
+
+    def route(self,chan):
+        '''Where the lines for chan go, the printer unless chan has a route.'''
+        if chan:
+            return self.routes.get(chan.lower(),self.printer)
+        return self.printer
+
+    def classify(self,printer,msg,nick):
+        '''What the rules of printer say to do with msg from nick.'''
+        return getattr(printer,'rules',self.rules).classify(msg,nick,self.client.nick)
+
+    def print_line(self,text,timestamp=True,highlight=False,chan=None,event=None):
+        self.output(self.route(chan),text,timestamp,highlight,event=event)
+
+    def output(self,printer,text,timestamp=True,highlight=False,action=None,event=None):
+        '''Print a line on printer, or where action says on a router.Route.
+        event is the events.Privmsg etc. the line is for, it goes along to
+        the outputs.'''
+        if isinstance(printer,router.Route):
+            printer.print_line(text,timestamp,highlight,action,event)
         else:
-            self.printer.print_line(text,timestamp,highlight)
-
-    def privmsg(self, nick, chan, msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.privmsg')
-        logger.debug('PRIVMSG from %s in %s: %s'%(nick,chan,msg))
-        nick,host = nick.split('!')
-        highlight = (self.client.nick in msg or self.client.nick in chan)
-        if self.client.nick in chan:
-            chan = 'P'
+            printer.print_line(text,timestamp,highlight,event)
+
+    def print_event(self,kind,event,chan,reason=None):
+        '''Print a join/part/quit/mode event, letting a Digest batch them up.'''
+        printer = self.route(chan)
+        text = event.line()
+        membership = getattr(printer,'membership',None)
+        if membership is not None:
+            membership(kind,event,chan,text,reason)
         else:
-            chan = ''
-        self.print_line('%s<%s> %s'%(chan,nick,msg),True,highlight)
+            self.output(printer,text,event.timestamp(),event=event)
+        self.record(chan,event.nick,text,scrollstore.EVENT,event.time)
+
+    def record(self,chan,nick,text,flags=0,when=None):
+        '''Keep a line in the scrollback store, when there is one.'''
+        if self.store is not None:
+            self.store.append(chan,nick,text,flags,when)
+
+    def privmsg(self,prefix,chan,msg):
+        self.log.privmsg.debug('PRIVMSG from %s in %s: %s',prefix,chan,msg)
+        event = events.Privmsg(events.received(self.client),events.prefix(prefix),chan,msg)
+        private = chan.lower() == self.client.nick.lower()
+        printer = self.route(chan)
+        action = self.classify(printer,msg,event.nick)
+        if private and action == NORMAL:
+            action = HIGHLIGHT
+        highlight = action == HIGHLIGHT
+        if action != SUPPRESS:
+            self.output(printer,event.line(private),event.timestamp(),highlight,action,event)
+        self.record(chan,event.nick,msg,(scrollstore.HIGHLIGHT if highlight else 0)|
+                                        (scrollstore.PRIVATE if private else 0),event.time)
     
-    def notice(self,server,target,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.notice')
-        logger.debug('NOTICE from %s to %s: %s'%(server,target,msg))
-        highlight = (self.client.nick in target or '*' in target)
-        self.print_line('%s: %s'%(server,msg),True,highlight)
+    def notice(self,prefix,target,msg):
+        self.log.notice.debug('NOTICE from %s to %s: %s',prefix,target,msg)
+        event = events.Notice(events.received(self.client),events.prefix(prefix),target,msg)
+        printer = self.route(target)
+        action = self.classify(printer,msg,event.nick)
+        if action == NORMAL and (target.lower() == self.client.nick.lower() or '*' in target):
+            action = HIGHLIGHT
+        highlight = action == HIGHLIGHT
+        if action != SUPPRESS:
+            self.output(printer,event.line(),event.timestamp(),highlight,action,event)
+        self.record(target,event.nick,msg,
+                    scrollstore.NOTICE|(scrollstore.HIGHLIGHT if highlight else 0),event.time)
         
     def welcome(self,server,target,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.welcome')
-        logger.debug('WELCOME from %s to %s: %s'%(server,target,msg))
+        self.log.welcome.debug('WELCOME from %s to %s: %s',server,target,msg)
         highlight = (self.client.nick in target or '*' in target)
         #self.print_line('%s: %s'%(server,msg),True,highlight)
         
     def motdstart(self,server,target,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.motdstart')
-        logger.debug('MOTD from %s to %s: %s'%(server,target,msg))
+        self.log.motdstart.debug('MOTD from %s to %s: %s',server,target,msg)
         #self.print_line('%s: %s'%(server,msg))
         
     def motd(self,server,target,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.motd')
-        logger.debug('MOTD from %s to %s: %s'%(server,target,msg))
+        self.log.motd.debug('MOTD from %s to %s: %s',server,target,msg)
         #self.print_line('%s: %s'%(server,msg))
     
     def endofmotd(self,server,target,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.endofmotd')
-        logger.debug('MOTD from %s to %s: %s'%(server,target,msg))
+        self.log.endofmotd.debug('MOTD from %s to %s: %s',server,target,msg)
         #self.print_line('%s: %s'%(server,msg))
         
     def mode(self,*args):
-        logger = logging.getLogger('IRCTerm.IRCHandler.mode')
         if len(args) == 4:
-            mod,chan,mode,target = args
+            prefix,chan,mode,target = args
         elif len(args) == 3:
-            mod,target,mode = args
-            chan = 'none'
+            prefix,target,mode = args
+            chan = None
         else:
-            logger.warn('No idea what this is: %s'%(repr(args)))
+            self.log.mode.warn('No idea what this is: %r',args)
             return
-        logger.debug('MODE by %s to %s in %s: %s'%(mod,target,chan,mode))
-        mod = mod.split('!')[0]
-        self.print_line('-!- mode/%s (%s %s) by %s'%(chan,mode,target,mod))
+        self.log.mode.debug('MODE by %s to %s in %s: %s',prefix,target,chan or 'none',mode)
+        event = events.Mode(events.received(self.client),events.prefix(prefix),chan,mode,target)
+        self.print_event('mode',event,chan)
         
     def currenttopic(self,server,target,chan,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.currenttopic')
-        logger.debug('CURRENTTOPIC on %s of %s to %s: %s'%(server,chan,target,msg))
-        self.print_line('-!- Topic for %s: %s'%(chan,msg))
+        self.log.currenttopic.debug('CURRENTTOPIC on %s of %s to %s: %s',server,chan,target,msg)
+        event = events.Topic(events.received(self.client),events.prefix(server),chan,msg)
+        self.print_line(event.line(),event.timestamp(),chan=chan,event=event)
+        self.record(chan,None,event.line(),scrollstore.EVENT,event.time)
         
     def topicinfo(self,server,target,chan,user,date):
-        logger = logging.getLogger('IRCTerm.IRCHandler.topicinfo')
-        logger.debug('TOPIC on %s of %s to %s: set by %s on %s'%(server,chan,target,user,date))
+        self.log.topicinfo.debug('TOPIC on %s of %s to %s: set by %s on %s',server,chan,target,user,date)
         date = datetime.fromtimestamp(int(date))
-        user,host = user.split('!')
-        self.print_line('-!- Topic set by %s <%s> (%s)'%(user,host,date))
+        # some servers only give the nick
+        user = events.prefix(user)
+        self.print_line('-!- Topic set by %s (%s)'%(user.who,date),
+                        datetime.fromtimestamp(events.received(self.client)),chan=chan)
         
-    def join(self,user,chan):
-        logger = logging.getLogger('IRCTerm.IRCHandler.join')
-        logger.debug('JOIN of %s to %s'%(user,chan))
-        user,host = user.split('!')
-        self.print_line('-!- %s <%s> has joined %s'%(user,host,chan))
+    def join(self,prefix,chan):
+        self.log.join.debug('JOIN of %s to %s',prefix,chan)
+        event = events.Join(events.received(self.client),events.prefix(prefix),chan)
+        self.print_event('join',event,chan)
         
-    def part(self,user,chan,msg):
-        logger = logging.getLogger('IRCTerm.IRCHandler.part')
-        logger.debug('PART of %s from %s: %s'%(user,chan,msg))
-        user,host = user.split('!')
-        self.print_line('-!- %s <%s> has left %s: %s'%(user,host,chan,msg))
+    def part(self,prefix,chan,msg=''):
+        self.log.part.debug('PART of %s from %s: %s',prefix,chan,msg)
+        event = events.Part(events.received(self.client),events.prefix(prefix),chan,msg)
+        self.print_event('part',event,chan)
         
-    def quit(self,user,chan):
-        logger = logging.getLogger('IRCTerm.IRCHandler.quit')
-        logger.debug('QUIT of %s from %s'%(user,chan))
-        user,host = user.split('!')
-        self.print_line('-!- %s <%s> has left %s'%(user,host,chan))
+    def quit(self,prefix,msg=''):
+        self.log.quit.debug('QUIT of %s from %s',prefix,msg)
+        event = events.Quit(events.received(self.client),events.prefix(prefix),msg)
+        # no channel in a QUIT, the network's route takes it
+        self.print_event('quit',event,None,msg)
         
     def namreply(self,server,target,null,chan,names):
-        logger = logging.getLogger('IRCTerm.IRCHandler.names')
-        logger.debug('NAMES in %s: %s'%(chan,names))
-        names = ' '.join(sorted(names.split(' ')))
-        self.print_line('-!- %s users in %s'%(len(names),chan))
-        self.print_line('%s'%names)
+        self.log.names.debug('NAMES in %s: %s',chan,names)
+        event = events.Names(events.received(self.client),events.prefix(server),chan,
+                             tuple(sorted(names.split())))
+        self.print_line(event.line(),event.timestamp(),chan=chan,event=event)
+        self.print_line(' '.join(event.names),event.timestamp(),chan=chan,event=event)
 
     def __unhandled__(self,*args):
-        logger = logging.getLogger('IRCTerm.IRCHandler.__unhandled__')
-        logger.info('UNHANDLED: %s'%(repr(args)))
+        self.log.__unhandled__.info('UNHANDLED: %r',args)
         
 
 class IRCScrollback(object):
-    def __init__(self,port=None):
+    log = Loggers('IRCTerm.IRCScrollback')
+    # as a sinks.Dispatcher sink: when its queue is full, repeats and overflow are merged into one job
+    QUEUE = 64
+    POLICY = COALESCE
+    # a merged job is at most eight lines of paper
+    MERGE_LIMIT = 42 * 8
+
+    def __init__(self,port=None,glyph_font=glyphs.FONT):
+        logger = logging.getLogger('IRCTerm.IRCScrollback')
         if port is not None:
             self.printer = tp(serialport=port)
         else:
             self.printer = tp(serialport=tp.SERIALPORT)
         self.printer.font_b_on()
 
-        # setting up text wrapper
-        self.wrapper = TextWrapper(initial_indent='',subsequent_indent=' '*9,
-                                   width=42,drop_whitespace=True)
+        # print_line can be called from a PrintQueue writer thread and from
+        # the day-change alarm at the same time
+        self.lock = threading.RLock()
+
+        # setting up text wrapper, continuation lines line up after the timestamp
+        self.wrapper = Layout(width=42,indent=9)
+
+        # emoji, CJK and such get printed as bitmaps when we have a font
+        try:
+            self.glyphs = glyphs.GlyphRenderer(glyph_font)
+        except (ImportError,IOError) as e:
+            logger.warn('Not rendering glyphs outside CP437: %s'%e)
+            self.glyphs = None
 
         # setting up the 'day-changed' printout
         signal.signal(signal.SIGALRM,self.day_change)
         self.day_change(None,None)
 
-    def split_format(self,text,fmt):
-        splits = []
-        while True:
-            
-            # find the starting token
-            start = text.find(' '+fmt)
-            if start < 0:
-                # there was no start, no format needed
-                return splits + [text]
-
-            # find the ending token
-            end = text.find(fmt+' ',start+2)
-            if end < 0:
-                # there was no ending, no format needed
-                return splits
-            # there *was* an end, trim the text and add the section to the list
-            splits.append(text[start+2:end])
-            text = text[end+2:]
-
-    def print_line(self,text,timestamp=True,highlight=False):
-        logger = logging.getLogger('IRCTerm.IRCScrollback.print_line')
-        logger.debug('text: |%s|\nts: %s hl: %s'%(text,timestamp,highlight))
-
-        text = text.encode('cp437',errors='replace')
-        
+    def print_line(self,text,timestamp=True,highlight=False,event=None):
+        '''Print a line, timestamp is either a flag or the datetime to print.'''
+        self.log.print_line.debug('text: |%s|\nts: %s hl: %s',text,timestamp,highlight)
+
+        if isinstance(text,str):
+            text = text.decode('utf-8','replace')
+
         # print a timestamp on the line
+        if timestamp is True:
+            timestamp = datetime.now()
         if timestamp:
-            text = datetime.now().strftime('%H:%M:%S') + ' ' + text
+            text = timestamp.strftime('%H:%M:%S') + ' ' + text
 
-        # highlight a row of text
-        if highlight:
-            self.printer.inverse_on()
-        else:
-            self.printer.inverse_off()
-        
-        '''
-        # handle *bold* and _underlined_ text
-        bold_sections = self.split_format(text,'*')
-        under_sections = self.split_format(text,'_')
+        # mIRC codes and *bold*/_underline_ markup to style runs
+        runs = ircformat.parse(text)
 
-        for bold in bold_sections:
-            text = text.replace(' *%s* '%bold,'>|<B>|<')
-        
-        for under in under_sections:
-            text = text.replace(' _%s_ '%under,'>|<U>|<')
-        '''
+        if self.glyphs is not None and glyphs.needs_glyphs(ircformat.plain(runs)):
+            self.print_glyphs(ircformat.plain(runs),highlight)
+            return
 
-        # print the line
-        self.printer.print_text(self.wrapper.fill(text) + '\n')
-        
-        if highlight:
-            self.printer.inverse_off()
+        runs = [(style,cp437.encode(chunk)) for style,chunk in runs]
+
+        # the whole message goes out to the printer in a single write,
+        # a highlight inverts the whole message
+        with self.lock, self.printer.transaction():
+            self.print_runs(ircformat.wrap(runs,self.wrapper),
+                            ircformat.INVERSE if highlight else 0)
+
+    # printer methods for each style bit, (off, on)
+    STYLES = {ircformat.BOLD: ('bold_off','bold_on'),
+              ircformat.UNDERLINE: ('underline_off','underline_on'),
+              ircformat.INVERSE: ('inverse_off','inverse_on')}
+
+    def print_runs(self,lines,base=0):
+        '''Print lines of (style, bytes) runs, the styles xor base. Only
+        style changes go to the printer, and it is left with all off.'''
+        current = 0
+        for line in lines or [[]]:
+            for style,chunk in line:
+                style ^= base
+                for bit,on in ircformat.transitions(current,style):
+                    getattr(self.printer,self.STYLES[bit][on])()
+                current = style
+                self.printer.print_text(chunk)
+            self.printer.print_text('\n')
+        for bit,on in ircformat.transitions(current,0):
+            getattr(self.printer,self.STYLES[bit][on])()
+
+    def print_glyphs(self,text,highlight=False):
+        '''Print a line with characters outside CP437, wrapped lines that
+        need them go out as bitmaps and the rest as text.'''
+        with self.lock, self.printer.transaction():
+            if highlight:
+                self.printer.inverse_on()
+            for line in self.wrapper.wrap(text):
+                if glyphs.needs_glyphs(line):
+                    self.printer.print_raster(self.glyphs.render(line,inverse=highlight))
+                else:
+                    self.printer.print_text(cp437.encode(line) + '\n')
+            if highlight:
+                self.printer.inverse_off()
 
     def next_day(self):
         '''Calculate the number of seconds to the next day.'''
@@ -271,11 +356,104 @@ class IRCScrollback(object):
         signal.alarm(self.next_day())
 
 class IRCInput(object):
-    def __init__(self):
-        self.port = serial.Serial('/dev/ttyO2',38400)
+    '''The serial keyboard: what is typed is echoed on the VFD and sent to
+    the channel when enter is hit. Runs in the IRC loop, reading the port
+    only when select() says there is something.
+
+    Besides plain lines there are /me <action>, /msg <target> <text> and
+    /query <target>, which sends the following lines to target.'''
+
+    # read() runs for every keystroke
+    log = Loggers('IRCTerm.IRCInput')
+    PORT = '/dev/ttyO2'
+    BAUDRATE = 38400
+    # CTCP ACTION, what /me sends
+    ACTION = u'\x01ACTION '
+
+    def __init__(self,irc,port=PORT,baudrate=BAUDRATE,tail=None,target=None):
+        '''irc is the IRCMain to send with, tail a VFDTail to echo on and
+        target where lines go, the first channel of irc by default.'''
+        self.irc = irc
+        if hasattr(port,'read'):
+            self.port = port
+        else:
+            self.port = serial.Serial(port,baudrate,timeout=0)
+        self.tail = tail
+        if target is None:
+            target = irc.channel if isinstance(irc.channel,basestring) else irc.channel[0]
+        self.target = target
+        self.editor = keyboard.LineEditor()
+        self.throttle = keyboard.Throttle(irc.loop,self.send)
+        irc.loop.add_reader(self.port,self.read)
+
+    def read(self):
+        try:
+            data = self.port.read(4096)
+        except (serial.SerialException,OSError,IOError) as e:
+            self.log.read.error('Keyboard gone, not reading it anymore: %s',e)
+            self.irc.loop.remove_reader(self.port)
+            return
+        if not data:
+            return
+        text,cursor = self.editor.text,self.editor.cursor
+        for line in self.editor.feed(data):
+            self.submit(line)
+        if self.tail is not None and (self.editor.text,self.editor.cursor) != (text,cursor):
+            self.tail.edit(self.editor.text if self.editor.text else None,self.editor.cursor)
+
+    def submit(self,line):
+        '''Handle a line that was typed.'''
+        if self.tail is not None:
+            self.tail.edit(None)
+        target,text = self.target,line
+        action = False
+        if line.startswith('/'):
+            command,_,rest = line[1:].partition(' ')
+            command = command.lower()
+            if command == 'me':
+                text,action = rest,True
+            elif command == 'msg' and ' ' in rest.strip():
+                target,_,text = rest.strip().partition(' ')
+            elif command == 'query' and rest.strip():
+                self.target = rest.strip()
+                self.notify('-!- Now talking to %s'%self.target)
+                return
+            else:
+                self.notify('-!- Unknown command: %s'%line)
+                return
+        if action:
+            # every chunk is an action of its own
+            limit = keyboard.MESSAGE_BYTES - len(self.ACTION) - 1
+            for chunk in keyboard.split_message(text,limit):
+                self.throttle.put(target,u'%s%s\x01'%(self.ACTION,chunk.decode('utf-8')))
+        else:
+            for chunk in keyboard.split_message(text):
+                self.throttle.put(target,chunk.decode('utf-8'))
+
+    def notify(self,text):
+        if self.tail is not None:
+            self.tail.print_line(text)
+
+    def send(self,target,text):
+        '''Send a PRIVMSG and print it like the others, False if not connected.'''
+        cli = self.irc.cli
+        if cli is None or not cli.connected:
+            return False
+        cli.send('PRIVMSG',target,':'+text)
+        # the server doesn't send our own messages back
+        handler = cli.command_handler
+        if text.startswith(self.ACTION):
+            line = '* %s %s'%(cli.nick,text[len(self.ACTION):].rstrip('\x01'))
+        else:
+            line = '<%s> %s'%(cli.nick,text)
+        handler.print_line(line,True,False,target)
+        handler.record(target,cli.nick,text)
+        return True
 
 if __name__ == '__main__':
     import sys, os
+    logsetup.setup(os.environ.get('IRCTERM_LOG','INFO'),
+                   json_file=os.environ.get('IRCTERM_LOG_FORMAT') == 'json')
     logger = logging.getLogger('IRCTerm.main')
     
     p = 'pants'
@@ -284,7 +462,44 @@ if __name__ == '__main__':
     else:
         p = IRCScrollback()
 
-    irc = IRCMain(printer=p)
-    conn = irc.connect()
-    while True:
-        conn.next()
+    # keep the IRC socket going while the printer catches up, and batch up
+    # joins/quits and fall back to highlights only when it can't
+    loop = Loop()
+    capacity = None
+    if p.printer.pacer is not None:
+        capacity = p.printer.pacer.lines_per_second(tp.FONT_B_HEIGHT)
+    available = {'printer':p,'console':sinks.ConsoleSink(),'log':sinks.LogSink()}
+
+    # show the channels on the VFD as well, when running on the BeagleBone
+    if noritake.GPIO is not None:
+        available['vfd'] = VFDTail(noritake.Screen())
+    else:
+        logger.warn('No GPIO, not using the VFD')
+
+    # and on a page at http://localhost:IRCTERM_WEB/ when that is set
+    if os.environ.get('IRCTERM_WEB'):
+        available['web'] = sinks.WebSink(int(os.environ['IRCTERM_WEB']))
+
+    # every output gets a queue and writer thread of its own, so none of
+    # them waits on another
+    dispatcher = sinks.Dispatcher(available,loop)
+    outputs = dict(dispatcher.outputs)
+    outputs['printer'] = Digest(outputs['printer'],loop,capacity)
+
+    # keep everything in the scrollback store too, see scrollstore.py for
+    # reprinting from it
+    store = scrollstore.ScrollStore(os.environ.get('IRCTERM_STORE',scrollstore.PATH))
+
+    # the networks and channels to follow and where their lines go, see
+    # router.py, #i3detroit on freenode without a config
+    config = router.read_config(os.environ.get('IRCTERM_CONFIG',router.CONFIG))
+    irc = router.Router(config,outputs,loop,store,IRCMain)
+    irc.connect()
+
+    # typing into the first network, when the keyboard is there
+    port = os.environ.get('IRCTERM_KEYBOARD',IRCInput.PORT)
+    if os.path.exists(port):
+        IRCInput(irc.networks[0],port,tail=available.get('vfd'))
+    else:
+        logger.warn('No keyboard at %s'%port)
+    loop.run_forever()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import time
+from collections import deque
+
+from logsetup import Loggers
+
+#==============================================================================#
+#   Serial keyboard line editing and flood-safe sending
+#==============================================================================#
+#
+#   LineEditor takes the bytes from the keyboard as they come, escape
+#   sequences split over reads included, and keeps the line being typed
+#   and the cursor in it. It knows the usual keys: backspace, delete, the
+#   arrows, home/end, and the emacs ones (^A ^E ^B ^F ^D ^K ^U ^W, ^P ^N
+#   for the history).
+#
+#   Throttle sends lines no faster than servers put up with, following
+#   their message timer (RFC 1459, 8.10): every message moves the timer
+#   PENALTY seconds ahead of now, and once it is more than WINDOW seconds
+#   ahead the server holds the client's messages back, or disconnects it.
+#   So up to WINDOW / PENALTY lines go out at once, then one every PENALTY
+#   seconds, the rest waiting on a loop timer.
+
+ESC = '\x1b'
+
+# ^X keys and the escape sequences of a VT100ish keyboard
+CONTROL = {'\x01': 'home', '\x02': 'left', '\x04': 'delete', '\x05': 'end',
+           '\x06': 'right', '\x08': 'backspace', '\x0b': 'kill-end',
+           '\x0e': 'next', '\x10': 'previous', '\x15': 'kill-start',
+           '\x17': 'kill-word', '\x7f': 'backspace', '\r': 'enter', '\n': 'enter'}
+SEQUENCES = {'[A': 'previous', '[B': 'next', '[C': 'right', '[D': 'left',
+             '[H': 'home', '[F': 'end', 'OH': 'home', 'OF': 'end',
+             '[1~': 'home', '[4~': 'end', '[3~': 'delete'}
+
+# IRC lines are at most 512 bytes with the CR LF, and the server puts
+# ':nick!user@host PRIVMSG target :' in front when relaying them
+MESSAGE_BYTES = 400
+
+
+class LineEditor(object):
+
+    HISTORY = 50
+
+    def __init__(self):
+        self.text = u''
+        self.cursor = 0
+        self.history = deque(maxlen=self.HISTORY)
+        self._browsing = None       # position in history, None when editing
+        self._escape = None         # escape sequence read so far
+        self._last = None
+
+    def feed(self, data):
+        '''Handle the bytes from the keyboard, returns the lines finished.'''
+        lines = []
+        for char in data:
+            last, self._last = self._last, char
+            if self._escape is not None:
+                self._escape += char
+                if self._escape in SEQUENCES:
+                    self.key(SEQUENCES[self._escape])
+                    self._escape = None
+                elif not self._sequence():
+                    self._escape = None
+                continue
+            if char == ESC:
+                self._escape = ''
+            elif char in CONTROL:
+                if char == '\n' and last == '\r':
+                    continue
+                line = self.key(CONTROL[char])
+                if line is not None:
+                    lines.append(line)
+            elif ' ' <= char < '\x7f' or char >= '\xa0':
+                # anything beyond ASCII is taken to be Latin-1
+                self.insert(char.decode('latin-1'))
+        return lines
+
+    def _sequence(self):
+        return any(sequence.startswith(self._escape) for sequence in SEQUENCES)
+
+    def insert(self, text):
+        self.text = self.text[:self.cursor] + text + self.text[self.cursor:]
+        self.cursor += len(text)
+        self._browsing = None
+
+    def key(self, name):
+        '''Do what key name does, returns the line for enter.'''
+        text, cursor = self.text, self.cursor
+        if name == 'enter':
+            self.text, self.cursor, self._browsing = u'', 0, None
+            if text.strip():
+                self.history.append(text)
+                return text
+        elif name == 'backspace' and cursor:
+            self.text, self.cursor = text[:cursor - 1] + text[cursor:], cursor - 1
+        elif name == 'delete':
+            self.text = text[:cursor] + text[cursor + 1:]
+        elif name == 'left':
+            self.cursor = max(0, cursor - 1)
+        elif name == 'right':
+            self.cursor = min(len(text), cursor + 1)
+        elif name == 'home':
+            self.cursor = 0
+        elif name == 'end':
+            self.cursor = len(text)
+        elif name == 'kill-end':
+            self.text = text[:cursor]
+        elif name == 'kill-start':
+            self.text, self.cursor = text[cursor:], 0
+        elif name == 'kill-word':
+            start = text[:cursor].rstrip(u' ').rfind(u' ') + 1
+            self.text, self.cursor = text[:start] + text[cursor:], start
+        elif name in ('previous', 'next'):
+            self._recall(-1 if name == 'previous' else 1)
+        return None
+
+    def _recall(self, step):
+        if not self.history:
+            return
+        if self._browsing is None:
+            if step > 0:
+                return
+            position = len(self.history) - 1
+        else:
+            position = self._browsing + step
+        if position < 0:
+            return
+        if position >= len(self.history):
+            self.text, self._browsing = u'', None
+        else:
+            self.text, self._browsing = self.history[position], position
+        self.cursor = len(self.text)
+
+
+def split_message(text, limit=MESSAGE_BYTES):
+    '''text as UTF-8 chunks of at most limit bytes, split at spaces where
+    there are any.'''
+    data = text.encode('utf-8') if isinstance(text, unicode) else text
+    chunks = []
+    while len(data) > limit:
+        cut = data.rfind(' ', limit // 2, limit + 1)
+        if cut < 0:
+            cut = limit
+            # don't split a UTF-8 sequence
+            while cut > 0 and 0x80 <= ord(data[cut]) < 0xC0:
+                cut -= 1
+        chunks.append(data[:cut])
+        data = data[cut:].lstrip(' ')
+    if data or not chunks:
+        chunks.append(data)
+    return chunks
+
+
+class Throttle(object):
+    log = Loggers('IRCTerm.Throttle')
+
+    PENALTY = 2.0
+    WINDOW = 8.0
+    # lines waiting to be sent, typing more than this drops the oldest
+    QUEUE = 20
+    # when send() can't send yet, e.g. while reconnecting, retry after this
+    RETRY = 1.0
+
+    def __init__(self, loop, send, penalty=PENALTY, window=WINDOW, clock=time.time):
+        '''send(*args) sends a line, and returns False to have it kept
+        and retried later.'''
+        self.loop = loop
+        self.send = send
+        self.penalty = penalty
+        self.window = window
+        self.clock = clock
+        self.queue = deque()
+        self.timer = 0.0
+        self.sent = 0
+        self.dropped = 0
+        self._pending = None
+
+    def put(self, *args):
+        if len(self.queue) >= self.QUEUE:
+            self.log.put.warn('Too much typed ahead, dropping %r', self.queue[0])
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(args)
+        if self._pending is None:
+            self._pump()
+
+    def delay(self):
+        '''Seconds until the next line can go out.'''
+        return max(0.0, self.timer - self.clock() - self.window + self.penalty)
+
+    def _pump(self):
+        self._pending = None
+        while self.queue:
+            wait = self.delay()
+            if wait > 0:
+                self._pending = self.loop.call_later(wait, self._pump)
+                return
+            if self.send(*self.queue[0]) is False:
+                self._pending = self.loop.call_later(self.RETRY, self._pump)
+                return
+            self.queue.popleft()
+            self.sent += 1
+            self.timer = max(self.timer, self.clock()) + self.penalty
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#==============================================================================#
+#   Line layout for the fixed width printer font
+#==============================================================================#
+#
+#   Layout stands in for textwrap.TextWrapper in IRCScrollback. It works on
+#   text that is already encoded for the printer, where every byte is one
+#   column, so it only needs to find the last space that fits with rfind()
+#   instead of splitting the line into chunks with regular expressions.
+#
+#   Continuation lines get a hanging indent, lining them up after the
+#   timestamp. A word too long for any line (URLs, pastes) fills up the
+#   current line, or starts a fresh one if less than MIN_FILL columns are
+#   left, and is broken after a '/', '.', '-', '?', '&' or similar in the
+#   second half of the space it has when there is one, and at the last
+#   column otherwise.
+#
+#   Leading spaces of continuation lines and trailing spaces of every line
+#   are dropped, newlines count as spaces, like TextWrapper with its
+#   defaults. The same code works on unicode strings.
+
+WIDTH = 42
+INDENT = 9
+
+# a long word is preferably broken after one of these
+BREAK_AFTER = '/.-?&=_,;:)]>'
+# columns a long word needs to start on the current line
+MIN_FILL = 8
+
+
+class Layout(object):
+    def __init__(self, width=WIDTH, indent=INDENT):
+        if indent >= width:
+            raise ValueError('indent %d leaves no room in %d columns' % (indent, width))
+        self.width = width
+        self.indent = indent
+
+    def _break(self, text, start, end):
+        '''Where to break a word running from start past end.'''
+        lowest = start + (end - start) // 2
+        best = -1
+        for c in BREAK_AFTER:
+            i = text.rfind(c, lowest, end - 1)
+            if i > best:
+                best = i
+        return best + 1 if best >= 0 else end
+
+    def spans(self, text):
+        '''(start, end) of the text of every line, trailing spaces left out.'''
+        width = self.width
+        n = len(text)
+        space = text[:0] + ' '
+        if n <= width and '\n' not in text:
+            end = len(text.rstrip(space))
+            return [(0, end)] if end else []
+        if '\n' in text:
+            text = text.replace('\n', ' ')
+
+        longest = width - self.indent
+        spans = []
+        pos = 0
+        avail = width
+        while True:
+            if spans:
+                while pos < n and text[pos] == space:
+                    pos += 1
+                if pos >= n:
+                    break
+            if n - pos <= avail:
+                end = len(text.rstrip(space))
+                if end > pos:
+                    spans.append((pos, end))
+                break
+            end = pos + avail
+            cut = text.rfind(space, pos, end + 1)
+            if cut > pos and text[pos:cut].strip(space):
+                word = text.find(space, cut + 1)
+                if word < 0:
+                    word = n
+                if word - cut - 1 > longest and end - cut - 1 >= MIN_FILL:
+                    # the next word has to be broken anyway, start it here
+                    cut = self._break(text, cut + 1, end)
+                    line, next = (pos, cut), cut
+                else:
+                    line, next = (pos, cut), cut + 1
+            else:
+                # the first word doesn't fit, break it
+                start = pos
+                while start < end and text[start] == space:
+                    start += 1
+                cut = self._break(text, start, end)
+                line, next = (pos, cut), cut
+            stop = line[0] + len(text[line[0]:line[1]].rstrip(space))
+            if stop > line[0]:
+                spans.append((line[0], stop))
+                avail = width - self.indent
+            pos = next
+        return spans
+
+    def wrap(self, text):
+        '''The lines of text, without line ends.'''
+        if len(text) <= self.width and '\n' not in text:
+            line = text.rstrip(' ')
+            return [line] if line else []
+        if '\n' in text:
+            text = text.replace('\n', ' ')
+        pad = text[:0] + ' ' * self.indent
+        lines = [text[start:end] for start, end in self.spans(text)]
+        return lines[:1] + [pad + line for line in lines[1:]]
+
+    def fill(self, text):
+        '''text wrapped into lines joined by newlines, no newline at the end,
+        same as TextWrapper.fill.'''
+        return '\n'.join(self.wrap(text))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import atexit
+import json
+import logging
+import threading
+import Queue
+from datetime import datetime
+from logging import StreamHandler
+from logging.handlers import TimedRotatingFileHandler
+
+#==============================================================================#
+#   Logging off the message path
+#==============================================================================#
+#
+#   The handlers for the per-message paths keep their loggers around
+#   (Loggers) and pass their arguments to the logger instead of formatting
+#   them first, so a DEBUG line that is filtered out costs a level check.
+#
+#   setup() sends everything the IRCTerm loggers let through to a
+#   QueueHandler; a QueueListener thread does the formatting and the console
+#   and irc.log writes. A full queue drops records rather than block the
+#   caller. Python 2 has no logging.handlers.QueueHandler, these follow the
+#   Python 3 ones.
+#
+#   Levels are configured per category with a spec like
+#   'INFO,IRCTerm.IRCHandler=DEBUG,IRCTerm.VFDTail=WARNING', the first bare
+#   level being the one for IRCTerm as a whole.
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOGFILE = 'irc.log'
+QUEUE_SIZE = 10000
+
+
+class Loggers(object):
+    '''logging.getLogger(prefix + '.' + name) as attributes, looked up once.'''
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        if name == '_prefix':
+            raise AttributeError(name)
+        logger = logging.getLogger('%s.%s' % (self._prefix, name))
+        setattr(self, name, logger)
+        return logger
+
+
+class QueueHandler(logging.Handler):
+    '''Puts records on a queue for a QueueListener. The message is merged
+    with its arguments here, so what gets logged is what they were at the
+    time of the call, and a traceback is formatted into exc_text, where the
+    formatters on the other side find it.'''
+
+    _formatter = logging.Formatter()
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    '''Hands the records from a queue to handlers in its own thread.'''
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='QueueListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                return
+            self.handle(record)
+
+    def stop(self):
+        '''Log what is still queued and stop the thread.'''
+        if self._thread is not None:
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+class JSONFormatter(logging.Formatter):
+    '''One JSON object per line: time, level, logger, message and, for
+    exceptions, the traceback. Records with an event (see sinks.LogSink)
+    have its fields as well.'''
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry['event'] = event.fields()
+        return json.dumps(entry)
+
+
+def parse_levels(spec, root='IRCTerm'):
+    '''{logger name: level} for a spec like 'INFO,IRCTerm.IRCHandler=DEBUG',
+    a level without a name is for root.'''
+    levels = {}
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, level = part.rpartition('=')
+        level = logging.getLevelName(level.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError('Unknown log level in %r' % part)
+        levels[name.strip() or root] = level
+    return levels
+
+
+def setup(levels='INFO', logfile=LOGFILE, json_file=False, console_level=logging.NOTSET,
+          file_level=logging.NOTSET, root='IRCTerm'):
+    '''Log root to the console and a daily rotated logfile through a
+    QueueListener, and set the levels from a spec (see parse_levels) or a
+    dict. The handlers take whatever the levels let through unless given a
+    level of their own. Returns the listener, which is also stopped at exit.'''
+    console = StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(FORMAT))
+    handlers = [console]
+    if logfile is not None:
+        logfile = TimedRotatingFileHandler(logfile, when='midnight', backupCount=7)
+        logfile.setLevel(file_level)
+        logfile.setFormatter(JSONFormatter() if json_file else logging.Formatter(FORMAT))
+        handlers.append(logfile)
+
+    queue = Queue.Queue(QUEUE_SIZE)
+    listener = QueueListener(queue, *handlers)
+    logger = logging.getLogger(root)
+    logger.addHandler(QueueHandler(queue))
+    logger.propagate = False
+
+    if isinstance(levels, basestring):
+        levels = parse_levels(levels, root)
+    for name, level in levels.iteritems():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
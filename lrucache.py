@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from collections import OrderedDict
+
+#==============================================================================#
+#   Least recently used cache
+#==============================================================================#
+#
+#   A dict of at most maxsize entries that forgets the one used longest ago
+#   to make room, counting hits and misses. The rendered glyphs and the
+#   parsed IRC prefixes are kept in one.
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
@@ -1,6 +1,14 @@
-import Adafruit_BBIO.GPIO as GPIO
+try:
+    import Adafruit_BBIO.GPIO as GPIO
+except ImportError:
+    # off the board, e.g. for benchmarks with a mock GPIO module
+    GPIO = None
+import logging
+import re
 import time
 import cp437
+import gpiomem
+from clock import monotonic
 
 #==============================================================================#
 #   Beaglebone Black script to interface with Noritake 8-bit Protocol display
@@ -25,14 +33,24 @@ PINS = {'E':'P9_24',    # pin 6 on display
         'DB1':'P9_16',  # pin 8 on display
         'DB0':'P9_15'   # pin 7 on display
         }
+# Add 'BUSY': 'P9_25' (or any free pin) when the display's BUSY output is
+# wired to the board, the bus then waits on it instead of on EXEC_TIMES
 
 #----------------------------------------------------------------------#
-#   Font Table
+#   Precomputed write plan
 #----------------------------------------------------------------------#
 #
-#   Corresponding 8bit definition for each character
+#   Everything that used to be worked out per character (hex string to int,
+#   int to bit string, bit string to pin levels) is done once here. Text is
+#   turned into bytes with cp437.encode(), which is shared with the printer.
 #
-CHARS = cp437.transpose()
+#   LEVELS:  byte -> levels of DB0..DB7
+#   CHANGED: xor of two bytes -> indexes of the data pins that differ, so
+#            going from one byte to the next only touches pins that change
+#
+DATA_PINS = tuple(PINS['DB%d' % i] for i in xrange(8))
+LEVELS = tuple(tuple(b >> i & 1 for i in xrange(8)) for b in xrange(256))
+CHANGED = tuple(tuple(i for i in xrange(8) if mask >> i & 1) for mask in xrange(256))
 
 #----------------------------------------------------------------------#
 #   Screen configuration. Default is 24x6 a la CU24063-Y100
@@ -50,10 +68,6 @@ def initializePins(pins):
         GPIO.setup(pin, GPIO.OUT)
     set_all_low(pins)
 
-# Pause the script for 2 ms
-def wait():
-    time.sleep(.002)
-
 # Set the GPIO pin to a state that's passed to it 
 def set_to_state(pin, state):
     GPIO.output(pin, int(state))
@@ -71,57 +85,299 @@ def set_all_low(pins):
     for pin in pins.itervalues():
         set_low(pin)
 
+#----------------------------------------------------------------------#
+#   Bus timing
+#----------------------------------------------------------------------#
+#
+#   The display latches a byte when E falls and then takes a while to act
+#   on it, with BUSY high meanwhile; a byte strobed in before it is done is
+#   lost. The setup and hold times around E are tens of nanoseconds, less
+#   than any GPIO write takes, but the execution times are not, so a backend
+#   with a timing asks it to wait() before every strobe and tells it what
+#   it sent():
+#
+#   - Timing knows how long each command takes (EXEC_TIMES) and follows the
+#     byte stream, so a 0x0C that is a cursor position argument isn't taken
+#     for a clear. The time runs on a monotonic clock from the strobe, so
+#     whatever Python spends between bytes counts toward it and a run of
+#     characters only waits for what is left, usually nothing. Short waits
+#     spin, sleep() overshoots by more than a character takes; long ones,
+#     like the init, sleep most of the way.
+#   - BusyTiming polls the BUSY line, when PINS has one, and waits exactly
+#     as long as the display needs.
+#
+#   Screen() puts its default backend on whichever fits; backends made by
+#   hand have no timing unless given one, which is what the benchmarks and
+#   the fakes want.
+
+# Seconds the display may need after a byte, the worst cases of the CU-Y
+# series with some margin. The real display reports it on BUSY.
+EXEC_TIMES = {'char': 50e-6,      # characters, and commands with no effect of their own
+              'lf': 0.5e-3,       # line feed, may scroll the whole display
+              'clear': 1e-3,      # 0x0C
+              'init': 2e-3}       # ESC @
+
+# Wait out the execution time of each byte before the next strobe
+class Timing(object):
+
+    # waits up to this long spin
+    SPIN = 0.5e-3
+
+    def __init__(self, times=EXEC_TIMES, clock=None):
+        self.times = dict(EXEC_TIMES, **times)
+        self.clock = clock or monotonic
+        self.ready = 0.0
+        self.longest = max(self.times.itervalues())
+        self._prefix = None
+        self._args = 0
+
+    # How long the display takes over byte, which follows the bytes before
+    def exec_time(self, byte):
+        times = self.times
+        if self._args:
+            self._args -= 1
+            return times['char']
+        prefix, self._prefix = self._prefix, None
+        if prefix == 0x1B:
+            return times['init'] if byte == 0x40 else times['char']
+        if prefix == 0x1F:
+            if byte == 0x24:
+                self._args = 2      # cursor position, x and y follow
+            return times['char']
+        if byte == 0x1B or byte == 0x1F:
+            self._prefix = byte
+        elif byte == 0x0C:
+            return times['clear']
+        elif byte == LF:
+            return times['lf']
+        return times['char']
+
+    # Return once the display can take the next byte
+    def wait(self):
+        clock = self.clock
+        ready = self.ready
+        delay = ready - clock()
+        if delay <= 0:
+            return
+        if delay > self.longest:
+            # the clock went back, time.time() can
+            self.ready = 0.0
+            return
+        if delay > self.SPIN:
+            time.sleep(delay - self.SPIN)
+        while clock() < ready:
+            pass
+
+    # byte was just strobed
+    def sent(self, byte):
+        self.ready = self.clock() + self.exec_time(byte)
+
+# Wait for the display's BUSY line to go low before each strobe, busy() is
+# the backend's reading of it
+class BusyTiming(object):
+
+    # BUSY high for longer than this means it isn't wired right
+    TIMEOUT = 0.1
+
+    def __init__(self, busy, clock=None):
+        self.busy = busy
+        self.clock = clock or monotonic
+        self.stuck = 0
+
+    def wait(self):
+        busy = self.busy
+        if not busy():
+            return
+        clock = self.clock
+        deadline = clock() + self.TIMEOUT
+        while busy():
+            if clock() > deadline:
+                if not self.stuck:
+                    logger = logging.getLogger('IRCTerm.Screen')
+                    logger.warn('BUSY stuck high for %.0f ms, writing anyway', self.TIMEOUT * 1000)
+                self.stuck += 1
+                return
+
+    def sent(self, byte):
+        pass
+
+# The timing for backend: BUSY when it has the pin, EXEC_TIMES otherwise
+def auto_timing(backend):
+    if backend.busy_pin is not None:
+        return BusyTiming(backend.busy)
+    return Timing()
+
+#----------------------------------------------------------------------#
+#   Bus backends
+#----------------------------------------------------------------------#
+#
+#   A backend puts bytes on the data bus and strobes E. RS is held low, the
+#   display takes commands and characters alike as data bytes. Data lines
+#   keep their level between bytes so only the ones that change are written.
+#   timing is None (no waiting), a Timing or BusyTiming, or 'auto' for
+#   auto_timing().
+
+# Drive the bus through Adafruit_BBIO, one call per changed pin
+class GPIOBackend(object):
+    def __init__(self, pins=PINS, gpio=None, timing=None):
+        self.gpio = gpio if gpio is not None else GPIO
+        pins = dict(pins)
+        self.busy_pin = pins.pop('BUSY', None)
+        self.e = pins['E']
+        self.data = tuple(pins['DB%d' % i] for i in xrange(8))
+        for pin in pins.itervalues():
+            self.gpio.setup(pin, self.gpio.OUT)
+            self.gpio.output(pin, self.gpio.LOW)
+        if self.busy_pin is not None:
+            self.gpio.setup(self.busy_pin, self.gpio.IN)
+        self.last = 0
+        self.timing = auto_timing(self) if timing == 'auto' else timing
+
+    def busy(self):
+        return self.gpio.input(self.busy_pin)
+
+    def write(self, byte):
+        self.write_bytes((byte,))
+
+    def write_bytes(self, data):
+        output = self.gpio.output
+        pins = self.data
+        e = self.e
+        last = self.last
+        timing = self.timing
+        for byte in bytearray(data):
+            for i in CHANGED[byte ^ last]:
+                output(pins[i], byte >> i & 1)
+            last = byte
+            if timing is not None:
+                timing.wait()
+            output(e, 1)
+            output(e, 0)
+            if timing is not None:
+                timing.sent(byte)
+        self.last = last
+
+# Drive the bus through memory-mapped GPIO registers, a couple of register
+# stores per byte however many pins change. regs is a gpiomem.MemRegisters
+# (the default) or a gpiomem.FakeRegisters for testing.
+class MmapBackend(object):
+    def __init__(self, pins=PINS, regs=None, timing=None):
+        layout = dict((name, gpiomem.HEADER[pin]) for name, pin in pins.iteritems())
+        self.busy_pin = layout.pop('BUSY', None)
+        banks = sorted(set(bank for bank, bit in layout.itervalues()))
+        if regs is None:
+            used = set(banks)
+            if self.busy_pin is not None:
+                used.add(self.busy_pin[0])
+            regs = gpiomem.MemRegisters(sorted(used))
+        self.regs = regs
+
+        # make every pin an output and drive it low
+        for bank in banks:
+            mask = 0
+            for b, bit in layout.itervalues():
+                if b == bank:
+                    mask |= 1 << bit
+            self.regs.write32(bank, gpiomem.CLEARDATAOUT, mask)
+            self.regs.write32(bank, gpiomem.OE, self.regs.read32(bank, gpiomem.OE) & ~mask)
+        # but BUSY, an input
+        if self.busy_pin is not None:
+            bank, bit = self.busy_pin
+            self.regs.write32(bank, gpiomem.OE, self.regs.read32(bank, gpiomem.OE) | 1 << bit)
+
+        self.e_bank, e_bit = layout['E']
+        self.e_mask = 1 << e_bit
+
+        # per bank: which data bits live there, and for every byte the
+        # set/clear masks that put it on the bus
+        self.plan = []
+        for bank in banks:
+            bits = [(i, layout['DB%d' % i][1]) for i in xrange(8) if layout['DB%d' % i][0] == bank]
+            if not bits:
+                continue
+            byte_mask = sum(1 << i for i, bit in bits)
+            setmasks = tuple(sum(1 << bit for i, bit in bits if b >> i & 1) for b in xrange(256))
+            allbits = sum(1 << bit for i, bit in bits)
+            clearmasks = tuple(allbits & ~m for m in setmasks)
+            self.plan.append((bank, byte_mask, setmasks, clearmasks))
+        self.last = 0
+        self.timing = auto_timing(self) if timing == 'auto' else timing
+
+    def busy(self):
+        bank, bit = self.busy_pin
+        return self.regs.read32(bank, gpiomem.DATAIN) >> bit & 1
+
+    def write(self, byte):
+        self.write_bytes((byte,))
+
+    def write_bytes(self, data):
+        write32 = self.regs.write32
+        plan = self.plan
+        e_bank = self.e_bank
+        e_mask = self.e_mask
+        last = self.last
+        timing = self.timing
+        for byte in bytearray(data):
+            changed = byte ^ last
+            for bank, byte_mask, setmasks, clearmasks in plan:
+                if changed & byte_mask:
+                    write32(bank, gpiomem.SETDATAOUT, setmasks[byte])
+                    write32(bank, gpiomem.CLEARDATAOUT, clearmasks[byte])
+            last = byte
+            if timing is not None:
+                timing.wait()
+            write32(e_bank, gpiomem.SETDATAOUT, e_mask)
+            write32(e_bank, gpiomem.CLEARDATAOUT, e_mask)
+            if timing is not None:
+                timing.sent(byte)
+        self.last = last
+
 #----------------------------------------------------------------------#
 #   display control 
 #----------------------------------------------------------------------#
+#
+#   write() is the way to put text on the display: the whole string is
+#   encoded at once, goes to the backend in a single write_bytes() call
+#   behind the cursor move, and where the cursor ends up is worked out from
+#   the length. Rows wrap into the next one, and past the bottom row the
+#   display scrolls up in vertical mode and starts over at the top
+#   otherwise. cp437.encode() drops control characters but line feeds,
+#   which move the cursor down a row.
+
+# bytes the cursor position can't be worked out from the length with
+CONTROL_BYTES = re.compile('[\x00-\x1f]')
+
 class Screen:
 
     # Necessary steps to turn on the display
-    def __init__(self, cursor_status='blinking'):
+    def __init__(self, cursor_status='blinking', backend=None):
 
-        if bit_mode not in [4,8]:
-            bit_mode = 8
-
-        self.bit_mode = bit_mode
-        self.pins = dict(PINS)
+        if backend is None:
+            backend = GPIOBackend(timing='auto')
+        self.backend = backend
         
         self.pos_x = 0
         self.pos_y = 0
+        self.mode = 'vertical'
 
         # Initialize screen
-        initializePins(self.pins)
-        self.sendCommand('0x1B')    # command mode
-        self.sendCommand('0x40')    # init display
-        wait()
+        self.sendCommand(0x1B)      # command mode
+        self.sendCommand(0x40)      # init display, the backend's timing waits for it
         self.on(cursor_status)
         self.scrollMode('vertical')
         self.clear()
 
-    # Tell the display to read in the command 
-    def transfer(self):
-        set_high(PINS['E'])
-        set_all_low(self.pins)
-
-    # Turn the GPIO pins on so the display can read them in 
+    # Put a byte on the bus, either an int or a '0x..' string
+    # Pin R/W is held to ground in the circuit - W only
     def sendCommand(self, command):
-        if command.startswith('0x'):
-            command = bin(int(command,16))
-        set_to_state(PINS['RS'],command[0])
-        # Pin R/W is held to ground in the circuit - W only, ignore this bit
-        set_to_state(PINS['DB7'], command[2])
-        set_to_state(PINS['DB6'], command[3])
-        set_to_state(PINS['DB5'], command[4])
-        set_to_state(PINS['DB4'], command[5])
-        set_to_state(PINS['DB3'], command[6])
-        set_to_state(PINS['DB2'], command[7])
-        set_to_state(PINS['DB1'], command[8])
-        set_to_state(PINS['DB0'], command[9])
-        self.transfer()
+        if isinstance(command, basestring):
+            command = int(command, 16)
+        self.backend.write(command)
 
     # Clear Display
     def clear(self):
-        self.sendCommand('0x0C')
-        
+        self.sendCommand(0x0C)
+        self.updatePos(0, 0, abs=True)
 
     # Turn the display on   
     # Turn the cursor on or off and set it's blinking or on or off
@@ -132,56 +388,58 @@ class Screen:
         block == block blinking
         underline = underline no blink
         '''
-        status_command = {'blinking':'16', 'block':'15', 'underline':'13'}
-        try:
-            command = '0x' + status_command[cursor_status]
-        except:
-            command = '0x' + status_command['blinking']
-        self.sendCommand(command)
+        status_command = {'blinking':0x16, 'block':0x15, 'underline':0x13}
+        self.sendCommand(status_command.get(cursor_status, status_command['blinking']))
 
     # Turn the display off
     def off(self):
-        self.sendCommand('0x14')
+        self.sendCommand(0x14)
 
     # Set scroll mode
     def scrollMode(self,mode='vertical'):
-        self.sendCommand('0x1F')
         command = {'vertical':0x02,
                    'horizontal':0x03,
                    'overwrite':0x01}[mode]
-        self.sendCommand('0x%02x'%command)
+        self.backend.write_bytes(bytearray((0x1F, command)))
+        self.mode = mode
     
     # Move cursor
     def moveCursor(self, x, y):
-        self.sendCommand('0x1F')        # command mode
-        self.sendCommand('0x24')        # move cursor
-        self.sendCommand('0x%02x'%x)    # xL is whatever column
-        self.sendCommand('0x%02x'%y)    # yL is whatever line
+        self.backend.write_bytes(bytearray(cursor_bytes(x, y)))
         self.updatePos(x=x,y=y,abs=True)
 
+    # Put text at x, y, or where the cursor is when they are left out
+    def write(self, text, x=None, y=None):
+        data = bytearray(cp437.encode(text))
+        if x is not None or y is not None:
+            x = self.pos_x if x is None else x
+            y = self.pos_y if y is None else y
+            self.backend.write_bytes(bytearray(cursor_bytes(x, y)) + data)
+            self.updatePos(x=x, y=y, abs=True)
+        else:
+            self.backend.write_bytes(data)
+        if CONTROL_BYTES.search(str(data)) is None:
+            self.updatePos(x=len(data))
+        else:
+            for byte in data:
+                if byte == LF:
+                    self.updatePos(y=1)
+                elif byte >= 0x20:
+                    self.updatePos(x=1)
+
     # Print a COLS char line to the display
     def printLine(self, line, line_number=1):
-        # limit the length of the string, turn the RS pin to high to start
-        # data transfer.
-        self.moveCursor(line_number)
-        if len(line)>COLS:
-            line = line[:COLS]
-
-        #  for each character in the line, execute the correct command 
-        for char in line:
-            self.printChar(char)
+        self.write(line[:COLS], 0, line_number)
             
     def printChar(self,char):
         if char == '\x08': #backspace
-            self.sendCommand('0x08')
+            self.sendCommand(0x08)
             self.updatePos(x=-1)
-        try:
-            command = CHARS[char]
-        except:
-            command = CHARS['?']
-        self.sendCommand(command)
-        self.updatePos(x=1)
+        else:
+            self.write(char)
         
+    # Move the cursor position by x columns and y rows, wrapping rows and
+    # scrolling in vertical mode like the display does, or set it (abs)
     def updatePos(self,x=0,y=0,abs=False):
         if abs:
             if not (0 <= x < COLS):
@@ -190,18 +448,141 @@ class Screen:
                 y = ROWS - 1
             self.pos_x = x
             self.pos_y = y
+            return
+        cell = (self.pos_y + y) * COLS + self.pos_x + x
+        self.pos_x = cell % COLS
+        if self.mode == 'vertical' and cell >= ROWS * COLS:
+            self.pos_y = ROWS - 1
         else:
-            if self.pos_x + x >= COLS:
-                self.x = 0
-                y += 1
-            elif self.pos_x + x < 0:
-                self.pos_x = COLS - 1
-                y -= 1
-            else:
-                self.pos_x += x
-            if not (0 <= self.pos_y + y < ROWS):
-                self.pos_y = 0
-            elif self.pos_y + y < 0:
-                self.pos_y = ROWS - 1
-            else:
-                self.pos_y += y
+            self.pos_y = cell // COLS % ROWS
+
+#----------------------------------------------------------------------#
+#   Framebuffer
+#----------------------------------------------------------------------#
+#
+#   Callers draw into a virtual ROWS x COLS screen and flush() works out the
+#   fewest bytes that bring the display up to date: unchanged cells are
+#   skipped, short gaps between changes are rewritten instead of paying for
+#   a cursor move, and a frame that is the old one shifted up is done with
+#   the hardware vertical scroll (line feeds on the bottom row).
+#
+#   Assumes the display is in vertical scroll mode, as Screen sets it up.
+
+MOVE_COST = 4           # bytes in a cursor move, see cursor_bytes()
+LF = 0x0A
+OVERWRITE_MODE = (0x1F, 0x01)
+VERTICAL_MODE = (0x1F, 0x02)
+
+def cursor_bytes(x, y):
+    return (0x1F, 0x24, x, y)
+
+def encode(text):
+    return bytearray(cp437.encode(text))
+
+class FrameBuffer(object):
+    def __init__(self, screen, rows=ROWS, cols=COLS):
+        self.screen = screen
+        self.rows = rows
+        self.cols = cols
+        self.blank = bytearray(' ' * cols)
+        # what callers want to see, and what the display is showing
+        self.frame = [bytearray(self.blank) for y in xrange(rows)]
+        self.shown = [bytearray(self.blank) for y in xrange(rows)]
+        self.cursor = None
+
+    # Put text at x, y, clipped to the end of the row
+    def write(self, x, y, text):
+        data = encode(text)[:self.cols - x]
+        self.frame[y][x:x + len(data)] = data
+
+    # Replace a whole row, padding with spaces
+    def line(self, y, text):
+        self.frame[y] = (encode(text[:self.cols]) + self.blank)[:self.cols]
+
+    # Shift everything up a row, text goes on the bottom row
+    def scroll(self, text=''):
+        self.frame.pop(0)
+        self.frame.append(bytearray(self.blank))
+        self.line(self.rows - 1, text)
+
+    def clear(self):
+        self.frame = [bytearray(self.blank) for y in xrange(self.rows)]
+
+    # Forget what is on the display so the next flush redraws everything
+    def invalidate(self):
+        self.shown = [bytearray(self.cols) for y in xrange(self.rows)]
+        self.cursor = None
+
+    # Work out the bytes that turn shown into frame, starting with the
+    # cursor at cursor (None if unknown)
+    def _diff(self, shown, frame, cursor):
+        out = bytearray()
+        cols = self.cols
+        for y in xrange(self.rows):
+            old = shown[y]
+            new = frame[y]
+            if old == new:
+                continue
+            x = 0
+            while x < cols:
+                if old[x] == new[x]:
+                    x += 1
+                    continue
+                # extend the run over gaps that are cheaper to rewrite
+                end = x + 1
+                gap = 0
+                for i in xrange(x + 1, cols):
+                    if old[i] != new[i]:
+                        end = i + 1
+                        gap = 0
+                    else:
+                        gap += 1
+                        if gap > MOVE_COST:
+                            break
+                if cursor is not None and cursor[1] == y and 0 <= x - cursor[0] <= MOVE_COST:
+                    out += new[cursor[0]:x]
+                else:
+                    out += bytearray(cursor_bytes(x, y))
+                if end == cols and y == self.rows - 1:
+                    # don't let the bottom right cell scroll the display
+                    out += bytearray(OVERWRITE_MODE) + new[x:end] + bytearray(VERTICAL_MODE)
+                else:
+                    out += new[x:end]
+                cursor = (end, y) if end < cols else None
+                x = end
+        return out, cursor
+
+    # Bytes for the update, using the hardware scroll when that is cheaper
+    def plan(self):
+        best, cursor = self._diff(self.shown, self.frame, self.cursor)
+        shown = self.shown
+        for k in xrange(1, self.rows):
+            if self.frame[:self.rows - k] != shown[k:]:
+                continue
+            out = bytearray(cursor_bytes(0, self.rows - 1)) + bytearray([LF] * k)
+            if len(out) >= len(best):
+                break
+            scrolled = shown[k:] + [bytearray(self.blank) for y in xrange(k)]
+            rest, c = self._diff(scrolled, self.frame, (0, self.rows - 1))
+            if len(out) + len(rest) < len(best):
+                best, cursor = out + rest, c
+            break
+        return best, cursor
+
+    # Put the display's cursor at x, y, e.g. where typing goes
+    def place_cursor(self, x, y):
+        if self.cursor != (x, y):
+            self.screen.backend.write_bytes(bytearray(cursor_bytes(x, y)))
+            self.cursor = (x, y)
+            self.screen.updatePos(x=x, y=y, abs=True)
+
+    # Bring the display up to date, returns the number of bytes sent
+    def flush(self):
+        out, cursor = self.plan()
+        if out:
+            self.screen.backend.write_bytes(out)
+        self.shown = [bytearray(row) for row in self.frame]
+        self.cursor = cursor
+        if cursor is not None:
+            self.screen.updatePos(x=cursor[0], y=cursor[1], abs=True)
+        return len(out)
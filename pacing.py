@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import time
+from collections import deque
+
+from clock import monotonic
+
+#==============================================================================#
+#   Throughput-aware pacing for the thermal printer UART
+#==============================================================================#
+#
+#   The printer has no usable flow control in the default wiring and a small
+#   input buffer, so writing as fast as the UART allows overruns it during
+#   IRC floods. The Pacer keeps a model of how long the printer needs for
+#   each job (serial transfer plus head/feed time derived from the heat
+#   settings) and holds writes back so that no more than max_inflight bytes
+#   are ever waiting inside the printer.
+#
+#   The timing model follows the Adafruit library: a byte takes 11 bit times
+#   on the wire (8N1 plus some margin), a text line takes charHeight heated
+#   dot lines plus lineSpacing fed dot lines, and a bitmap row one heated dot
+#   line. A heated dot line needs one heating pass per 8 * (heatingDots + 1)
+#   dots, each pass lasting heatTime + heatInterval (in units of 10us).
+
+DOTS = 384                  # dots per printed row
+BITS_PER_BYTE = 11          # 8N1 with a bit of margin
+DOT_FEED_TIME = 0.0021      # seconds to feed one dot line without heating
+LINE_SPACING = 6            # dot lines fed between text lines
+
+
+class Pacer(object):
+
+    # bytes allowed to sit unprocessed in the printer's input buffer
+    MAX_INFLIGHT = 256
+
+    def __init__(self, baudrate, heatTime=80, heatInterval=2, heatingDots=7,
+                 max_inflight=MAX_INFLIGHT, clock=monotonic):
+        self.byte_time = float(BITS_PER_BYTE) / baudrate
+        passes = -(-DOTS // (8 * (heatingDots + 1)))
+        self.dot_print_time = max(DOT_FEED_TIME, passes * (heatTime + heatInterval) * 10e-6)
+        self.max_inflight = max_inflight
+        # finish times are on this clock, a wall clock step would stall or
+        # rush the writes
+        self.clock = clock
+
+        # (estimated finish time, bytes) for every piece still in the printer
+        self._inflight = deque()
+        self._inflight_bytes = 0
+        self._busy_until = 0.0
+
+    def head_time(self, text_lines=0, char_height=24, feed_lines=0, dot_rows=0):
+        """ Estimated time the print head and paper feed need for a job. """
+        return (text_lines * (char_height * self.dot_print_time + LINE_SPACING * DOT_FEED_TIME) +
+                feed_lines * (char_height + LINE_SPACING) * DOT_FEED_TIME +
+                dot_rows * self.dot_print_time)
+
+    def lines_per_second(self, char_height=24, chars_per_line=42):
+        """ Sustainable rate of full text lines for the current settings. """
+        line = self.head_time(1, char_height)
+        return 1.0 / max(line, (chars_per_line + 1) * self.byte_time)
+
+    def backlog(self):
+        """ Seconds until the printer is expected to have finished everything
+            sent so far. """
+        return max(0.0, self._busy_until - self.clock())
+
+    def _expire(self, now):
+        while self._inflight and self._inflight[0][0] <= now:
+            self._inflight_bytes -= self._inflight.popleft()[1]
+
+    def _wait_for_room(self, n):
+        while True:
+            now = self.clock()
+            self._expire(now)
+            if not self._inflight or self._inflight_bytes + n <= self.max_inflight:
+                return
+            time.sleep(self._inflight[0][0] - now)
+
+    def write(self, port, data, head_time=0.0):
+        """ Write data to port, never letting more than max_inflight bytes
+            pile up in the printer. head_time is the estimate for the whole of
+            data and is spread evenly across it. """
+        if not data:
+            return
+        per_byte = head_time / len(data)
+        for start in xrange(0, len(data), self.max_inflight):
+            piece = data[start:start + self.max_inflight]
+            n = len(piece)
+            self._wait_for_room(n)
+            now = self.clock()
+            port.write(piece)
+            finish = max(now + n * self.byte_time, self._busy_until) + n * per_byte
+            self._busy_until = finish
+            self._inflight.append((finish, n))
+            self._inflight_bytes += n
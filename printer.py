@@ -1,7 +1,10 @@
 #!/usr/bin/env python 
 #coding=utf-8
 
-import serial, time
+import serial
+import raster
+from pacing import Pacer
+from contextlib import contextmanager
 
 #===========================================================#
 # RASPBERRY PI (tested with Raspbian Jan 2012):
@@ -51,6 +54,14 @@ class ThermalPrinter(object):
     BAUDRATE = 19200
     TIMEOUT = 3
 
+    # serial flow control, passed as flow_control to __init__:
+    # None, 'rtscts' (printer DTR wired to CTS), 'dsrdtr' or 'xonxoff'
+    FLOW_CONTROL = None
+
+    # character heights in dot lines for font A (12x24) and font B (9x17)
+    FONT_A_HEIGHT = 24
+    FONT_B_HEIGHT = 17
+
     # pixels with more color value (average for multiple channels) are counted as white
     # tweak this if your images appear too black or too white
     black_threshold = 48
@@ -61,6 +72,14 @@ class ThermalPrinter(object):
 
     _ESC = chr(27)
 
+    # Output buffering: commands and text accumulate in one bytearray. Every
+    # public method goes out in a single write() by the time it returns, so
+    # nothing is left waiting for a later call; inside a transaction()
+    # nothing is written until the outermost block exits, so a styled line
+    # is still one write. A buffer filling up past BUFFER_SIZE is written
+    # either way.
+    BUFFER_SIZE = 512
+
     # These values (including printDensity and printBreaktime) are taken from 
     # lazyatom's Adafruit-Thermal-Library branch and seem to work nicely with bitmap 
     # images. Changes here can cause symptoms like images printing out as random text. 
@@ -78,15 +97,31 @@ class ThermalPrinter(object):
     # blank page may occur. The more heating interval, the more
     # clear, but the slower printing speed.
     
-    def __init__(self, heatTime=80, heatInterval=2, heatingDots=7, serialport=SERIALPORT):
-        self.printer = serial.Serial(serialport, self.BAUDRATE, timeout=self.TIMEOUT)
-        self.printer.write(self._ESC) # ESC - command
-        self.printer.write(chr(64)) # @   - initialize
-        self.printer.write(self._ESC) # ESC - command
-        self.printer.write(chr(55)) # 7   - print settings
-        self.printer.write(chr(heatingDots))  # Heating dots (20=balance of darkness vs no jams) default = 20
-        self.printer.write(chr(heatTime)) # heatTime Library default = 255 (max)
-        self.printer.write(chr(heatInterval)) # Heat interval (500 uS = slower, but darker) default = 250
+    # Writes are paced by a Pacer (see pacing.py) built from the same
+    # settings, which estimates how long the printer needs for each job and
+    # never lets more than Pacer.MAX_INFLIGHT bytes pile up in its input
+    # buffer. Pass pacing=False to write as fast as the UART allows, e.g. when
+    # the printer has working hardware flow control.
+    
+    def __init__(self, heatTime=80, heatInterval=2, heatingDots=7, serialport=SERIALPORT,
+                 flow_control=FLOW_CONTROL, pacing=True):
+        flow = {None: {},
+                'rtscts': {'rtscts': True},
+                'dsrdtr': {'dsrdtr': True},
+                'xonxoff': {'xonxoff': True}}[flow_control]
+        if hasattr(serialport, 'write'):
+            # already a port, e.g. a virtualprinter.VirtualPrinter
+            self.printer = serialport
+        else:
+            self.printer = serial.Serial(serialport, self.BAUDRATE, timeout=self.TIMEOUT, **flow)
+        if pacing:
+            self.pacer = Pacer(self.BAUDRATE, heatTime, heatInterval, heatingDots)
+        else:
+            self.pacer = None
+        self._buffer = bytearray()
+        self._buffer_time = 0.0
+        self._depth = 0
+        self._char_height = self.FONT_A_HEIGHT
 
         # Description of print density from page 23 of the manual:
         # DC2 # n Set printing density
@@ -95,16 +130,66 @@ class ThermalPrinter(object):
         # D7..D5 of n is used to set the printing break time. Break time is n(D7-D5)*250us.
         printDensity = 15 # 120% (? can go higher, text is darker but fuzzy)
         printBreakTime = 15 # 500 uS
-        self.printer.write(chr(18))
-        self.printer.write(chr(35))
-        self.printer.write(chr((printDensity << 4) | printBreakTime))
+
+        with self.transaction():
+            self._command(27, 64) # ESC @ - initialize
+            self._command(27, 55, # ESC 7 - print settings
+                          heatingDots,  # Heating dots (20=balance of darkness vs no jams) default = 20
+                          heatTime,     # heatTime Library default = 255 (max)
+                          heatInterval) # Heat interval (500 uS = slower, but darker) default = 250
+            self._command(18, 35, (printDensity << 4) | printBreakTime) # DC2 #
+
+    def _write(self, data, head_time=0.0):
+        """ Queue raw bytes for the printer. head_time is the estimated time
+            the print head needs for them, see _head_time. Outside of a
+            transaction they are written right away, methods that write
+            several pieces wrap them in one. """
+        self._buffer.extend(data)
+        self._buffer_time += head_time
+        if self._depth == 0 or len(self._buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def _command(self, *codes):
+        self._write(bytearray(codes))
+
+    def _head_time(self, text_lines=0, feed_lines=0, dot_rows=0):
+        if self.pacer is None:
+            return 0.0
+        return self.pacer.head_time(text_lines, self._char_height, feed_lines, dot_rows)
+
+    def flush(self):
+        """ Send everything buffered so far in a single write. """
+        if self._buffer:
+            if self.pacer is None:
+                self.printer.write(bytes(self._buffer))
+            else:
+                self.pacer.write(self.printer, bytes(self._buffer), self._buffer_time)
+            del self._buffer[:]
+        self._buffer_time = 0.0
+
+    @contextmanager
+    def transaction(self):
+        """ Group several commands into one write, e.g.
+
+                with p.transaction():
+                    p.inverse_on()
+                    p.print_text('hello\\n')
+                    p.inverse_off()
+
+            Transactions can be nested, only the outermost one flushes. """
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.flush()
 
     def reset(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(64))
+        self._command(27, 64)
 
     def linefeed(self):
-        self.printer.write(chr(10))
+        self._write(chr(10), self._head_time(feed_lines=1))
 
     def justify(self, align="L"):
         pos = 0
@@ -114,74 +199,52 @@ class ThermalPrinter(object):
             pos = 1
         elif align == "R":
             pos = 2
-        self.printer.write(self._ESC)
-        self.printer.write(chr(97))
-        self.printer.write(chr(pos))
+        self._command(27, 97, pos)
 
     def bold_off(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(69))
-        self.printer.write(chr(0))
+        self._command(27, 69, 0)
 
     def bold_on(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(69))
-        self.printer.write(chr(1))
+        self._command(27, 69, 1)
 
     def font_b_off(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(33))
-        self.printer.write(chr(0))
+        self._command(27, 33, 0)
+        self._char_height = self.FONT_A_HEIGHT
 
     def font_b_on(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(33))
-        self.printer.write(chr(1))
+        self._command(27, 33, 1)
+        self._char_height = self.FONT_B_HEIGHT
 
     def underline_off(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(45))
-        self.printer.write(chr(0))
+        self._command(27, 45, 0)
 
     def underline_on(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(45))
-        self.printer.write(chr(1))
+        self._command(27, 45, 1)
 
     def inverse_off(self):
-        self.printer.write(chr(29))
-        self.printer.write(chr(66))
-        self.printer.write(chr(0))
+        self._command(29, 66, 0)
 
     def inverse_on(self):
-        self.printer.write(chr(29))
-        self.printer.write(chr(66))
-        self.printer.write(chr(1))
+        self._command(29, 66, 1)
 
     def upsidedown_off(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(123))
-        self.printer.write(chr(0))
+        self._command(27, 123, 0)
 
     def upsidedown_on(self):
-        self.printer.write(self._ESC)
-        self.printer.write(chr(123))
-        self.printer.write(chr(1))
+        self._command(27, 123, 1)
         
     def barcode_chr(self, msg):
-        self.printer.write(chr(29)) # Leave
-        self.printer.write(chr(72)) # Leave
-        self.printer.write(msg)     # Print barcode # 1:Abovebarcode 2:Below 3:Both 0:Not printed
+        with self.transaction():
+            self._command(29, 72) # Leave
+            self._write(msg)      # Print barcode # 1:Abovebarcode 2:Below 3:Both 0:Not printed
         
     def barcode_height(self, msg):
-        self.printer.write(chr(29))  # Leave
-        self.printer.write(chr(104)) # Leave
-        self.printer.write(msg)      # Value 1-255 Default 50
+        with self.transaction():
+            self._command(29, 104) # Leave
+            self._write(msg)       # Value 1-255 Default 50
         
     def barcode_height(self):
-        self.printer.write(chr(29))  # Leave
-        self.printer.write(chr(119)) # Leave
-        self.printer.write(chr(2))   # Value 2,3 Default 2
+        self._command(29, 119, 2) # Value 2,3 Default 2
         
     def barcode(self, msg):
         """ Please read http://www.adafruit.com/datasheets/A2-user%20manual.pdf
@@ -193,24 +256,25 @@ class ThermalPrinter(object):
         # 68=EAN8    7,8    #74=CODE11    >1
         # 69=CODE39    >1    #75=MSI        >1
         # 70=I25        >1 EVEN NUMBER           
-        self.printer.write(chr(29))  # LEAVE
-        self.printer.write(chr(107)) # LEAVE
-        self.printer.write(chr(65))  # USE ABOVE CHART
-        self.printer.write(chr(12))  # USE CHART NUMBER OF CHAR 
-        self.printer.write(msg)
+        with self.transaction():
+            self._command(29,  # LEAVE
+                          107, # LEAVE
+                          65,  # USE ABOVE CHART
+                          12)  # USE CHART NUMBER OF CHAR 
+            self._write(msg)
         
     def print_text(self, msg, chars_per_line=None):
         """ Print some text defined by msg. If chars_per_line is defined, 
             inserts newlines after the given amount. Use normal '\n' line breaks for 
             empty lines. """ 
         if chars_per_line == None:
-            self.printer.write(msg)
+            self._write(msg, self._head_time(text_lines=msg.count('\n')))
         else:
             l = list(msg)
             le = len(msg)
             for i in xrange(chars_per_line + 1, le, chars_per_line + 1):
                 l.insert(i, '\n')
-            self.printer.write("".join(l))
+            self._write("".join(l), self._head_time(text_lines=l.count('\n')))
             print "".join(l)
 
     def print_markup(self, markup):
@@ -273,14 +337,14 @@ class ThermalPrinter(object):
         elif type(pixels[0]) in (list, tuple) and len(pixels[0]) == 3: # RGB
             print " => RGB channel"
             for i, p in enumerate(pixels):
-                if sum(p[0:2]) / 3.0 < self.black_threshold:
+                if sum(p[0:3]) / 3.0 < self.black_threshold:
                     black_and_white_pixels[i % w + i / w * 384] = 0
                 else:
                     black_and_white_pixels[i % w + i / w * 384] = 1
         elif type(pixels[0]) in (list, tuple) and len(pixels[0]) == 4: # RGBA
             print " => RGBA channel"
             for i, p in enumerate(pixels):
-                if sum(p[0:2]) / 3.0 < self.black_threshold and p[3] > self.alpha_threshold:
+                if sum(p[0:3]) / 3.0 < self.black_threshold and p[3] > self.alpha_threshold:
                     black_and_white_pixels[i % w + i / w * 384] = 0
                 else:
                     black_and_white_pixels[i % w + i / w * 384] = 1
@@ -292,6 +356,14 @@ class ThermalPrinter(object):
         return black_and_white_pixels
 
 
+    def print_raster(self, rows):
+        """ Print dot rows that are already packed (raster.ROW_BYTES bytes per
+            row, see raster.pack_rows) right where the paper is, without the
+            line feed print_bitmap starts with. """
+        with self.transaction():
+            for chunk in raster.chunks(rows):
+                self._write(chunk, self._head_time(dot_rows=ord(chunk[2])))
+
     def print_bitmap(self, pixels, w, h, output_png=False):
         """ Best to use images that have a pixel width of 384 as this corresponds
             to the printer row width. 
@@ -310,45 +382,37 @@ class ThermalPrinter(object):
                 w, h = i.size
                 p.print_bitmap(data, w, h)
         """
-        counter = 0
-        if output_png:
-            import Image, ImageDraw
-            test_img = Image.new('RGB', (384, h))
-            draw = ImageDraw.Draw(test_img)
+        rows = (pixels[i:i + w] for i in xrange(0, w * h, w))
+        self.print_bitmap_rows(rows, w, output_png)
 
-        self.linefeed()
-        
-        black_and_white_pixels = self.convert_pixel_array_to_binary(pixels, w, h)        
-        print_bytes = []
+    def print_bitmap_rows(self, rows, w, output_png=False):
+        """ Print a bitmap given as an iterator of pixel rows (each a plain list
+            of w pixels, same formats as print_bitmap). Rows are converted one
+            DC2 * chunk at a time in a background thread while the previous
+            chunk is being sent, so long images start printing right away and
+            never have to fit in memory.
+
+            Example code with PIL:
+                import Image
+                i = Image.open("banner.png")
+                p.print_bitmap_rows(raster.image_rows(i), i.size[0])
+        """
+        packed = []
+        chunks = raster.stream_chunks(rows, w, self.black_threshold, self.alpha_threshold)
+        with self.transaction():
+            self.linefeed()
+            for chunk in raster.prefetch(chunks):
+                self._write(chunk, self._head_time(dot_rows=ord(chunk[2])))
+                if output_png:
+                    packed.append(chunk[4:])
 
-        # read the bytes into an array
-        for rowStart in xrange(0, h, 256):
-            chunkHeight = 255 if (h - rowStart) > 255 else h - rowStart
-            print_bytes += (18, 42, chunkHeight, 48)
-            
-            for i in xrange(0, 48 * chunkHeight, 1):
-                # read one byte in
-                byt = 0
-                for xx in xrange(8):
-                    pixel_value = black_and_white_pixels[counter]
-                    counter += 1
-                    # check if this is black
-                    if pixel_value == 0:
-                        byt += 1 << (7 - xx)
-                        if output_png: draw.point((counter % 384, round(counter / 384)), fill=(0, 0, 0))
-                    # it's white
-                    else:
-                        if output_png: draw.point((counter % 384, round(counter / 384)), fill=(255, 255, 255))
-                
-                print_bytes.append(byt)
-        
-        # output the array all at once to the printer
-        # might be better to send while printing when dealing with 
-        # very large arrays...
-        for b in print_bytes:
-            self.printer.write(chr(b))   
-        
         if output_png:
+            import Image
+            rows = ''.join(packed)
+            # PIL's 1 bit mode uses set bits for white, the printer for black
+            invert = ''.join([chr(255 - i) for i in xrange(256)])
+            test_img = Image.fromstring('1', (raster.DOTS, len(rows) / raster.ROW_BYTES),
+                                        rows.translate(invert))
             test_print = open('print-output.png', 'wb')
             test_img.save(test_print, 'PNG')
             print "output saved to %s" % test_print.name
@@ -383,6 +447,7 @@ if __name__ == '__main__':
     p.linefeed()
     p.linefeed()
     p.linefeed()
+    p.flush()
 
 
 '''
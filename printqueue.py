@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from logsetup import Loggers
+
+#==============================================================================#
+#   Bounded print queue between the IRC handler and a slow output
+#==============================================================================#
+#
+#   PrintQueue has the same print_line() as IRCScrollback, so it can be handed
+#   to IRCMain in its place. Lines are queued and printed by a dedicated
+#   writer thread, so reading from the IRC socket never waits on paper.
+#
+#   When the queue is full one of the overflow policies kicks in:
+#     'block'       - the caller waits until there is room again
+#     'drop-oldest' - the oldest queued line is thrown away
+#     'coalesce'    - the new line is merged into the newest queued line,
+#                     repeats of the same line just bump a counter. A merged
+#                     line grows up to merge_limit characters, past that the
+#                     oldest line is dropped to make room for the new one
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+# characters a coalesced line may grow to
+MERGE_LIMIT = 512
+
+
+class _Entry(object):
+    __slots__ = ('text', 'timestamp', 'highlight', 'queued', 'event', 'repeats', 'lines')
+
+    def __init__(self, text, timestamp, highlight, queued, event=None):
+        self.text = text
+        self.timestamp = timestamp
+        self.highlight = highlight
+        self.queued = queued
+        # the events.Privmsg etc. the line is for, None once lines are merged
+        self.event = event
+        self.repeats = 1
+        # lines merged into this one, repeats included
+        self.lines = 1
+
+    def render(self):
+        if self.repeats > 1:
+            return '%s (x%d)' % (self.text, self.repeats)
+        return self.text
+
+
+class PrintQueue(object):
+    log = Loggers('IRCTerm.PrintQueue')
+
+    def __init__(self, output, maxsize=64, policy=COALESCE, name=None, merge_limit=MERGE_LIMIT):
+        if policy not in POLICIES:
+            raise ValueError('Unknown overflow policy %r, choose from %s' % (policy, POLICIES))
+        self.output = output
+        self.maxsize = maxsize
+        self.policy = policy
+        self.merge_limit = merge_limit
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # metrics, see stats(). printed counts print jobs, which can hold
+        # several coalesced lines
+        self.enqueued = 0
+        self.printed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        self._started = time.time()
+
+        self._thread = threading.Thread(target=self._run, name='PrintQueue' + (' ' + name if name else ''))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        '''Queue a line for printing. The timestamp is taken now, not when
+        the line finally reaches the paper.'''
+        if timestamp is True:
+            timestamp = datetime.now()
+        entry = _Entry(text, timestamp, highlight, time.time(), event)
+        with self._cond:
+            if self._closed:
+                raise ValueError('print_line on a closed PrintQueue')
+            self.enqueued += 1
+            if len(self._queue) >= self.maxsize:
+                if self.policy == BLOCK:
+                    while len(self._queue) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        self.dropped += 1
+                        raise ValueError('PrintQueue closed while print_line waited for room')
+                else:
+                    last = self._queue[-1]
+                    if self.policy == COALESCE:
+                        if last.text == text and last.highlight == highlight:
+                            last.repeats += 1
+                            last.lines += 1
+                            self.coalesced += 1
+                            return
+                        merged = '%s | %s' % (last.render(), text)
+                        if len(merged) <= self.merge_limit:
+                            last.text = merged
+                            last.repeats = 1
+                            last.highlight = last.highlight or highlight
+                            last.event = None
+                            last.lines += 1
+                            self.coalesced += 1
+                            return
+                    dropped = self._queue.popleft()
+                    self.dropped += dropped.lines
+                    self.log.print_line.warn('Queue full, dropped: %s', dropped.text)
+            self._queue.append(entry)
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify_all()
+
+    def _run(self):
+        logger = logging.getLogger('IRCTerm.PrintQueue.writer')
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                entry = self._queue.popleft()
+                self._cond.notify_all()
+            try:
+                self.output.print_line(entry.render(), entry.timestamp, entry.highlight, entry.event)
+            except Exception:
+                logger.exception('Printing failed: %s', entry.text)
+            latency = time.time() - entry.queued
+            with self._cond:
+                self.printed += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self._total_latency += latency
+
+    def depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self):
+        '''Queue depth, per-line latency (enqueue to printed, in seconds) and
+        throughput (print jobs per second since the queue was made).'''
+        with self._cond:
+            return {'throughput': self.printed / max(time.time() - self._started, 1e-9),
+                    'depth': len(self._queue),
+                    'max_depth': self.max_depth,
+                    'enqueued': self.enqueued,
+                    'printed': self.printed,
+                    'dropped': self.dropped,
+                    'coalesced': self.coalesced,
+                    'last_latency': self.last_latency,
+                    'max_latency': self.max_latency,
+                    'avg_latency': self._total_latency / self.printed if self.printed else 0.0}
+
+    def close(self, timeout=None):
+        '''Stop accepting lines and wait for the queued ones to be printed.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+
+class FanOut(object):
+    '''Hands every line to several outputs, e.g. a PrintQueue and a VFDTail.
+    Each output is expected to return quickly and do its own I/O elsewhere,
+    so one slow device never holds up the others.'''
+
+    def __init__(self, *outputs):
+        self.outputs = outputs
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        if timestamp is True:
+            timestamp = datetime.now()
+        for output in self.outputs:
+            output.print_line(text, timestamp, highlight, event)
+
+    def membership(self, kind, event, chan, text, reason=None):
+        '''Pass join/part/quit/mode events on to outputs that batch them,
+        the others print text with the time the event was received.'''
+        for output in self.outputs:
+            membership = getattr(output, 'membership', None)
+            if membership is not None:
+                membership(kind, event, chan, text, reason)
+            else:
+                output.print_line(text, event.timestamp())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import binascii
+import threading
+import Queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#==============================================================================#
+#   Batched bitmap rasterizer for the thermal printer
+#==============================================================================#
+#
+#   Turns pixel data into the printer's 1bpp raster format a whole row at a
+#   time instead of one pixel at a time. Each dot row is 384 dots wide, packed
+#   MSB first into 48 bytes, with a set bit meaning a black dot. Rows are sent
+#   in chunks of at most 255 rows, each preceded by "DC2 * r n".
+#
+#   Uses NumPy when it is installed, otherwise falls back to str.translate()
+#   thresholding and int(bits, 2) packing, which is still a lot faster than
+#   the per-pixel loops it replaces.
+#
+#   stream_chunks() does the same for an iterator of pixel rows, converting
+#   one chunk at a time so memory stays bounded for long receipts, and
+#   prefetch() lets the next chunk be converted while the current one is
+#   still going out over the serial port.
+
+DOTS = 384              # dots per printed row
+ROW_BYTES = DOTS / 8    # bytes per printed row
+CHUNK_ROWS = 255        # max rows per DC2 * command
+
+
+def _threshold_table(black_threshold):
+    # maps a byte value to '1' (black) or '0' (white)
+    return ''.join(['1' if v < black_threshold else '0' for v in xrange(256)])
+
+
+def _channels(pixels):
+    """ Number of channels in a plain pixel list: 1, 3 (RGB) or 4 (RGBA). """
+    p = pixels[0]
+    if isinstance(p, (int, long)):
+        return 1
+    if isinstance(p, (list, tuple)) and len(p) in (3, 4):
+        return len(p)
+    raise ValueError("Unsupported pixels array type %s (%r). Please send plain "
+                     "list (single channel, RGB or RGBA)" % (type(p), p))
+
+
+def _luminance(pixels, channels, alpha_threshold):
+    """ Collapse pixels to a bytearray of single channel values. Pixels that
+        are too transparent come out white. """
+    if channels == 1:
+        return bytearray(pixels)
+    if channels == 3:
+        return bytearray([(r + g + b) / 3 for r, g, b in pixels])
+    return bytearray([(r + g + b) / 3 if a > alpha_threshold else 255
+                      for r, g, b, a in pixels])
+
+
+def _pack_rows_numpy(pixels, w, h, channels, black_threshold, alpha_threshold):
+    a = numpy.asarray(pixels, dtype=numpy.uint16)
+    if channels == 1:
+        black = a.reshape(h, w) < black_threshold
+    else:
+        a = a.reshape(h, w, channels)
+        # (r+g+b)/3 < t is the same test as r+g+b < 3t
+        black = a[:, :, :3].sum(axis=2) < 3 * black_threshold
+        if channels == 4:
+            black &= a[:, :, 3] > alpha_threshold
+    if w < DOTS:
+        black = numpy.hstack((black, numpy.zeros((h, DOTS - w), dtype=bool)))
+    return numpy.packbits(black, axis=1).tobytes()
+
+
+def _pack_rows_python(pixels, w, h, channels, black_threshold, alpha_threshold):
+    bits = str(_luminance(pixels, channels, alpha_threshold)).translate(
+        _threshold_table(black_threshold))
+    pad = '0' * (DOTS - w)
+    fmt = '%%0%dx' % (ROW_BYTES * 2)
+    unhexlify = binascii.unhexlify
+    return ''.join([unhexlify(fmt % int(bits[i:i + w] + pad, 2))
+                    for i in xrange(0, w * h, w)])
+
+
+def pack_rows(pixels, w, h, black_threshold=48, alpha_threshold=127):
+    """ Threshold a plain pixel list (single channel, RGB or RGBA, values
+        0-255) and pack it into h rows of ROW_BYTES bytes each, padding every
+        row to DOTS with white. Returns a str of h * ROW_BYTES bytes. """
+    if w > DOTS:
+        raise ValueError("Bitmap width too large: %s. Needs to be under %s" % (w, DOTS))
+    if not h:
+        return ''
+    channels = _channels(pixels)
+    if numpy is not None:
+        return _pack_rows_numpy(pixels, w, h, channels, black_threshold, alpha_threshold)
+    return _pack_rows_python(pixels, w, h, channels, black_threshold, alpha_threshold)
+
+
+def _chunk(data):
+    return chr(18) + chr(42) + chr(len(data) / ROW_BYTES) + chr(ROW_BYTES) + data
+
+
+def chunks(rows):
+    """ Split packed rows into printer commands, yielding one str per DC2 *
+        chunk of up to CHUNK_ROWS rows with its header prepended. """
+    step = CHUNK_ROWS * ROW_BYTES
+    for start in xrange(0, len(rows), step):
+        yield _chunk(rows[start:start + step])
+
+
+def stream_chunks(rows, w, black_threshold=48, alpha_threshold=127,
+                  chunk_rows=CHUNK_ROWS):
+    """ Like chunks(pack_rows(...)) but for an iterable of pixel rows (each a
+        plain list of w pixels). Only chunk_rows rows are held in memory and
+        every chunk is yielded as soon as its last row has arrived. """
+    if w > DOTS:
+        raise ValueError("Bitmap width too large: %s. Needs to be under %s" % (w, DOTS))
+    chunk_rows = min(chunk_rows, CHUNK_ROWS)
+    batch = []
+    count = 0
+    for row in rows:
+        batch.extend(row)
+        count += 1
+        if count == chunk_rows:
+            yield _chunk(pack_rows(batch, w, count, black_threshold, alpha_threshold))
+            batch = []
+            count = 0
+    if count:
+        yield _chunk(pack_rows(batch, w, count, black_threshold, alpha_threshold))
+
+
+def image_rows(image, strip_height=32):
+    """ Read a PIL image strip by strip, yielding one pixel row at a time.
+        Convert palette images first, e.g. image.convert('L'). """
+    w, h = image.size
+    for top in xrange(0, h, strip_height):
+        strip = list(image.crop((0, top, w, min(top + strip_height, h))).getdata())
+        for i in xrange(0, len(strip), w):
+            yield strip[i:i + w]
+
+
+def prefetch(iterable, depth=1, timeout=0.1):
+    """ Run iterable in a background thread, keeping up to depth items ready
+        ahead of the consumer. Exceptions are re-raised in the consumer. If
+        the consumer stops early the thread notices within timeout seconds
+        and stops too. """
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=timeout)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception, e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, name='raster.prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
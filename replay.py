@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import ast
+import json
+import os
+import random
+import re
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+import cp437
+import ircterm
+import logsetup
+import noritake
+import router
+import sinks
+from digest import Digest
+from ircclient import Loop, decode, parse_line, event_name
+from pacing import Pacer
+from printer import ThermalPrinter
+from vfdtail import VFDTail
+from virtualprinter import VirtualPrinter
+from virtualvfd import VirtualVFD
+
+#==============================================================================#
+#   Replay recorded or synthetic IRC traffic through the whole output path
+#==============================================================================#
+#
+#   Usage: python replay.py [options] [irc.log | -p profile ...]
+#
+#   Events go through IRCHandler and the routes of a router.Router into
+#   outputs made by a sinks.Dispatcher, the same wiring as ircterm's
+#   __main__: Digest, PrintQueue and IRCScrollback into a
+#   virtualprinter.VirtualPrinter, and PrintQueue and VFDTail into a
+#   noritake.Screen on a virtualvfd.VirtualVFD with the bus timing ircterm
+#   uses. The routes come from --config, ircterm's single channel default
+#   without one, and the events go to its first network. Nothing needs the
+#   hardware.
+#
+#   Events are (seconds, handler method, args) with args as the handler gets
+#   them, prefix first. They come from raw IRC lines (':nick!u@h PRIVMSG #c
+#   :hi'), from the IRCHandler debug lines and UNHANDLED entries in an
+#   irc.log, plain or JSON lines (the debug lines are only there when it ran
+#   with IRCTERM_LOG=INFO,IRCTerm.IRCHandler=DEBUG), or from one of the
+#   PROFILES.
+#
+#   The report has messages per second, the time the handler took for each
+#   (p50/p99), input to output latency (until the bytes were written to the
+#   port, and until the modelled printer has them on paper), bytes written
+#   per message and the time spent in each stage.
+#   Stage times are wall clock spent inside that stage, so stages running in
+#   different threads overlap; cpu is what the whole process used. serial
+#   includes the VirtualPrinter parsing what it is sent. At --speed 0 the
+#   Digest sees every profile as a flood, use --no-digest to time the plain
+#   path.
+
+#----------------------------------------------------------------------#
+#   Event sources
+#----------------------------------------------------------------------#
+
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - (\S+) - \w+ - (.*)$')
+
+# IRCHandler debug messages -> (handler method, args in handler order)
+LOG_EVENTS = [
+    (re.compile(r'^PRIVMSG from (\S+) in (\S+): (.*)$'), 'privmsg', lambda m: m.groups()),
+    (re.compile(r'^NOTICE from (\S+) to (\S+): (.*)$'), 'notice', lambda m: m.groups()),
+    (re.compile(r'^JOIN of (\S+) to (\S+)$'), 'join', lambda m: m.groups()),
+    (re.compile(r'^PART of (\S+) from (\S+): (.*)$'), 'part', lambda m: m.groups()),
+    (re.compile(r'^QUIT of (\S+) from (.*)$'), 'quit', lambda m: m.groups()),
+    (re.compile(r'^MODE by (\S+) to (\S+) in (\S+): (.*)$'), 'mode',
+     lambda m: (m.group(1), m.group(2), m.group(4)) if m.group(3) == 'none'
+               else (m.group(1), m.group(3), m.group(4), m.group(2))),
+]
+
+
+def raw_event(line, seconds=0.0):
+    '''Event for a raw IRC protocol line.'''
+    prefix, command, args = parse_line(line)
+    return (seconds, event_name(command), (prefix,) + tuple(args))
+
+
+def _log_entry(line):
+    '''(seconds, logger name, message) of a plain or JSON log line, or None.'''
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+            stamp, fraction = (entry['time'].split('.') + ['0'])[:2]
+            stamp = datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S')
+            return (time.mktime(stamp.timetuple()) + float('0.' + fraction),
+                    entry['logger'], entry['message'])
+        except (ValueError, KeyError):
+            return None
+    m = LOG_LINE.match(line)
+    if m is None:
+        return None
+    stamp = datetime.strptime(m.group(1), '%Y-%m-%d %H:%M:%S')
+    return (time.mktime(stamp.timetuple()) + int(m.group(2)) / 1000.0, m.group(3), m.group(4))
+
+
+def read_log(lines):
+    '''Events from irc.log lines or raw IRC lines, in file order.'''
+    events = []
+    start = None
+    for line in lines:
+        line = decode(line.rstrip('\r\n'))
+        if not line:
+            continue
+        entry = _log_entry(line)
+        if entry is None:
+            if line.startswith(':') or line.split(' ', 1)[0].isupper():
+                events.append(raw_event(line, events[-1][0] if events else 0.0))
+            continue
+        seconds, name, message = entry
+        if start is None:
+            start = seconds
+        if message.startswith('UNHANDLED: '):
+            try:
+                args = ast.literal_eval(message[len('UNHANDLED: '):])
+            except (ValueError, SyntaxError):
+                continue
+            events.append((seconds - start, args[0], tuple(args[1:])))
+            continue
+        if not name.startswith('IRCTerm.IRCHandler.'):
+            continue
+        for pattern, method, args in LOG_EVENTS:
+            m = pattern.match(message)
+            if m is not None:
+                events.append((seconds - start, method, tuple(args(m))))
+                break
+    return events
+
+
+NICKS = ['agmlego', 'nate', 'kirk', 'mmm', 'jeff', 'hexapod', 'lasercat', 'drill_press']
+WORDS = (u'the laser cutter is free again anyone seen 3/8" drill bits in drawer under '
+         u'lathe stuff sign top left who wants coffee pizza meeting tonight at 8 '
+         u'CNC router broke z axis stepper soldering station café ünïcödé').split()
+
+
+def _nick(rng, nick=None):
+    nick = nick or rng.choice(NICKS)
+    return '%s!~%s@%s.example.net' % (nick, nick, nick)
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in xrange(words))
+
+
+def chatter(seconds=120, rate=0.5, channel='#i3detroit', seed=1):
+    '''Steady conversation, the odd highlight and a join now and then.'''
+    rng = random.Random(seed)
+    events = []
+    t = 0.0
+    while t < seconds:
+        t += rng.expovariate(rate)
+        if rng.random() < 0.05:
+            events.append((t, 'join', (_nick(rng), channel)))
+            continue
+        text = _sentence(rng, rng.randint(2, 25))
+        if rng.random() < 0.05:
+            text = 'i3ircterm: ' + text
+        events.append((t, 'privmsg', (_nick(rng), channel, text)))
+    return events
+
+
+def netsplit(users=300, seconds=2.0, channel='#i3detroit', seed=2):
+    '''A netsplit: users quitting within a couple of seconds, chatter
+    carrying on, then everyone joining back.'''
+    rng = random.Random(seed)
+    names = ['user%03d' % i for i in xrange(users)]
+    events = []
+    for i, name in enumerate(names):
+        events.append((seconds * i / users, 'quit', (_nick(rng, name), 'hub.example.net leaf.example.net')))
+        if i % 25 == 0:
+            events.append((seconds * i / users, 'privmsg', (_nick(rng), channel, 'uh oh, split')))
+    for i, name in enumerate(names):
+        events.append((30 + seconds * i / users, 'join', (_nick(rng, name), channel)))
+    return events
+
+
+def flood(seconds=30, rate=20, channel='#i3detroit', seed=3):
+    '''A bot pasting long lines as fast as the server lets it.'''
+    rng = random.Random(seed)
+    return [(float(i) / rate, 'privmsg',
+             (_nick(rng, 'spambot'), channel, '[%d] %s' % (i, _sentence(rng, 40))))
+            for i in xrange(int(seconds * rate))]
+
+
+PROFILES = {'chatter': chatter, 'netsplit': netsplit, 'flood': flood}
+
+#----------------------------------------------------------------------#
+#   Instrumentation
+#----------------------------------------------------------------------#
+
+
+class Stages(object):
+    '''Calls and wall clock seconds per stage.'''
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.time() - start
+                self.calls[name] += 1
+        return timed
+
+
+class Probe(object):
+    '''Sits between IRCHandler and the outputs and notes when each line
+    came in, so it can be matched up when the printer is done with it.'''
+
+    def __init__(self, output):
+        self.output = output
+        self.started = defaultdict(deque)
+        if hasattr(output, 'membership'):
+            self.membership = output.membership
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        self.started[text].append(time.time())
+        self.output.print_line(text, timestamp, highlight, event)
+
+    def done(self, text):
+        '''When text came in, None for lines made up along the way.'''
+        started = self.started.get(text)
+        return started.popleft() if started else None
+
+
+class _Client(object):
+    def __init__(self, nick):
+        self.nick = nick
+        self.received = None
+
+    def send(self, *args):
+        pass
+
+
+class _Network(object):
+    '''Takes the place of ircterm.IRCMain for the Router: the handler
+    IRCMain would connect, with the same printer and routes, on a client
+    that sends nothing.'''
+
+    def __init__(self, nick='i3ircterm', printer=None, store=None, routes=None, **kwargs):
+        self.handler = ircterm.IRCHandler(_Client(nick))
+        self.handler.printer = printer
+        self.handler.store = store
+        self.handler.routes = routes or {}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+#----------------------------------------------------------------------#
+#   The replay
+#----------------------------------------------------------------------#
+
+
+class Replay(object):
+    '''Replays events through the output path. speed is how many times
+    faster than recorded to go, 0 for as fast as possible. paced keeps the
+    printer's Pacer, so writes wait on the modelled printer in real time.
+    config is a router config, read_config()'s default when None.'''
+
+    # stands in for the IRCScrollback as the Dispatcher's printer sink
+    QUEUE = ircterm.IRCScrollback.QUEUE
+    POLICY = ircterm.IRCScrollback.POLICY
+    MERGE_LIMIT = ircterm.IRCScrollback.MERGE_LIMIT
+
+    def __init__(self, events, speed=0, paced=False, vfd=True, digest=True, config=None):
+        self.events = sorted(events, key=lambda e: e[0])
+        self.speed = speed
+        self.stages = Stages()
+
+        self.port = VirtualPrinter()
+        self.port.write = self.stages.wrap('serial', self.port.write)
+        self.scrollback = ircterm.IRCScrollback(self.port)
+        if not paced:
+            self.scrollback.printer.pacer = None
+        # wrap() and fill() go through spans() too, as does ircformat.wrap()
+        self.scrollback.wrapper.spans = self.stages.wrap('wrap', self.scrollback.wrapper.spans)
+
+        self.loop = Loop()
+        available = {'printer': self}
+        self.tail = None
+        if vfd:
+            self.vfd = VirtualVFD()
+            screen = noritake.Screen(backend=noritake.MmapBackend(regs=self.vfd, timing='auto'))
+            self.tail = VFDTail(screen)
+            self.tail.framebuffer.flush = self.stages.wrap('vfd', self.tail.framebuffer.flush)
+            available['vfd'] = self.tail
+        self.dispatcher = sinks.Dispatcher(available)
+        outputs = dict(self.dispatcher.outputs)
+        self.digest = None
+        if digest:
+            pacer = Pacer(ThermalPrinter.BAUDRATE)
+            capacity = pacer.lines_per_second(ThermalPrinter.FONT_B_HEIGHT)
+            outputs['printer'] = self.digest = Digest(outputs['printer'], self.loop, capacity)
+        outputs['printer'] = self.probe = Probe(outputs['printer'])
+
+        if config is None:
+            config = router.read_config(None)
+        self.router = router.Router(config, outputs, self.loop, main=_Network)
+        self.handler = self.router.networks[0].handler
+
+        self.printed = 0
+        self.handler_latency = []
+        self.latency = []
+        self.paper_latency = []
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        '''PrintQueue output, timing the scrollback.'''
+        start = time.time()
+        self.scrollback.print_line(text, timestamp, highlight, event)
+        done = time.time()
+        self.stages.seconds['print'] += done - start
+        self.stages.calls['print'] += 1
+        self.printed += 1
+        started = self.probe.done(text)
+        if started is not None:
+            self.latency.append(done - started)
+            self.paper_latency.append(max(done, self.port.busy_until) - started)
+
+    def _dispatch(self, method, args):
+        handler = getattr(self.handler, method, None)
+        # as if the line had just come off the socket
+        start = self.handler.client.received = time.time()
+        try:
+            if callable(handler):
+                handler(*args)
+            else:
+                self.handler.__unhandled__(method, *args)
+        finally:
+            took = time.time() - start
+            self.stages.seconds['handler'] += took
+            self.stages.calls['handler'] += 1
+            self.handler_latency.append(took)
+
+    def _step(self):
+        now = time.time()
+        while self._next < len(self.events):
+            seconds, method, args = self.events[self._next]
+            if self.speed:
+                delay = self._start + seconds / self.speed - now
+                if delay > 0:
+                    self.loop.call_later(delay, self._step)
+                    return
+            self._next += 1
+            self._dispatch(method, args)
+            if not self.speed:
+                # let timers run between events
+                self.loop.call_later(0, self._step)
+                return
+        if self.digest is not None:
+            self.digest.flush()
+        self.loop.stop()
+
+    def run(self):
+        encode = cp437.encode
+        cp437.encode = self.stages.wrap('encode', encode)
+        try:
+            cpu = os.times()
+            self._start = time.time()
+            self._next = 0
+            self.loop.call_later(0, self._step)
+            self.loop.run_forever()
+            self.dispatcher.close()
+            self.wall = time.time() - self._start
+            cpu_end = os.times()
+            self.cpu = cpu_end[0] + cpu_end[1] - cpu[0] - cpu[1]
+        finally:
+            cp437.encode = encode
+        return self
+
+    def report(self):
+        n = len(self.events)
+        rows = [('messages', '%d in %.3f s, %.1f/s' % (n, self.wall, n / self.wall)),
+                ('printed lines', '%d, %d timed' % (self.printed, len(self.latency))),
+                ('handler latency', 'p50 %.3f ms  p99 %.3f ms' % (
+                    percentile(self.handler_latency, 50) * 1000,
+                    percentile(self.handler_latency, 99) * 1000)),
+                ('latency to port', 'p50 %.1f ms  p99 %.1f ms' % (percentile(self.latency, 50) * 1000,
+                                                                 percentile(self.latency, 99) * 1000)),
+                ('latency to paper', 'p50 %.2f s  p99 %.2f s' % (percentile(self.paper_latency, 50),
+                                                                percentile(self.paper_latency, 99))),
+                ('bytes/message', '%.1f (%d bytes)' % (float(self.port.bytes) / max(n, 1), self.port.bytes)),
+                ('cpu', '%.3f s, %.1f us/message' % (self.cpu, self.cpu / max(n, 1) * 1e6))]
+        for stage in ('handler', 'print', 'wrap', 'encode', 'serial', 'vfd'):
+            if self.stages.calls[stage]:
+                rows.append(('  ' + stage, '%8.1f ms  %6d calls  %7.1f us/call' % (
+                    self.stages.seconds[stage] * 1000, self.stages.calls[stage],
+                    self.stages.seconds[stage] / self.stages.calls[stage] * 1e6)))
+        if self.tail is not None:
+            rows.append(('vfd bytes', '%d, %d timing violations' % (len(self.vfd.received),
+                                                                     len(self.vfd.violations))))
+        for name, value in rows:
+            print '%-20s %s' % (name, value)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay IRC traffic through the printer and VFD paths.')
+    parser.add_argument('logs', nargs='*', help='irc.log files or raw IRC lines')
+    parser.add_argument('-p', '--profile', action='append', choices=sorted(PROFILES), default=[],
+                        help='synthetic traffic to replay, can be repeated')
+    parser.add_argument('-s', '--speed', type=float, default=0,
+                        help='times faster than recorded, 0 (default) for as fast as possible')
+    parser.add_argument('--paced', action='store_true', help='wait on the modelled printer like the real one')
+    parser.add_argument('--no-vfd', dest='vfd', action='store_false')
+    parser.add_argument('--no-digest', dest='digest', action='store_false')
+    parser.add_argument('--config', help='route as this ircterm config does')
+    parser.add_argument('--png', help='save the printed paper here')
+    parser.add_argument('--log', help='log to the console at these levels while replaying, '
+                                      'e.g. INFO,IRCTerm.IRCHandler=DEBUG')
+    args = parser.parse_args()
+    if args.log:
+        logsetup.setup(args.log, logfile=None)
+    config = router.read_config(args.config) if args.config else None
+
+    sources = [(path, read_log(open(path))) for path in args.logs]
+    sources += [(name, PROFILES[name]()) for name in args.profile]
+    if not sources:
+        sources = [(name, PROFILES[name]()) for name in sorted(PROFILES)]
+    for name, events in sources:
+        print '== %s' % name
+        replay = Replay(events, args.speed, args.paced, args.vfd, args.digest, config).run()
+        replay.report()
+        if args.png:
+            root, ext = os.path.splitext(args.png)
+            path = args.png if len(sources) == 1 else '%s-%s%s' % (root, os.path.basename(name), ext)
+            print 'paper saved to %s' % replay.port.save(path)
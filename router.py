@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import os
+import re
+from ConfigParser import SafeConfigParser
+from StringIO import StringIO
+
+from logsetup import Loggers
+from printqueue import FanOut
+from rules import Rules, NORMAL, HIGHLIGHT, SUPPRESS
+
+#==============================================================================#
+#   Several channels and networks, routed to the outputs
+#==============================================================================#
+#
+#   The networks and channels to follow come from a config file:
+#
+#       [network freenode]
+#       server = irc.freenode.net
+#       nick = i3ircterm
+#       channels = #i3detroit #i3detroit-infra
+#
+#       [channel freenode #i3detroit-infra]
+#       print = vfd
+#       highlight = printer vfd
+#       ignore = buildbot
+#       highlight_words = door, laser cutter
+#       log_regex = ^\[jenkins\]
+#
+#   Every network gets an IRCMain, all of them on the same Loop. Where the
+#   lines of a channel go is looked up from the channel section, then its
+#   network section, then [defaults]:
+#
+#       print       outputs for ordinary lines: printer, vfd, log, console
+#                   and/or web
+#       highlight   outputs for lines that mention us
+#       events      yes/no, print joins, parts, quits and mode changes
+#       tag         put in front of the channel's lines, the channel name by
+#                   default when following more than one channel
+#
+#   and which messages get highlighted, dropped or sent to a single output
+#   is up to rules (see rules.py), collected from all three sections:
+#
+#       <action>_words  keywords, comma separated
+#       <action>_regex  regular expressions, one per line
+#       <action>_nicks  nicks the messages are from
+#       ignore          same as suppress_nicks
+#
+#   with the action one of highlight, suppress or an output. The
+#   rules are compiled when the config is loaded, routes with the same
+#   rules share them.
+#
+#   The network section's route takes private messages, notices and quits.
+#   'log' only writes the line to the IRCTerm.Router.log logger, 'console'
+#   to stdout and 'web' to the page sinks.WebSink serves, and every line
+#   still goes to the scrollback store.
+#
+#   Routes are worked out once: each handler gets a dict from the lowercased
+#   channel name to a Route holding a FanOut per output set, so a message
+#   costs one dict lookup. Routes with the same outputs share the FanOut,
+#   and the outputs themselves (the PrintQueue of each sink, see sinks.py,
+#   with a Digest in front of the printer's) are shared by all connections.
+#   They are only called from the loop thread, so they need no locking;
+#   each PrintQueue hands the lines to its sink's writer thread.
+
+CONFIG = 'ircterm.conf'
+
+# used when there is no config file, what ircterm did before
+DEFAULT_CONFIG = '''
+[network freenode]
+server = irc.freenode.net
+port = 6667
+nick = i3ircterm
+user = i3ircterm
+realname = IRC Terminal at i3Detroit
+channels = #i3detroit
+'''
+
+ROUTING = {'print': 'printer vfd',
+           'highlight': 'printer vfd',
+           'events': 'yes',
+           'tag': None}
+
+OUTPUTS = ('printer', 'vfd', 'log', 'console', 'web')
+ACTIONS = (SUPPRESS, HIGHLIGHT) + OUTPUTS
+
+
+class Route(object):
+    '''Where the lines of one channel go, and the rules for its messages.'''
+    # these run for every message, keep the loggers around
+    log = Loggers('IRCTerm.Route')
+
+    def __init__(self, outputs, highlights, rules, events=True, tag='', only=None):
+        '''only maps output names to a FanOut of just that output, for the
+        rules sending messages to a single output.'''
+        self.outputs = outputs
+        self.highlights = highlights
+        self.rules = rules
+        self.events = events
+        self.tag = tag
+        self.targets = {NORMAL: outputs, HIGHLIGHT: highlights, SUPPRESS: None}
+        self.targets.update(only or {})
+
+    def print_line(self, text, timestamp=True, highlight=False, action=None, event=None):
+        '''Print a line, on the outputs for action (one of the rules'
+        actions) if given.'''
+        if action is None:
+            action = HIGHLIGHT if highlight else NORMAL
+        target = self.targets[action]
+        if target is None:
+            self.log.print_line.debug('Suppressed: %s', text)
+            return
+        if self.tag:
+            text = self.tag + text
+        target.print_line(text, timestamp, highlight, event)
+
+    def membership(self, kind, event, chan, text, reason=None):
+        if self.events:
+            self.outputs.membership(kind, event, chan, text, reason)
+
+
+def read_config(path=CONFIG):
+    '''The config at path, the single channel default when it doesn't exist.'''
+    config = SafeConfigParser()
+    if path is not None and os.path.exists(path):
+        config.read(path)
+    else:
+        config.readfp(StringIO(DEFAULT_CONFIG))
+    return config
+
+
+class Router(object):
+
+    def __init__(self, config, outputs, loop, store=None, main=None):
+        '''Set up an IRCMain for every network in config (a ConfigParser),
+        with outputs a dict of output name to output, the queued ones
+        sinks.Dispatcher makes.'''
+        if main is None:
+            from ircterm import IRCMain as main
+        self.config = config
+        self.outputs = dict(outputs)
+        self._fanouts = {}
+        self._rules = {}
+        self._sections = dict((section.lower(), section) for section in config.sections())
+
+        networks = [s.split(None, 1)[1] for s in config.sections() if s.startswith('network ')]
+        if not networks:
+            raise ValueError('No [network ...] sections in the config')
+        channels = dict((network, self._get(['network ' + network], 'channels', '').split())
+                        for network in networks)
+        many = sum(len(c) for c in channels.itervalues()) > 1
+
+        self.networks = []
+        for network in networks:
+            section = 'network ' + network
+            routes = {}
+            for chan in channels[network]:
+                tag = self._get(['channel %s %s' % (network, chan), section], 'tag')
+                if tag is None:
+                    tag = chan if many else ''
+                tag = tag + ' ' if tag else ''
+                routes[chan.lower()] = self._route(['channel %s %s' % (network, chan), section], tag)
+            get = lambda key, default=None: self._get([section], key, default)
+            irc = main(server=get('server'), port=int(get('port', '6667')),
+                       channel=channels[network], nick=get('nick', 'i3ircterm'),
+                       realname=get('realname', 'IRC Terminal at i3Detroit'),
+                       user=get('user', get('nick', 'i3ircterm')), password=get('password'),
+                       printer=self._route([section], ''), loop=loop, store=store,
+                       routes=routes)
+            self.networks.append(irc)
+
+    def _value(self, section, key):
+        '''The value for key in section, as unicode like the IRC lines it is
+        matched against.'''
+        value = self.config.get(section, key)
+        try:
+            return value if isinstance(value, unicode) else value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError('%s in [%s] is not UTF-8' % (key, section))
+
+    def _all(self, sections, key):
+        '''The values for key in all the sections that have it.'''
+        values = []
+        for section in sections + ['defaults']:
+            section = self._sections.get(section.lower())
+            if section is not None and self.config.has_option(section, key):
+                values.append(self._value(section, key))
+        return values
+
+    def _get(self, sections, key, default=None):
+        for section in sections + ['defaults']:
+            # channel names are case-insensitive
+            section = self._sections.get(section.lower())
+            if section is not None and self.config.has_option(section, key):
+                return self._value(section, key)
+        return ROUTING.get(key, default)
+
+    def _fanout(self, names):
+        names = tuple(names.split())
+        if names not in self._fanouts:
+            for name in names:
+                if name not in OUTPUTS:
+                    raise ValueError('Unknown output %r, use %s' % (name, ', '.join(OUTPUTS)))
+                if name not in self.outputs:
+                    logger = logging.getLogger('IRCTerm.Router')
+                    logger.warn('No %s output, not sending lines there', name)
+            self._fanouts[names] = FanOut(*[self.outputs[name] for name in names
+                                            if name in self.outputs])
+        return self._fanouts[names]
+
+    def _compile(self, sections):
+        keywords, regexes, nicks = [], [], []
+        for action in ACTIONS:
+            for value in self._all(sections, action + '_words'):
+                keywords.extend((word.strip(), action) for word in value.split(',') if word.strip())
+            for value in self._all(sections, action + '_regex'):
+                regexes.extend((line.strip(), action) for line in value.splitlines() if line.strip())
+            for value in self._all(sections, action + '_nicks'):
+                nicks.extend((nick, action) for nick in re.split(r'[\s,]+', value) if nick)
+        for value in self._all(sections, 'ignore'):
+            nicks.extend((nick, SUPPRESS) for nick in re.split(r'[\s,]+', value) if nick)
+
+        key = (tuple(keywords), tuple(regexes), tuple(nicks))
+        if key not in self._rules:
+            try:
+                used = set(action for pattern, action in keywords + regexes + nicks)
+                self._rules[key] = Rules(keywords, regexes, nicks,
+                                         [output for output in OUTPUTS if output in used])
+            except re.error as e:
+                raise ValueError('Bad regular expression in [%s]: %s' % (sections[0], e))
+        return self._rules[key]
+
+    def _route(self, sections, tag):
+        events = self._get(sections, 'events').strip().lower()
+        if events not in ('yes', 'no', 'true', 'false', 'on', 'off', '1', '0'):
+            raise ValueError('events should be yes or no, not %r' % events)
+        rules = self._compile(sections)
+        only = dict((action, self._fanout(action)) for action in rules.actions if action in OUTPUTS)
+        return Route(self._fanout(self._get(sections, 'print')),
+                     self._fanout(self._get(sections, 'highlight')),
+                     rules, events in ('yes', 'true', 'on', '1'), tag, only)
+
+    def connect(self):
+        for irc in self.networks:
+            irc.connect()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import re
+import sre_constants
+import sre_parse
+
+#==============================================================================#
+#   Highlight and filter rules
+#==============================================================================#
+#
+#   Rules decides what happens to a message: printed as usual (NORMAL),
+#   highlighted (HIGHLIGHT), dropped (SUPPRESS) or sent only to one of the
+#   outputs (its name, e.g. 'vfd'). A rule is a keyword, a regular
+#   expression or a nick, with the action it asks for. When several match,
+#   SUPPRESS wins over HIGHLIGHT, which wins over the outputs, in the order
+#   they were given.
+#
+#   Everything is compiled once:
+#
+#   - keywords go into one Aho-Corasick automaton, with the failure links
+#     folded into the transitions, so matching all of them is one dict
+#     lookup per character of the message however many there are. Keywords
+#     are case-insensitive and only match as whole words (where they start
+#     or end with a letter or digit), so 'nate' doesn't fire on 'senate'.
+#   - a regular expression that starts with some literal text (after
+#     anchors like ^ or \b) only runs when the automaton saw that text.
+#     The others are joined into a single one for each action. Either way
+#     they are only tried for actions that would win over what already
+#     matched.
+#   - nicks are a dict, case-insensitive.
+#
+#   Our own nick is a highlight as a whole word, looked for separately
+#   since it changes when the server makes us take another one.
+
+NORMAL = 'normal'
+HIGHLIGHT = 'highlight'
+SUPPRESS = 'suppress'
+
+
+def _word(char):
+    return char.isalnum() or char == u'_'
+
+
+def _unicode(pattern):
+    '''pattern as unicode, byte strings being UTF-8.'''
+    if isinstance(pattern, unicode):
+        return pattern
+    try:
+        return pattern.decode('utf-8')
+    except UnicodeDecodeError:
+        raise ValueError('Rule %r is neither unicode nor UTF-8' % pattern)
+
+
+def literal_prefix(pattern):
+    '''The literal text every match of pattern starts with, lowercased.'''
+    prefix = []
+    for op, arg in sre_parse.parse(pattern):
+        if op == sre_constants.LITERAL:
+            prefix.append(unichr(arg))
+        elif op != sre_constants.AT or prefix:
+            break
+    return u''.join(prefix).lower()
+
+
+class Automaton(object):
+    '''Aho-Corasick automaton over lowercased keywords, each with a value.
+    Keywords only match as whole words, substrings anywhere.'''
+
+    def __init__(self, keywords, substrings=()):
+        goto = [{}]
+        found = [[]]
+        words = [(word.lower(), value, True) for word, value in keywords]
+        words += [(word.lower(), value, False) for word, value in substrings]
+        for word, value, whole in words:
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                if char not in goto[state]:
+                    goto.append({})
+                    found.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            found[state].append((len(word), whole and _word(word[0]), whole and _word(word[-1]), value))
+
+        # breadth first, so a state's failure state is done before it, and
+        # every state gets the transitions and keywords of its failure state
+        fail = [0] * len(goto)
+        delta = [goto[0]] + [None] * (len(goto) - 1)
+        queue = list(goto[0].itervalues())
+        for state in queue:
+            delta[state] = dict(delta[fail[state]])
+            delta[state].update(goto[state])
+            found[state].extend(found[fail[state]])
+            for char, child in goto[state].iteritems():
+                fail[child] = delta[fail[state]].get(char, 0)
+                queue.append(child)
+
+        self.delta = delta
+        self.found = [tuple(f) for f in found]
+        self.states = len(goto)
+
+    def matches(self, text):
+        '''(start, end, value) for every whole word keyword in text, which
+        has to be lowercased already.'''
+        delta = self.delta
+        found = self.found
+        n = len(text)
+        state = 0
+        for i, char in enumerate(text):
+            state = delta[state].get(char, 0)
+            if found[state]:
+                end = i + 1
+                for length, left, right, value in found[state]:
+                    start = end - length
+                    if left and start > 0 and _word(text[start - 1]):
+                        continue
+                    if right and end < n and _word(text[end]):
+                        continue
+                    yield start, end, value
+
+
+class Rules(object):
+
+    def __init__(self, keywords=(), regexes=(), nicks=(), outputs=()):
+        '''keywords, regexes and nicks are (pattern, action) pairs, outputs
+        the output names that can be actions, most important first. Patterns
+        are matched as unicode, byte strings are taken to be UTF-8.'''
+        keywords = [(_unicode(word), action) for word, action in keywords]
+        regexes = [(_unicode(pattern), action) for pattern, action in regexes]
+        nicks = [(_unicode(nick), action) for nick, action in nicks]
+        self.actions = [SUPPRESS, HIGHLIGHT] + [o for o in outputs if o not in (SUPPRESS, HIGHLIGHT)]
+        self.actions.append(NORMAL)
+        rank = dict((action, i) for i, action in enumerate(self.actions))
+        for pattern, action in list(keywords) + list(regexes) + list(nicks):
+            if action not in rank:
+                raise ValueError('Unknown action %r for %r' % (action, pattern))
+        self.normal = rank[NORMAL]
+
+        # regular expressions with a literal prefix of a few characters are
+        # triggered by the automaton finding it, values -1, -2, ... there
+        merged = {}
+        self.triggered = []
+        triggers = []
+        for pattern, action in regexes:
+            regex = re.compile(pattern, re.I | re.U)
+            prefix = literal_prefix(pattern)
+            if len(prefix) >= 3:
+                self.triggered.append((rank[action], regex))
+                triggers.append((prefix, -len(self.triggered)))
+            else:
+                merged.setdefault(rank[action], []).append('(?:%s)' % pattern)
+        self.regexes = [(r, re.compile('|'.join(patterns), re.I | re.U))
+                        for r, patterns in sorted(merged.iteritems())]
+
+        self.keywords = Automaton([(word, rank[action]) for word, action in keywords], triggers)
+        if self.keywords.states == 1:
+            self.keywords = None
+
+        self.nicks = dict((nick.lower(), rank[action]) for nick, action in nicks)
+        self._me = (None, None)
+
+    def classify(self, text, nick=None, me=None):
+        '''The action for a message text from nick, me being our own nick.'''
+        best = self.normal
+        if self.nicks and nick is not None:
+            best = self.nicks.get(nick.lower(), best)
+            if best == 0:
+                return SUPPRESS
+        regexes = self.regexes
+        if self.keywords is not None:
+            for start, end, r in self.keywords.matches(text.lower()):
+                if r < 0:
+                    if regexes is self.regexes:
+                        regexes = list(regexes)
+                    regexes.append(self.triggered[-1 - r])
+                elif r < best:
+                    best = r
+                    if best == 0:
+                        return SUPPRESS
+            if regexes is not self.regexes:
+                regexes.sort()
+        for r, regex in regexes:
+            if r >= best:
+                break
+            if regex.search(text):
+                best = r
+                break
+        if me and best > 1 and self._nick(me).search(text):
+            best = 1
+        return self.actions[best]
+
+    def _nick(self, me):
+        if self._me[0] != me:
+            self._me = (me, re.compile(r'(?<!\w)%s(?!\w)' % re.escape(me), re.I | re.U))
+        return self._me[1]
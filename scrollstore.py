@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+#==============================================================================#
+#   Persistent scrollback store
+#==============================================================================#
+#
+#   Everything IRCHandler prints is also appended to a single file, so there
+#   is a history beyond the paper and the week of irc.log. A record is a
+#   fixed header followed by the strings as UTF-8:
+#
+#       time (double)  flags (byte)  channel, nick lengths (bytes)
+#       message length (ushort)  channel  nick  message
+#
+#   Records are only ever appended, each with a single write. Readers map
+#   the file and pick up what was appended since with refresh(), so the
+#   reprint CLI below can run next to ircterm. A record cut short by a crash
+#   is ignored by readers and cut off when the store is next opened for
+#   writing.
+#
+#   The indexes are kept in memory and built from the record headers when
+#   the store is opened: the record offsets and times by record number, the
+#   record numbers per nick (case-insensitive) and those of highlights. Only
+#   readers build them by default; ircterm's store only ever appends, so
+#   it just scans the headers for where the last complete record ends and
+#   keeps nothing per record.
+#   Times in the index never go backwards, a record from before a clock
+#   step is indexed at the time of the one before it, so the time index can
+#   be searched with bisect.
+
+PATH = 'scrollback.dat'
+MAGIC = 'IRCSCRL1'
+
+# record flags
+HIGHLIGHT = 1
+PRIVATE = 2
+NOTICE = 4
+EVENT = 8           # join/part/quit/mode/topic, message is the whole line
+
+_header = struct.Struct('<dBBBH')
+MAX_NAME = 255
+MAX_MESSAGE = 65535
+
+
+class Record(namedtuple('Record', 'time channel nick flags message')):
+    __slots__ = ()
+
+    def line(self):
+        '''The record as IRCHandler prints it, without the timestamp.'''
+        if self.flags & EVENT or not self.nick:
+            return self.message
+        if self.flags & NOTICE:
+            return u'%s: %s' % (self.nick, self.message)
+        return u'%s<%s> %s' % (u'P' if self.flags & PRIVATE else u'', self.nick, self.message)
+
+
+def _utf8(text, limit):
+    '''text as at most limit bytes of UTF-8, cut between characters.'''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if len(text) <= limit:
+        return text
+    cut = limit
+    # don't split a UTF-8 sequence
+    while cut > 0 and 0x80 <= ord(text[cut]) < 0xC0:
+        cut -= 1
+    return text[:cut]
+
+
+def _timestamp(when):
+    '''Seconds since the epoch for a datetime or a number.'''
+    if isinstance(when, datetime):
+        return time.mktime(when.timetuple()) + when.microsecond / 1e6
+    return when
+
+
+class ScrollStore(object):
+
+    def __init__(self, path=PATH, writable=True, indexed=None):
+        '''Open the store at path, creating it when writable. Only an
+        indexed store can be read from, stores are indexed unless writable
+        by default.'''
+        self.path = path
+        self.writable = writable
+        self.indexed = not writable if indexed is None else indexed
+        if writable:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+            if os.fstat(self._fd).st_size == 0:
+                os.write(self._fd, MAGIC)
+        else:
+            self._fd = os.open(path, os.O_RDONLY)
+        self._map = None
+        self._mapped = 0
+
+        self._offsets = array('L')
+        self._times = array('d')
+        self._nicks = {}
+        self._highlights = array('L')
+        self._count = 0
+        self._end = len(MAGIC)
+
+        self._remap()
+        if self._mapped and self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise IOError('%s is not a scrollback store' % path)
+        self.refresh()
+
+        if writable:
+            size = os.fstat(self._fd).st_size
+            if size > self._end:
+                logger = logging.getLogger('IRCTerm.ScrollStore')
+                logger.warn('Dropping %d bytes of an incomplete record at the end of %s',
+                            size - self._end, path)
+                os.ftruncate(self._fd, self._end)
+
+    def _remap(self):
+        size = os.fstat(self._fd).st_size
+        if size == self._mapped:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._mapped = 0
+        if size:
+            self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+            self._mapped = size
+
+    def _index(self, offset, when, nick, flags):
+        '''Count a record, and index it when the store is indexed; nick is
+        UTF-8.'''
+        number = self._count
+        self._count += 1
+        if not self.indexed:
+            return
+        self._offsets.append(offset)
+        self._times.append(max(when, self._times[-1]) if number else when)
+        if nick:
+            nick = nick.decode('utf-8', 'replace').lower()
+            if nick not in self._nicks:
+                self._nicks[nick] = array('L')
+            self._nicks[nick].append(number)
+        if flags & HIGHLIGHT:
+            self._highlights.append(number)
+
+    def refresh(self):
+        '''Index the records appended since the last refresh, returns how
+        many there were.'''
+        self._remap()
+        count = self._count
+        m = self._map
+        offset = self._end
+        end = self._mapped
+        while offset + _header.size <= end:
+            when, flags, chan_len, nick_len, msg_len = _header.unpack_from(m, offset)
+            start = offset + _header.size + chan_len
+            stop = start + nick_len + msg_len
+            if stop > end:
+                break
+            self._index(offset, when, m[start:start + nick_len], flags)
+            offset = stop
+        self._end = offset
+        return self._count - count
+
+    def append(self, channel, nick, message, flags=0, when=None):
+        '''Add a record, when defaults to now.'''
+        if when is None:
+            when = time.time()
+        channel = _utf8(channel or '', MAX_NAME)
+        nick = _utf8(nick or '', MAX_NAME)
+        message = _utf8(message, MAX_MESSAGE)
+        record = _header.pack(when, flags, len(channel), len(nick), len(message))
+        os.write(self._fd, record + channel + nick + message)
+        self._index(self._end, when, nick, flags)
+        self._end += len(record) + len(channel) + len(nick) + len(message)
+
+    def __len__(self):
+        return self._count
+
+    def _check_indexed(self):
+        if not self.indexed:
+            raise ValueError('%s was opened without indexes, open it with indexed=True '
+                             'to read from it' % self.path)
+
+    def __getitem__(self, number):
+        self._check_indexed()
+        offset = self._offsets[number]
+        if offset + _header.size > self._mapped:
+            self._remap()
+        m = self._map
+        when, flags, chan_len, nick_len, msg_len = _header.unpack_from(m, offset)
+        start = offset + _header.size
+        if start + chan_len + nick_len + msg_len > self._mapped:
+            self._remap()
+            m = self._map
+        channel = m[start:start + chan_len]
+        start += chan_len
+        nick = m[start:start + nick_len]
+        start += nick_len
+        message = m[start:start + msg_len]
+        return Record(when, channel.decode('utf-8', 'replace'), nick.decode('utf-8', 'replace'),
+                      flags, message.decode('utf-8', 'replace'))
+
+    def query(self, nick=None, highlight=False, since=None, until=None, last=None):
+        '''Records from nick and/or highlights from since up to until
+        (datetimes or seconds since the epoch), oldest first, only the last
+        ones when given.'''
+        self._check_indexed()
+        if not self.writable:
+            self.refresh()
+        lo = 0 if since is None else bisect.bisect_left(self._times, _timestamp(since))
+        hi = len(self._times) if until is None else bisect.bisect_left(self._times, _timestamp(until))
+
+        if nick is not None:
+            numbers = self._nicks.get(nick.lower(), array('L'))
+        elif highlight:
+            numbers = self._highlights
+        else:
+            numbers = xrange(lo, hi)
+        if nick is not None or highlight:
+            numbers = numbers[bisect.bisect_left(numbers, lo):bisect.bisect_left(numbers, hi)]
+
+        records = []
+        for number in reversed(numbers):
+            record = self[number]
+            if highlight and not record.flags & HIGHLIGHT:
+                continue
+            records.append(record)
+            if last is not None and len(records) >= last:
+                break
+        records.reverse()
+        return records
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+#----------------------------------------------------------------------#
+#   Reprinting
+#----------------------------------------------------------------------#
+
+def parse_time(text, now=None):
+    '''A datetime for 'HH:MM[:SS]' (the last time it was that time),
+    'YYYY-MM-DD [HH:MM[:SS]]' or a duration back from now like '90m', '2h'
+    or '3d'.'''
+    now = now or datetime.now()
+    text = text.strip()
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+    if text[-1:] in units and text[:-1].isdigit():
+        return now - timedelta(**{units[text[-1]]: int(text[:-1])})
+    for fmt in ('%H:%M', '%H:%M:%S'):
+        try:
+            t = datetime.strptime(text, fmt).time()
+        except ValueError:
+            continue
+        when = datetime.combine(now.date(), t)
+        return when if when <= now else when - timedelta(days=1)
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    raise ValueError('Not a time: %r' % text)
+
+
+def reprint(records, output, title=None):
+    '''Send records to output (an IRCScrollback or anything with its
+    print_line) with their own timestamps, and a line where the day
+    changes.'''
+    if title is not None:
+        output.print_line('------- %s -------' % title, timestamp=False)
+    day = None
+    for record in records:
+        when = datetime.fromtimestamp(record.time)
+        if when.date() != day:
+            day = when.date()
+            output.print_line('------- %s -------' % day, timestamp=False)
+        output.print_line(record.line(), timestamp=when, highlight=bool(record.flags & HIGHLIGHT))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Reprint lines from the scrollback store.')
+    parser.add_argument('--store', default=PATH, help='the store, default %(default)s')
+    parser.add_argument('-n', '--nick', help='only lines from this nick')
+    parser.add_argument('-m', '--mentions', action='store_true', help='only highlighted lines')
+    parser.add_argument('-s', '--since', type=parse_time, help="e.g. 09:00, '2015-03-01 18:00' or 2h")
+    parser.add_argument('-u', '--until', type=parse_time)
+    parser.add_argument('-l', '--last', type=int, help='only the last LAST lines')
+    parser.add_argument('--port', help='printer serial port, the default one if not given')
+    parser.add_argument('--png', help='print on a virtual printer and save the paper here')
+    parser.add_argument('--list', action='store_true', help='list on the console instead of printing')
+    args = parser.parse_args()
+
+    store = ScrollStore(args.store, writable=False)
+    records = store.query(args.nick, args.mentions, args.since, args.until, args.last)
+    store.close()
+
+    if args.list:
+        for record in records:
+            print '%s %s' % (datetime.fromtimestamp(record.time).strftime('%Y-%m-%d %H:%M:%S'),
+                             record.line().encode('utf-8'))
+    else:
+        # the printer can only be used by one process, stop ircterm first
+        # or use --png
+        from ircterm import IRCScrollback
+        port = args.port
+        if args.png:
+            import virtualprinter
+            port = virtualprinter.VirtualPrinter()
+        scrollback = IRCScrollback(port)
+        reprint(records, scrollback, 'Scrollback, %d lines' % len(records))
+        if args.png:
+            print 'paper saved to %s' % port.save(args.png)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import sys
+import textwrap
+import threading
+from collections import deque
+from datetime import datetime
+
+import ircformat
+from printqueue import PrintQueue, BLOCK, DROP_OLDEST, COALESCE, MERGE_LIMIT
+from termcolor import colored
+
+#==============================================================================#
+#   Output sinks and the dispatcher feeding them
+#==============================================================================#
+#
+#   A sink is anything with print_line(text, timestamp, highlight, event):
+#   the printer (IRCScrollback), the VFD (VFDTail), and the ones here, the
+#   console, the log and a page on localhost that follows the channels.
+#   event is the events.Privmsg, Join, ... the line was made from, the same
+#   object the rules and the routes had, or None for lines of our own and
+#   ones a queue merged. A sink says how it wants to be fed with a few class
+#   attributes:
+#
+#       QUEUE       lines its queue holds
+#       POLICY      what happens when that is full, see printqueue.py
+#       MERGE_LIMIT characters a line merged by 'coalesce' may grow to
+#       WIDTH       columns to wrap at, None for no wrapping
+#       ENCODING    what its lines are encoded to
+#
+#   The Sink base class does the rendering from WIDTH and ENCODING, the
+#   printer and the VFD render for themselves and only have the first two.
+#
+#   Dispatcher puts every sink behind its own PrintQueue, with its own
+#   writer thread, and those are the outputs router.Router fans the lines
+#   out to. So every sink takes a line as soon as it is handed one and a
+#   stalled printer never holds up the VFD or the log, it only fills its
+#   own queue. The queues count what went through them and what had to be
+#   dropped, Dispatcher logs that every STATS_INTERVAL seconds.
+
+STATS_INTERVAL = 600.0
+
+
+class Sink(object):
+
+    QUEUE = 256
+    POLICY = DROP_OLDEST
+    WIDTH = None
+    ENCODING = 'utf-8'
+    TIMESTAMP = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, width=None):
+        if width is not None:
+            self.WIDTH = width
+
+    def render(self, text, timestamp=True):
+        '''The line as encoded lines of at most WIDTH columns, styles and
+        colours stripped.'''
+        text = ircformat.strip(text)
+        if timestamp is True:
+            timestamp = datetime.now()
+        if timestamp:
+            text = u'%s %s' % (timestamp.strftime(self.TIMESTAMP), text)
+        lines = textwrap.wrap(text, self.WIDTH) if self.WIDTH else [text]
+        if isinstance(text, unicode):
+            lines = [line.encode(self.ENCODING, 'replace') for line in lines]
+        return lines
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        self.write(self.render(text, timestamp), highlight, event)
+
+    def write(self, lines, highlight, event=None):
+        raise NotImplementedError
+
+
+class ConsoleSink(Sink):
+    '''Lines on stdout, highlights in red.'''
+
+    def __init__(self, width=None, stream=None):
+        Sink.__init__(self, width)
+        self.stream = stream if stream is not None else sys.stdout
+        self.ENCODING = getattr(self.stream, 'encoding', None) or self.ENCODING
+
+    def write(self, lines, highlight, event=None):
+        color = 'red' if highlight else 'green'
+        self.stream.write(''.join(colored(line, color) + '\n' for line in lines))
+        self.stream.flush()
+
+
+class LogSink(Sink):
+    '''Lines to a logger, and through logsetup to irc.log. The event goes
+    along as the record's event, which the JSON log writes out.'''
+
+    # logsetup already queues the records, nothing is lost here
+    QUEUE = 1024
+    POLICY = BLOCK
+
+    def __init__(self, name='IRCTerm.Router.log'):
+        Sink.__init__(self)
+        self.logger = logging.getLogger(name)
+
+    def render(self, text, timestamp=True):
+        # the log has times of its own
+        return [ircformat.strip(text)]
+
+    def write(self, lines, highlight, event=None):
+        for line in lines:
+            self.logger.info('%s', line, extra={'event': event})
+
+#----------------------------------------------------------------------#
+#   Web viewer
+#----------------------------------------------------------------------#
+#
+#   WebSink serves a page on localhost with the last KEEP lines that then
+#   follows new ones as they come, as server-sent events: a plain HTTP
+#   response that stays open, which every browser reads with EventSource
+#   and which needs nothing beyond the standard library. A page that lost
+#   the connection gets what it missed from Last-Event-ID.
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>i3ircterm</title>
+<style>
+body { background: #000; color: #3c3; font: 14px monospace; margin: 1em; }
+div { white-space: pre-wrap; }
+.highlight { color: #f44; }
+</style></head>
+<body><script>
+var events = new EventSource('/events');
+events.onmessage = function (e) {
+    var line = JSON.parse(e.data);
+    var div = document.createElement('div');
+    div.textContent = line.text;
+    if (line.highlight)
+        div.className = 'highlight';
+    document.body.appendChild(div);
+    while (document.body.childNodes.length > %(keep)d)
+        document.body.removeChild(document.body.firstChild);
+    window.scrollTo(0, document.body.scrollHeight);
+};
+</script></body></html>
+'''
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # mostly a page closed while following
+        logger = logging.getLogger('IRCTerm.WebSink')
+        logger.debug('Request from %s failed', client_address[0], exc_info=True)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # a comment line this often keeps proxies and the browser from giving up
+    KEEPALIVE = 15.0
+
+    def do_GET(self):
+        sink = self.server.sink
+        if self.path == '/':
+            page = PAGE % {'keep': sink.KEEP}
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+        elif self.path == '/events':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                last = int(self.headers.get('Last-Event-ID', -1))
+            except ValueError:
+                last = -1
+            self._follow(sink, last)
+        else:
+            self.send_error(404)
+
+    def _follow(self, sink, last):
+        while not sink.closed:
+            lines = sink.since(last, self.KEEPALIVE)
+            try:
+                if not lines:
+                    self.wfile.write(': keepalive\n\n')
+                for number, data in lines:
+                    self.wfile.write('id: %d\ndata: %s\n\n' % (number, data))
+                    last = number
+                self.wfile.flush()
+            except (IOError, OSError):
+                return
+
+    def log_message(self, format, *args):
+        logger = logging.getLogger('IRCTerm.WebSink')
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+class WebSink(Sink):
+    '''The channels on http://localhost:PORT/'''
+
+    PORT = 8037
+    # lines a new page starts with
+    KEEP = 200
+
+    def __init__(self, port=PORT, host='127.0.0.1'):
+        Sink.__init__(self)
+        self.lines = deque(maxlen=self.KEEP)
+        self.count = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self.server = _Server((host, port), _Handler)
+        self.server.sink = self
+        self._thread = threading.Thread(target=self.server.serve_forever, name='WebSink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, lines, highlight, event=None):
+        with self._cond:
+            for line in lines:
+                data = json.dumps({'text': line.decode(self.ENCODING), 'highlight': highlight})
+                self.lines.append((self.count, data))
+                self.count += 1
+            self._cond.notify_all()
+
+    def since(self, last, timeout=None):
+        '''The (number, JSON) lines after number last, waiting up to timeout
+        seconds for there to be any.'''
+        with self._cond:
+            if self.count - 1 <= last and not self.closed:
+                self._cond.wait(timeout)
+            return [(number, data) for number, data in self.lines if number > last]
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+#----------------------------------------------------------------------#
+#   Dispatcher
+#----------------------------------------------------------------------#
+
+class Dispatcher(object):
+
+    def __init__(self, sinks, loop=None, interval=STATS_INTERVAL):
+        '''Put each of sinks (a dict of name to sink) behind a PrintQueue
+        of its own, those are in outputs. With a loop the queue counters
+        are logged every interval seconds.'''
+        self.sinks = dict(sinks)
+        self.outputs = {}
+        for name, sink in self.sinks.iteritems():
+            self.outputs[name] = PrintQueue(sink, getattr(sink, 'QUEUE', 64),
+                                            getattr(sink, 'POLICY', COALESCE), name=name,
+                                            merge_limit=getattr(sink, 'MERGE_LIMIT', MERGE_LIMIT))
+        self.loop = loop
+        self.interval = interval
+        if loop is not None:
+            loop.call_later(interval, self._log_stats)
+
+    def stats(self):
+        '''Sink name -> the counters of its queue, see PrintQueue.stats().'''
+        return dict((name, queue.stats()) for name, queue in self.outputs.iteritems())
+
+    def _log_stats(self):
+        self.log_stats()
+        self.loop.call_later(self.interval, self._log_stats)
+
+    def log_stats(self):
+        logger = logging.getLogger('IRCTerm.Dispatcher')
+        for name, stats in sorted(self.stats().iteritems()):
+            logger.info('%s: %d lines, %.2f/s, %d dropped, %d coalesced, depth %d (max %d), '
+                        'latency avg %.3f s max %.3f s', name, stats['printed'],
+                        stats['throughput'], stats['dropped'], stats['coalesced'],
+                        stats['depth'], stats['max_depth'], stats['avg_latency'],
+                        stats['max_latency'])
+
+    def close(self, timeout=None):
+        '''Print what is still queued and stop the sinks that can be.'''
+        for name, queue in self.outputs.iteritems():
+            queue.close(timeout)
+            close = getattr(self.sinks[name], 'close', None)
+            if close is not None:
+                close()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import logging
+import threading
+import time
+from collections import deque
+
+import ircformat
+import noritake
+from printqueue import DROP_OLDEST
+
+#==============================================================================#
+#   Live IRC tail on the Noritake VFD
+#==============================================================================#
+#
+#   VFDTail has the same print_line() as IRCScrollback and shows the last
+#   ROWS lines, newest at the bottom. Lines wider than COLS run as a marquee.
+#
+#   print_line() only records the line; a separate thread redraws through a
+#   noritake.FrameBuffer at most FPS times a second, so a burst of messages
+#   costs one redraw of the final frame rather than one per message, and
+#   the caller never waits on the GPIO bus.
+#
+#   While something is typed on the keyboard, edit() puts it on the bottom
+#   row with the cursor where the next character goes. Typing is drawn
+#   right away rather than at the next frame, and as the FrameBuffer only
+#   sends the cells that changed a keystroke is a few bytes on the bus.
+
+
+class VFDTail(object):
+
+    # most redraws per second
+    FPS = 10
+    # marquee: seconds per column, seconds to hold the start, blank columns
+    # between the end of the text and its next start
+    MARQUEE_STEP = 0.25
+    MARQUEE_PAUSE = 1.5
+    MARQUEE_GAP = 4
+    # marker in front of highlighted lines
+    HIGHLIGHT = u'»'
+    # in front of the line being typed
+    PROMPT = u'>'
+    # as a sinks.Dispatcher sink: only the last ROWS lines get shown anyway
+    QUEUE = 64
+    POLICY = DROP_OLDEST
+
+    def __init__(self, screen, fps=FPS):
+        self.framebuffer = noritake.FrameBuffer(screen)
+        self.rows = self.framebuffer.rows
+        self.cols = self.framebuffer.cols
+        self.interval = 1.0 / fps
+
+        # (text, time it arrived)
+        self.lines = deque(maxlen=self.rows)
+        self.frames = 0
+        # (text, cursor) of the line being typed
+        self._edit = None
+        self._typed = False
+        self._dirty = False
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name='VFDTail')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def print_line(self, text, timestamp=True, highlight=False, event=None):
+        # no styles on the VFD, and colour codes would leave their digits
+        text = ircformat.strip(text)
+        if highlight:
+            text = self.HIGHLIGHT + text
+        with self._cond:
+            self.lines.append((text, time.time()))
+            self._dirty = True
+            self._cond.notify()
+
+    def edit(self, text, cursor=0):
+        '''Show text being typed on the bottom row with the cursor at cursor,
+        None to give the row back to the channel.'''
+        with self._cond:
+            self._edit = (text, cursor) if text is not None else None
+            self._typed = True
+            self._dirty = True
+            self._cond.notify()
+
+    def _marquee(self, text, since, now):
+        if len(text) <= self.cols:
+            return text
+        loop = text + u' ' * self.MARQUEE_GAP
+        offset = int(max(0.0, now - since - self.MARQUEE_PAUSE) / self.MARQUEE_STEP) % len(loop)
+        return (loop + loop)[offset:offset + self.cols]
+
+    def _render(self, lines, edit, now):
+        '''Draw the frame, returns the cursor column on the bottom row when
+        editing.'''
+        rows = self.rows
+        if edit is not None:
+            rows -= 1
+            lines = lines[len(lines) - rows:] if rows else []
+        top = rows - len(lines)
+        for y in xrange(top):
+            self.framebuffer.line(y, u'')
+        for y, (text, since) in enumerate(lines):
+            self.framebuffer.line(top + y, self._marquee(text, since, now))
+        if edit is None:
+            return None
+        # scroll the line sideways to keep the cursor on the display
+        text, cursor = edit
+        text = self.PROMPT + text
+        x = len(self.PROMPT) + cursor
+        offset = max(0, x - self.cols + 1)
+        self.framebuffer.line(rows, text[offset:offset + self.cols])
+        return x - offset
+
+    def _run(self):
+        logger = logging.getLogger('IRCTerm.VFDTail')
+        next_frame = 0.0
+        while True:
+            with self._cond:
+                moving = any(len(text) > self.cols for text, since in self.lines)
+                while not self._dirty and not self._closed:
+                    self._cond.wait(self.MARQUEE_STEP if moving else None)
+                    if moving:
+                        break
+                if self._closed:
+                    return
+                lines = list(self.lines)
+                edit = self._edit
+                typed, self._typed = self._typed, False
+                self._dirty = False
+            # cap the refresh rate, whatever piled up meanwhile is drawn at
+            # once; typing doesn't wait
+            delay = next_frame - time.time()
+            if delay > 0 and not typed:
+                time.sleep(delay)
+                with self._cond:
+                    lines = list(self.lines)
+                    edit = self._edit
+                    self._typed = False
+                    self._dirty = False
+            now = time.time()
+            next_frame = now + self.interval
+            try:
+                x = self._render(lines, edit, now)
+                self.framebuffer.flush()
+                if x is not None:
+                    self.framebuffer.place_cursor(x, self.rows - 1)
+                self.frames += 1
+            except Exception:
+                logger.exception('VFD update failed')
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import binascii
+import logging
+import os
+import pty
+import struct
+import threading
+import time
+import tty
+import zlib
+from collections import deque
+
+import cp437
+import glyphs
+import raster
+from pacing import BITS_PER_BYTE, DOT_FEED_TIME, LINE_SPACING
+
+try:
+    import ImageFont, ImageDraw, Image
+except ImportError:
+    try:
+        from PIL import ImageFont, ImageDraw, Image
+    except ImportError:
+        ImageFont = ImageDraw = Image = None
+
+#==============================================================================#
+#   A software stand-in for the thermal printer
+#==============================================================================#
+#
+#   VirtualPrinter parses the byte stream ThermalPrinter sends (ESC @, ESC 7,
+#   DC2 #, ESC !, ESC E, ESC -, GS B, ESC {, ESC a, DC2 *, GS k, ...) exactly
+#   as the printer would, and lays the result out as dot rows on a virtual
+#   paper strip that save() writes out as a PNG. Text is drawn with a local
+#   bitmap font when PIL is around and as hollow boxes otherwise, which is
+#   enough to see the layout and about as much ink as real glyphs.
+#
+#   It has write() like a serial.Serial, so it can be handed straight to
+#   ThermalPrinter as its port, or it can sit behind a pty (serve_pty) so the
+#   unmodified program can open it like /dev/ttyO4.
+#
+#   Every byte is also run through a model of the printer's timing: it
+#   arrives BITS_PER_BYTE bit times after the previous one, and every dot row
+#   keeps the head busy for one heating pass per 8 * (heatingDots + 1) black
+#   dots in it (heatTime + heatInterval each, from ESC 7), or a plain paper
+#   feed step for blank rows. Bytes are consumed as the head gets to them;
+#   peak_backlog is the most that ever waited in the printer, and overruns
+#   counts bytes beyond input_buffer. print_time is when the last row left
+#   the head, counted from the first byte.
+
+ESC = 27
+GS = 29
+DC2 = 18
+LF = 10
+
+# arguments after the two command bytes for the fixed length commands
+ARGUMENTS = {
+    (ESC, 64): 0,       # ESC @     initialize
+    (ESC, 55): 3,       # ESC 7     heating dots, time, interval
+    (DC2, 35): 1,       # DC2 #     density and break time
+    (ESC, 33): 1,       # ESC !     print mode
+    (ESC, 69): 1,       # ESC E     bold
+    (ESC, 45): 1,       # ESC -     underline
+    (ESC, 123): 1,      # ESC {     upside down
+    (ESC, 97): 1,       # ESC a     justification
+    (ESC, 100): 1,      # ESC d     print and feed n lines
+    (ESC, 74): 1,       # ESC J     feed n dots
+    (ESC, 51): 1,       # ESC 3     line spacing
+    (ESC, 50): 0,       # ESC 2     default line spacing
+    (GS, 66): 1,        # GS B      inverse
+    (GS, 72): 1,        # GS H      barcode text position
+    (GS, 104): 1,       # GS h      barcode height
+    (GS, 119): 1,       # GS w      barcode module width
+}
+
+# (cell width, cell height) of font A and B
+FONTS = ((12, 24), (9, 17))
+
+ROW_MASK = (1 << raster.DOTS) - 1
+
+
+def _row_bytes(bits):
+    return binascii.unhexlify('%0*x' % (raster.ROW_BYTES * 2, bits))
+
+
+class VirtualPrinter(object):
+
+    BAUDRATE = 19200
+    # bytes the printer can hold before it starts losing data, None to only
+    # track peak_backlog
+    INPUT_BUFFER = None
+
+    def __init__(self, baudrate=BAUDRATE, input_buffer=INPUT_BUFFER, font_path=glyphs.FONT,
+                 clock=time.time):
+        self.byte_time = float(BITS_PER_BYTE) / baudrate
+        self.input_buffer = input_buffer
+        self.clock = clock
+        self.font_path = font_path
+        self._fonts = {}
+        self._glyphs = {}
+        self._lock = threading.Lock()
+
+        # the strip of paper, one packed row (raster.ROW_BYTES) per dot row
+        self.paper = []
+        # the text lines printed so far, decoded from CP437
+        self.lines = []
+        # commands that were not understood, as (offset, bytes)
+        self.unknown = []
+
+        self.bytes = 0
+        self.peak_backlog = 0
+        self.overruns = 0
+        self._start = None
+        self._serial_clock = 0.0
+        self._head_clock = 0.0
+        self._waiting = deque()
+        self._waiting_bytes = 0
+
+        self._cmd = bytearray()
+        self._need = 1
+        self._line = []
+        self.initialize()
+
+    def initialize(self):
+        '''ESC @, back to the power-on settings.'''
+        self.heating_dots = 7
+        self.heat_time = 80
+        self.heat_interval = 2
+        self.density = 10
+        self.break_time = 2
+        self.mode = 0
+        self.bold = False
+        self.underline = 0
+        self.inverse = False
+        self.upside_down = False
+        self.justify = 0
+        self.line_spacing = LINE_SPACING
+        self.barcode_text = 0
+        self.barcode_height = 50
+        self.barcode_width = 3
+        del self._line[:]
+
+    #----------------------------------------------------------------------#
+    #   Serial port side
+    #----------------------------------------------------------------------#
+
+    def write(self, data):
+        with self._lock:
+            now = self.clock()
+            if self._start is None:
+                self._start = now
+                self._serial_clock = self._head_clock = now
+            arrival = max(self._serial_clock, now)
+            for b in bytearray(data):
+                arrival += self.byte_time
+                self._arrive(arrival)
+                self._feed(b, arrival)
+            self._serial_clock = arrival
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def serve_pty(self):
+        '''Read from a new pty in a background thread and return the path of
+        its slave side, to be opened like the printer's serial port.'''
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+
+        def run():
+            logger = logging.getLogger('IRCTerm.VirtualPrinter.serve_pty')
+            while True:
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                try:
+                    self.write(data)
+                except Exception:
+                    logger.exception('Failed to parse printer data')
+        thread = threading.Thread(target=run, name='VirtualPrinter')
+        thread.daemon = True
+        thread.start()
+        # keep the slave open so reads don't fail between clients
+        self._pty = (master, slave)
+        return path
+
+    #----------------------------------------------------------------------#
+    #   Timing model
+    #----------------------------------------------------------------------#
+
+    def _arrive(self, arrival):
+        while self._waiting and self._waiting[0][0] <= arrival:
+            self._waiting_bytes -= self._waiting.popleft()[1]
+        backlog = self._waiting_bytes + len(self._cmd) + 1
+        self.peak_backlog = max(self.peak_backlog, backlog)
+        if self.input_buffer is not None and backlog > self.input_buffer:
+            self.overruns += 1
+        self.bytes += 1
+
+    def _consume(self, n, arrival):
+        '''The last n bytes are taken by the printer once its head is free.'''
+        done = max(arrival, self._head_clock)
+        self._head_clock = done
+        if done > arrival:
+            self._waiting.append((done, n))
+            self._waiting_bytes += n
+
+    def row_time(self, bits):
+        '''Head time for one dot row.'''
+        black = bin(bits).count('1')
+        if not black:
+            return DOT_FEED_TIME
+        passes = -(-black // (8 * (self.heating_dots + 1)))
+        return max(DOT_FEED_TIME, passes * (self.heat_time + self.heat_interval) * 10e-6)
+
+    def _print_row(self, bits):
+        self._head_clock += self.row_time(bits)
+        self.paper.append(_row_bytes(bits))
+
+    def _feed_dots(self, n):
+        for i in xrange(n):
+            self._print_row(0)
+
+    @property
+    def busy_until(self):
+        '''Clock time at which the head is done with everything so far.'''
+        return self._head_clock
+
+    @property
+    def print_time(self):
+        '''Seconds from the first byte until the head finished the last row.'''
+        if self._start is None:
+            return 0.0
+        return self._head_clock - self._start
+
+    #----------------------------------------------------------------------#
+    #   Command parser
+    #----------------------------------------------------------------------#
+
+    def _length(self, cmd):
+        '''Length the command starting in cmd needs, as far as cmd tells.'''
+        n = len(cmd)
+        if cmd[0] not in (ESC, GS, DC2):
+            return 1
+        if n < 2:
+            return 2
+        key = (cmd[0], cmd[1])
+        if key == (DC2, 42):
+            # DC2 * r n, then r rows of n bytes
+            if n < 4:
+                return 4
+            return 4 + cmd[2] * cmd[3]
+        if key == (GS, 107):
+            # GS k m, then n and n bytes for m >= 65, or NUL terminated data
+            if n < 3:
+                return 3
+            if cmd[2] >= 65:
+                return 5 if n < 4 else 4 + cmd[3]
+            return n if n > 3 and cmd[-1] == 0 else n + 1
+        return 2 + ARGUMENTS.get(key, 0)
+
+    def _feed(self, b, arrival):
+        self._cmd.append(b)
+        cmd = self._cmd
+        if cmd[0] == DC2 and len(cmd) > 4 and cmd[1] == 42 and cmd[3]:
+            # bitmap rows go to the head as soon as each one is complete
+            if (len(cmd) - 4) % cmd[3] == 0:
+                self._consume(cmd[3], arrival)
+                self._bitmap_row(cmd[-cmd[3]:])
+        if len(cmd) < self._need:
+            return
+        need = self._length(cmd)
+        if len(cmd) < need:
+            self._need = need
+            return
+        self._need = 1
+        self._cmd = bytearray()
+        if cmd[0] == DC2 and cmd[1] == 42:
+            return
+        self._consume(len(cmd), arrival)
+        self._execute(cmd)
+
+    def _execute(self, cmd):
+        b = cmd[0]
+        if b == LF:
+            self._print_line()
+        elif b >= 0x20:
+            self._text(b)
+        elif b in (ESC, GS, DC2):
+            key = (b, cmd[1])
+            arg = cmd[2] if len(cmd) > 2 else 0
+            if key == (ESC, 64):
+                self.initialize()
+            elif key == (ESC, 55):
+                self.heating_dots, self.heat_time, self.heat_interval = cmd[2:5]
+            elif key == (DC2, 35):
+                self.density = arg & 0x1F
+                self.break_time = arg >> 5
+            elif key == (ESC, 33):
+                self.mode = arg
+                self.underline = 1 if arg & 0x80 else 0
+                self.bold = bool(arg & 0x08)
+            elif key == (ESC, 69):
+                self.bold = bool(arg & 1)
+            elif key == (ESC, 45):
+                self.underline = arg & 3
+            elif key == (ESC, 123):
+                self.upside_down = bool(arg & 1)
+            elif key == (ESC, 97):
+                self.justify = min(arg, 2)
+            elif key == (ESC, 100):
+                self._print_line()
+                for i in xrange(max(0, arg - 1)):
+                    self._print_line()
+            elif key == (ESC, 74):
+                self._flush_line()
+                self._feed_dots(arg)
+            elif key == (ESC, 51):
+                self.line_spacing = arg
+            elif key == (ESC, 50):
+                self.line_spacing = LINE_SPACING
+            elif key == (GS, 66):
+                self.inverse = bool(arg & 1)
+            elif key == (GS, 72):
+                self.barcode_text = arg & 3
+            elif key == (GS, 104):
+                self.barcode_height = arg
+            elif key == (GS, 119):
+                self.barcode_width = arg
+            elif key == (GS, 107):
+                self._barcode(cmd)
+            else:
+                self.unknown.append((self.bytes - len(cmd), bytes(cmd)))
+        else:
+            self.unknown.append((self.bytes - len(cmd), bytes(cmd)))
+
+    #----------------------------------------------------------------------#
+    #   Layout
+    #----------------------------------------------------------------------#
+
+    def _cell(self):
+        return FONTS[self.mode & 1]
+
+    def _text(self, code):
+        width, height = self._cell()
+        if (len(self._line) + 1) * width > raster.DOTS:
+            # the printer wraps by itself when the line is full
+            self._print_line()
+        self._line.append((code, self.mode & 1, self.bold, self.underline, self.inverse))
+
+    def _flush_line(self):
+        if self._line:
+            self._print_line()
+
+    def _print_line(self):
+        line, self._line = self._line, []
+        self.lines.append(cp437.decode(''.join([chr(c[0]) for c in line])))
+        height = max([FONTS[c[1]][1] for c in line] or [self._cell()[1]])
+        rows = [0] * height
+        x = 0
+        for code, font, bold, underline, inverse in line:
+            width, cell_height = FONTS[font]
+            glyph = self._glyph(code, font)
+            mask = (1 << width) - 1
+            for y in xrange(height):
+                # glyphs of a smaller font sit on the baseline
+                gy = y - (height - cell_height)
+                bits = glyph[gy] if gy >= 0 else 0
+                if bold:
+                    bits |= bits >> 1
+                if underline and gy >= cell_height - underline:
+                    bits = mask
+                if inverse:
+                    bits ^= mask
+                rows[y] = rows[y] << width | bits
+            x += width
+        # left, centre or right of the free space
+        shift = (raster.DOTS - x) * (2 - self.justify) // 2
+        rows = [r << shift & ROW_MASK for r in rows]
+        if self.upside_down:
+            rows = [int(bin(r)[2:].zfill(raster.DOTS)[::-1], 2) for r in reversed(rows)]
+        for r in rows:
+            self._print_row(r)
+        self._feed_dots(self.line_spacing)
+
+    def _font(self, size):
+        if ImageFont is None or not os.path.exists(self.font_path):
+            return None
+        if size not in self._fonts:
+            self._fonts[size] = ImageFont.truetype(self.font_path, size)
+        return self._fonts[size]
+
+    def _glyph(self, code, font):
+        '''Rows of a character cell as ints, the leftmost dot in the high bit.'''
+        key = (code, font)
+        if key in self._glyphs:
+            return self._glyphs[key]
+        width, height = FONTS[font]
+        char = cp437.DECODING[code]
+        face = self._font(height - 1)
+        if char in (u' ', u'\xa0'):
+            rows = [0] * height
+        elif face is not None:
+            img = Image.new('1', (width, height), 0)
+            ImageDraw.Draw(img).text((0, 0), char, font=face, fill=1)
+            pixels = list(img.getdata())
+            rows = [int(''.join(['1' if p else '0' for p in pixels[y * width:(y + 1) * width]]), 2)
+                    for y in xrange(height)]
+        else:
+            # a hollow box filling the glyph area
+            top, bottom = height // 4, height - height // 8 - 1
+            edge = 1 << (width - 2) | 1 << 1
+            full = ((1 << (width - 2)) - 1) << 1
+            rows = [0] * height
+            for y in xrange(top, bottom + 1):
+                rows[y] = full if y in (top, bottom) else edge
+        self._glyphs[key] = rows
+        return rows
+
+    def _bitmap_row(self, data):
+        self._flush_line()
+        row = int(binascii.hexlify(bytes(data)), 16) if data else 0
+        row <<= max(0, raster.DOTS - 8 * len(data))
+        self._print_row(row >> max(0, 8 * len(data) - raster.DOTS) & ROW_MASK)
+
+    def _barcode(self, cmd):
+        '''A stand-in for the barcode: one bar per set bit of the data, at
+        the configured module width and height. Not scannable, but it takes
+        the space and ink of one.'''
+        self._flush_line()
+        if cmd[2] >= 65:
+            data = cmd[4:]
+        else:
+            data = cmd[3:-1]
+        bits = ''.join([bin(b)[2:].zfill(8) for b in data])
+        module = max(1, self.barcode_width)
+        bar = ''.join([c * module for c in bits])[:raster.DOTS]
+        row = int(bar.ljust(raster.DOTS, '0'), 2) if bar else 0
+        if self.barcode_text & 1:
+            self._text_line(data)
+        for i in xrange(self.barcode_height):
+            self._print_row(row)
+        if self.barcode_text & 2:
+            self._text_line(data)
+
+    def _text_line(self, data):
+        saved = self._line
+        self._line = []
+        for b in data:
+            self._text(b)
+        self._print_line()
+        self._line = saved
+
+    #----------------------------------------------------------------------#
+    #   Output
+    #----------------------------------------------------------------------#
+
+    def save(self, path):
+        '''Write the paper as a black and white PNG, without needing PIL.'''
+        with self._lock:
+            invert = ''.join([chr(255 - i) for i in xrange(256)])
+            # grayscale PNGs have 0 for black, the printer has 1
+            scanlines = ''.join(['\0' + row.translate(invert) for row in self.paper])
+        height = len(self.paper)
+
+        def chunk(kind, data):
+            return (struct.pack('>I', len(data)) + kind + data +
+                    struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+        with open(path, 'wb') as f:
+            f.write('\x89PNG\r\n\x1a\n')
+            f.write(chunk('IHDR', struct.pack('>IIBBBBB', raster.DOTS, max(height, 1), 1, 0, 0, 0, 0)))
+            f.write(chunk('IDAT', zlib.compress(scanlines or '\0' + '\xff' * raster.ROW_BYTES)))
+            f.write(chunk('IEND', ''))
+        return path
+
+    def stats(self):
+        return {'bytes': self.bytes, 'dot_rows': len(self.paper), 'lines': len(self.lines),
+                'print_time': self.print_time, 'peak_backlog': self.peak_backlog,
+                'overruns': self.overruns, 'unknown': len(self.unknown)}
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        sys.exit('Usage: %s output.png' % sys.argv[0])
+    vp = VirtualPrinter()
+    print 'Virtual printer listening on %s, ^C to save %s' % (vp.serve_pty(), sys.argv[1])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    vp.save(sys.argv[1])
+    for k, v in sorted(vp.stats().items()):
+        print '%-14s %s' % (k, v)
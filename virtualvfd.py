@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import gpiomem
+import noritake
+
+#==============================================================================#
+#   A software stand-in for the VFD, checking the bus timing
+#==============================================================================#
+#
+#   VirtualVFD is a gpiomem.FakeRegisters with the display on the pins: when
+#   E falls it latches the data lines, and it keeps the time the display
+#   would be busy with that byte (Display, from DISPLAY_TIMES). Whatever the
+#   real display would have lost or garbled is recorded in violations as
+#   (byte number, what, seconds):
+#
+#   'early'     the byte was strobed while the display was still busy, by
+#               that many seconds
+#   'hold'      a data line changed while E was high
+#
+#   With a BUSY pin it drives that input from the same model, so BusyTiming
+#   can be run against it. Hand it to noritake.MmapBackend as regs.
+#
+#   The model is its own, not noritake.Timing, so that what the bus waits
+#   and what the display needs are two separate guesses and the one can be
+#   checked against the other: undershoot() lists the commands a set of
+#   EXEC_TIMES doesn't wait long enough for. Pass stricter times to
+#   VirtualVFD to see what the bus does when the display is slower.
+
+# Seconds the display takes over each command, per command rather than in
+# EXEC_TIMES' four classes. Typical CU-Y figures, EXEC_TIMES has the margin.
+DISPLAY_TIMES = {'char': 40e-6,     # a character written
+                 'cursor': 40e-6,   # BS, HT, home, CR, and 0x1F 0x24 x y
+                 'mode': 40e-6,     # 0x1F 0x01..0x03, scroll mode
+                 'power': 40e-6,    # 0x13..0x16, display and cursor on and off
+                 'lf': 0.4e-3,      # line feed, scrolls the display in vertical mode
+                 'clear': 0.8e-3,   # 0x0C
+                 'init': 1.5e-3}    # ESC @
+
+CURSOR = frozenset((0x08, 0x09, 0x0B, 0x0D))
+POWER = frozenset((0x13, 0x14, 0x15, 0x16))
+
+# The display's side of the byte stream
+class Display(object):
+
+    def __init__(self, times=DISPLAY_TIMES):
+        self.times = dict(DISPLAY_TIMES, **times)
+        self._prefix = None
+        self._args = 0
+
+    # The command byte finishes, or 'char' for a character; None while a
+    # command is still waiting for more bytes
+    def command(self, byte):
+        if self._args:
+            self._args -= 1
+            return None if self._args else 'cursor'
+        prefix, self._prefix = self._prefix, None
+        if prefix == 0x1B:
+            return 'init' if byte == 0x40 else 'char'
+        if prefix == 0x1F:
+            if byte == 0x24:
+                self._args = 2
+                return None
+            return 'mode' if byte in (0x01, 0x02, 0x03) else 'char'
+        if byte == 0x1B or byte == 0x1F:
+            self._prefix = byte
+            return None
+        if byte == 0x0C:
+            return 'clear'
+        if byte == noritake.LF:
+            return 'lf'
+        if byte in CURSOR:
+            return 'cursor'
+        if byte in POWER:
+            return 'power'
+        return 'char'
+
+    # Seconds the display is busy after byte; taking in the bytes of a
+    # command that isn't complete yet takes as long as a character
+    def exec_time(self, byte):
+        return self.times[self.command(byte) or 'char']
+
+# Every command the display knows, with its bytes
+COMMANDS = (('char', (0x41,)),
+            ('cursor', (0x08,)),
+            ('cursor', (0x09,)),
+            ('cursor', (0x0B,)),
+            ('cursor', (0x0D,)),
+            ('cursor', noritake.cursor_bytes(23, 5)),
+            ('mode', noritake.OVERWRITE_MODE),
+            ('mode', noritake.VERTICAL_MODE),
+            ('mode', (0x1F, 0x03)),
+            ('power', (0x13,)),
+            ('power', (0x14,)),
+            ('power', (0x15,)),
+            ('power', (0x16,)),
+            ('lf', (noritake.LF,)),
+            ('clear', (0x0C,)),
+            ('init', (0x1B, 0x40)))
+
+# The commands noritake.Timing(times) gives less time than the display
+# needs, as (command, bytes, timing's seconds, the display's seconds)
+def undershoot(times=noritake.EXEC_TIMES, display_times=DISPLAY_TIMES):
+    short = []
+    for name, data in COMMANDS:
+        timing = noritake.Timing(times)
+        display = Display(display_times)
+        for byte in data:
+            waits, needs = timing.exec_time(byte), display.exec_time(byte)
+            if waits < needs:
+                short.append((name, tuple(data), waits, needs))
+                break
+    return short
+
+
+class VirtualVFD(gpiomem.FakeRegisters):
+
+    def __init__(self, pins=noritake.PINS, times=DISPLAY_TIMES, clock=None):
+        gpiomem.FakeRegisters.__init__(self)
+        layout = dict((name, gpiomem.HEADER[pin]) for name, pin in pins.iteritems())
+        self.e_bank, bit = layout['E']
+        self.e_mask = 1 << bit
+        self.data_pins = tuple(layout['DB%d' % i] for i in xrange(8))
+        self.data_masks = {}
+        for bank, bit in self.data_pins:
+            self.data_masks[bank] = self.data_masks.get(bank, 0) | 1 << bit
+        self.busy_pin = layout.get('BUSY')
+        # follows the byte stream for the execution times
+        self.model = Display(times)
+        self.clock = clock or noritake.monotonic
+        self.ready = 0.0
+        self.received = bytearray()
+        self.violations = []
+
+    def _e(self):
+        return self.regs[self.e_bank][gpiomem.DATAOUT] & self.e_mask
+
+    def write32(self, bank, offset, value):
+        falling = False
+        if offset in (gpiomem.SETDATAOUT, gpiomem.CLEARDATAOUT) and self._e():
+            if value & self.data_masks.get(bank, 0):
+                self.violations.append((len(self.received), 'hold', 0.0))
+            falling = (offset == gpiomem.CLEARDATAOUT and bank == self.e_bank
+                       and value & self.e_mask)
+        gpiomem.FakeRegisters.write32(self, bank, offset, value)
+        if falling:
+            self._latch()
+
+    def _latch(self):
+        now = self.clock()
+        byte = 0
+        for i, (bank, bit) in enumerate(self.data_pins):
+            byte |= (self.regs[bank][gpiomem.DATAOUT] >> bit & 1) << i
+        if now < self.ready:
+            self.violations.append((len(self.received), 'early', self.ready - now))
+        self.received.append(byte)
+        self.ready = now + self.model.exec_time(byte)
+
+    def read32(self, bank, offset):
+        value = gpiomem.FakeRegisters.read32(self, bank, offset)
+        if offset == gpiomem.DATAIN and self.busy_pin is not None and bank == self.busy_pin[0]:
+            mask = 1 << self.busy_pin[1]
+            if self.clock() < self.ready:
+                value |= mask
+            else:
+                value &= ~mask
+        return value